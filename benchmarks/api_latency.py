@@ -0,0 +1,91 @@
+#!/bin/env python3
+"""Measure API latency while the database is busy with a write.
+
+A writer thread keeps taking the database write lock for --hold seconds at a
+time (like a job committing a big result) while --clients threads read job
+status and listings through the API.  Run it with and without --no-wal to
+see what write-ahead logging buys the readers.
+"""
+import argparse
+import sqlite3
+import tempfile
+import threading
+import time
+from pathlib import Path
+import requests
+import common
+from engines.registry import engine_registry
+
+
+def writer(database: str, hold: float, stop: threading.Event, commits: list):
+    """Hold the write lock for a while, over and over"""
+    db = sqlite3.connect(database, timeout=30, isolation_level=None)
+    while not stop.is_set():
+        db.execute("BEGIN EXCLUSIVE")
+        db.execute("UPDATE transcriptionjob SET message = message WHERE id > 0")
+        time.sleep(hold)
+        db.execute("COMMIT")
+        commits.append(time.time())
+        time.sleep(hold / 4)
+    db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=8, help="Number of client threads")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per client")
+    parser.add_argument("--jobs", type=int, default=500, help="Jobs in the database")
+    parser.add_argument("--hold", type=float, default=0.2, help="Seconds the writer holds the lock")
+    parser.add_argument("--no-wal", action="store_true", help="Use the rollback journal instead of WAL")
+    args = parser.parse_args()
+
+    # nothing should start, the jobs are just there to be read.  With no
+    # cpu slots the node doesn't run any engine's jobs.
+    engine_registry.processors['whisper.cpp'] = common.stub_processor(0)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = common.make_config(Path(tmpdir),
+                                    database={'wal': not args.no_wal},
+                                    workers={'cpu': 0})
+        with common.BenchServer(config) as server:
+            session = requests.Session()
+            ids = [session.post(server.url + "/transcription/",
+                                headers=server.headers,
+                                json=common.stub_request()).json()['id'] for _ in range(args.jobs)]
+
+            stop = threading.Event()
+            commits = []
+            w = threading.Thread(target=writer, args=(config.files.database, args.hold, stop, commits))
+            w.start()
+            latencies = {'status': [], 'list': []}
+            errors = []
+            def client(n: int):
+                s = requests.Session()
+                for i in range(args.requests):
+                    if i % 4:
+                        kind, url = 'status', f"{server.url}/transcription/{ids[(n * args.requests + i) % len(ids)]}"
+                    else:
+                        kind, url = 'list', f"{server.url}/transcription/?limit=100"
+                    start = time.time()
+                    r = s.get(url, headers=server.headers)
+                    latencies[kind].append(time.time() - start)
+                    if r.status_code != 200:
+                        errors.append(r.status_code)
+            clients = [threading.Thread(target=client, args=(n,)) for n in range(args.clients)]
+            begin = time.time()
+            for c in clients:
+                c.start()
+            for c in clients:
+                c.join()
+            elapsed = time.time() - begin
+            stop.set()
+            w.join()
+
+    total = sum(len(v) for v in latencies.values())
+    print(f"{'rollback journal' if args.no_wal else 'WAL'}: {total} requests in {elapsed:.2f}s "
+          f"({total / elapsed:.0f}/s), {len(commits)} writer commits, {len(errors)} errors")
+    for kind, values in latencies.items():
+        print(common.summarize(kind, values))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+#!/bin/env python3
+"""Compare the cost of checking a bearer token by scanning the users file
+(the way it used to be done) with the in-memory credential index."""
+import argparse
+import random
+import tempfile
+import time
+from pathlib import Path
+import common
+from auth import CredentialStore
+
+
+def scan_file(users_file: str, credential: str):
+    """The original implementation: read the whole file on every request"""
+    with open(users_file) as f:
+        for l in f.readlines():
+            is_admin, user, token = l.strip().split(':')
+            if f"{user}:{token}" == credential:
+                return user, is_admin.lower()[0] == 'y'
+    return None
+
+
+def measure(fn, credentials: list[str]) -> list[float]:
+    times = []
+    for c in credentials:
+        start = time.perf_counter()
+        if fn(c) is None:
+            raise Exception(f"Lookup failed for {c}")
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=10000, help="Number of users in the file")
+    parser.add_argument("--lookups", type=int, default=2000, help="Number of lookups to time")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        users_file = str(Path(tmpdir, "users.txt"))
+        with open(users_file, "w") as f:
+            for i in range(args.users):
+                f.write(f"{'y' if i == 0 else 'n'}:user{i}:token-{i:08d}-{random.getrandbits(64):016x}\n")
+        lines = Path(users_file).read_text().splitlines()
+        credentials = [":".join(random.choice(lines).split(':')[1:]) for _ in range(args.lookups)]
+
+        store = CredentialStore(users_file)
+        # the first lookup loads the file
+        store.lookup(credentials[0])
+        print(common.summarize("file scan", measure(lambda c: scan_file(users_file, c), credentials), 1e6, "us"))
+        print(common.summarize("credential index", measure(store.lookup, credentials), 1e6, "us"))
+
+
+if __name__ == "__main__":
+    main()
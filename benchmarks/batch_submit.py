@@ -0,0 +1,54 @@
+#!/bin/env python3
+"""Compare submitting jobs one at a time with submitting them in batches.
+
+Nothing is run (there are no cpu slots, so the node doesn't run any
+engine's jobs), so this is just the cost of getting the jobs into the queue
+and checking on them afterwards.
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+import requests
+import common
+from engines.registry import engine_registry
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=2000, help="Number of jobs per method")
+    parser.add_argument("--batch", type=int, default=500, help="Jobs per batch")
+    args = parser.parse_args()
+
+    engine_registry.processors['whisper.cpp'] = common.stub_processor(0)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with common.BenchServer(common.make_config(Path(tmpdir), workers={'cpu': 0})) as server:
+            session = requests.Session()
+            start = time.time()
+            for _ in range(args.jobs):
+                session.post(server.url + "/transcription/", headers=server.headers,
+                             json=common.stub_request()).raise_for_status()
+            single = time.time() - start
+
+            ids = []
+            start = time.time()
+            for n in range(0, args.jobs, args.batch):
+                r = session.post(server.url + "/transcription/batch", headers=server.headers,
+                                 json=[common.stub_request()] * min(args.batch, args.jobs - n))
+                r.raise_for_status()
+                ids.extend(x['id'] for x in r.json())
+            batched = time.time() - start
+
+            start = time.time()
+            for n in range(0, len(ids), args.batch):
+                session.get(server.url + "/transcription/status", headers=server.headers,
+                            params={'ids': ",".join(str(x) for x in ids[n:n + args.batch])}).raise_for_status()
+            status = time.time() - start
+
+    print(f"one at a time: {args.jobs} jobs in {single:.2f}s ({args.jobs / single:.0f}/s)")
+    print(f"batches of {args.batch}: {args.jobs} jobs in {batched:.2f}s ({args.jobs / batched:.0f}/s)")
+    print(f"status of {len(ids)} jobs in batches of {args.batch}: {status * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
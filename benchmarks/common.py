@@ -0,0 +1,157 @@
+"""Shared plumbing for the benchmark scripts.
+
+The benchmarks run the real FastAPI application from rest_server.py in a
+background thread, but with the transcription engines replaced by stubs so
+no models, GPUs, or S3 are needed.
+"""
+import sys
+from pathlib import Path
+# the server modules import each other as top-level modules, so the server
+# directory needs to be on the path.  Keep sys.path[0] where it is since the
+# config model uses it to find the service root.
+sys.path.insert(1, str(Path(__file__).resolve().parent.parent / "transcription_server"))
+import json
+import socket
+import threading
+import time
+from tempfile import TemporaryDirectory
+import requests
+import uvicorn
+import rest_server
+from config_model import ServerConfig
+from job_model import TranscriptionJob, TranscriptionState
+from engines.whispercpp_model import WhisperCPPOptions
+from engines.upload import upload_outputs
+from engines.timing import StageTimer
+
+BENCH_USER = "benchuser"
+BENCH_TOKEN = f"{BENCH_USER}:benchmark-token"
+
+
+def make_config(workdir: Path, **overrides) -> ServerConfig:
+    """Create a server configuration where everything lives in workdir"""
+    users = Path(workdir, "users.txt")
+    users.write_text(f"y:{BENCH_TOKEN}\n")
+    config = ServerConfig(files={'database': str(Path(workdir, "transcription.db")),
+                                 'log_dir': str(workdir),
+                                 'models_dir': str(Path(workdir, "models")),
+                                 'users': str(users),
+                                 'spool_dir': str(Path(workdir, "spool")),
+                                 'transcript_cache': str(Path(workdir, "transcript_cache"))},
+                          **overrides)
+    config.server.root = str(Path(__file__).resolve().parent.parent)
+    return config
+
+
+def stub_processor(delay: float = 0.0, on_start=None):
+    """Build a processor that pretends to transcribe for delay seconds"""
+    def process_stub(job: TranscriptionJob, config: ServerConfig):
+        if on_start:
+            on_start(job)
+        if delay:
+            time.sleep(delay)
+        job.processing_time = delay
+        job.state = TranscriptionState.FINISHED
+        job.message = "Stub transcription has completed"
+    return process_stub
+
+
+def transfer_processor(delay: float = 0.0, on_start=None):
+    """Build a processor that does everything a real engine does except the
+       transcription: it downloads the input, "transcribes" it (by sleeping
+       for delay seconds, or not at all for a fixed cost), and uploads the
+       outputs the job asked for."""
+    def process_transfer(job: TranscriptionJob, config: ServerConfig):
+        if on_start:
+            on_start(job)
+        timer = StageTimer()
+        try:
+            req = WhisperCPPOptions(**json.loads(job.request)['options'])
+            with TemporaryDirectory() as tmpdir:
+                with timer.stage('media') as stage:
+                    r = requests.get(str(req.input), timeout=60)
+                    r.raise_for_status()
+                    stage['bytes'] = len(r.content)
+                with timer.stage('inference'):
+                    if delay:
+                        time.sleep(delay)
+                formats = ['json', 'vtt', 'csv', 'txt']
+                for fmt in formats:
+                    Path(tmpdir, f"output.{fmt}").write_text(f"Stub {fmt} transcript of job {job.id}\n")
+                with timer.stage('upload') as stage:
+                    stats = upload_outputs(req.outputs, Path(tmpdir), formats, config.uploads)
+                    stage['bytes'] = sum(x['sent_bytes'] for x in stats.values())
+            job.upload_stats = json.dumps(stats)
+            job.processing_time = timer.seconds('inference')
+            job.state = TranscriptionState.FINISHED
+            job.message = "Stub transcription has completed"
+        except Exception as e:
+            job.state = TranscriptionState.ERROR
+            job.message = str(e)
+        finally:
+            job.stage_timings = timer.to_json()
+    return process_transfer
+
+
+def stub_request(priority: int = 1, notification_type: str = 'expire',
+                 notification_url: str = None, input_url: str = 'http://127.0.0.1:9/input.wav',
+                 outputs: dict = None) -> dict:
+    """A transcription request the stub engine will accept"""
+    return {'version': '1',
+            'notification_type': notification_type,
+            'notification_url': notification_url,
+            'priority': priority,
+            'options': {'engine': 'whisper.cpp',
+                        'model': 'tiny.en',
+                        'input': input_url,
+                        'outputs': outputs or {'txt_url': 'http://127.0.0.1:9/output.txt'}}}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class BenchServer:
+    """Run the REST service in a background thread"""
+    def __init__(self, config: ServerConfig):
+        rest_server.app.server_config = config
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.headers = {'Authorization': f"Bearer {BENCH_TOKEN}"}
+        self.server = uvicorn.Server(uvicorn.Config(rest_server.app, 
+                                                    host='127.0.0.1', 
+                                                    port=self.port,
+                                                    log_level='warning'))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+    
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join(timeout=10)
+
+
+def percentile(values: list[float], pct: float) -> float:
+    """Nearest-rank percentile"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = max(0, min(len(values) - 1, round(pct / 100 * len(values) + 0.5) - 1))
+    return values[k]
+
+
+def summarize(name: str, values: list[float], scale: float = 1000, unit: str = "ms") -> str:
+    """One line of summary statistics for a set of measurements"""
+    if not values:
+        return f"{name}: no samples"
+    return (f"{name}: n={len(values)} "
+            f"mean={scale * sum(values) / len(values):.2f}{unit} "
+            f"p50={scale * percentile(values, 50):.2f}{unit} "
+            f"p99={scale * percentile(values, 99):.2f}{unit} "
+            f"max={scale * max(values):.2f}{unit}")
@@ -0,0 +1,60 @@
+#!/bin/env python3
+"""Measure how long a job sits in the queue before the dispatcher starts it.
+
+Two scenarios are measured with a stub engine:
+* idle - one job is submitted to an idle server and we wait for it to
+  finish before submitting the next.  This is the wakeup latency.
+* burst - all jobs are submitted at once and we measure the gap between
+  one job finishing and the next one starting.
+"""
+import argparse
+import tempfile
+import threading
+import time
+from pathlib import Path
+import requests
+import common
+from engines.registry import engine_registry
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=20, help="Number of jobs per scenario")
+    parser.add_argument("--delay", type=float, default=0.05, help="Stub inference time in seconds")
+    args = parser.parse_args()
+
+    starts = []
+    started = threading.Event()
+    def on_start(job):
+        starts.append((time.time(), job.queue_time))
+        started.set()
+    
+    engine_registry.processors['whisper.cpp'] = common.stub_processor(args.delay, on_start)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with common.BenchServer(common.make_config(Path(tmpdir))) as server:
+            session = requests.Session()
+            submit = lambda: session.post(server.url + "/transcription/", 
+                                          headers=server.headers,
+                                          json=common.stub_request()).raise_for_status()
+            # idle: queue-to-start with nothing else going on.
+            for _ in range(args.jobs):
+                started.clear()
+                submit()
+                started.wait(timeout=60)
+                time.sleep(args.delay + 0.05)
+            idle = [s - q for s, q in starts]
+
+            # burst: everything at once.
+            starts.clear()
+            for _ in range(args.jobs):
+                submit()
+            while len(starts) < args.jobs:
+                time.sleep(0.05)
+            gaps = [starts[i][0] - starts[i - 1][0] - args.delay for i in range(1, len(starts))]
+
+    print(common.summarize("idle queue-to-start", idle))
+    print(common.summarize("burst finish-to-next-start", gaps))
+
+
+if __name__ == "__main__":
+    main()
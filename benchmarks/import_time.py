@@ -0,0 +1,52 @@
+#!/bin/env python3
+"""Measure how long it takes to import the server, which is paid at every
+startup and every --reload.
+
+Each run is a fresh interpreter.  'lazy' imports rest_server the way the
+server does now, where the engine modules are loaded on first use.  'eager'
+also imports both engine modules, which is what startup used to cost.  The
+peak memory and whether the heavy modules (whisper, torch) were pulled in
+are reported too.
+"""
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+import common
+
+CHILD = """
+import sys, time, resource, json
+sys.path.insert(1, {path!r})
+start = time.perf_counter()
+import rest_server
+{extra}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed,
+                  'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  'heavy': sorted(m for m in ('whisper', 'torch') if m in sys.modules)}}))
+"""
+
+SCENARIOS = {'lazy': "",
+             'eager': "import engines.whisper_process, engines.whispercpp_process"}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5, help="Interpreters to start for each scenario")
+    args = parser.parse_args()
+
+    path = str(Path(__file__).resolve().parent.parent / "transcription_server")
+    for name, extra in SCENARIOS.items():
+        results = []
+        for _ in range(args.runs):
+            p = subprocess.run([sys.executable, "-c", CHILD.format(path=path, extra=extra)],
+                               stdout=subprocess.PIPE, encoding='utf-8', check=True)
+            results.append(json.loads(p.stdout.splitlines()[-1]))
+        print(common.summarize(f"{name} import", [r['seconds'] for r in results]) +
+              f" maxrss={max(r['maxrss'] for r in results) / 1024:.0f}MB"
+              f" heavy modules: {', '.join(results[0]['heavy']) or 'none'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+#!/bin/env python3
+"""Drive a mix of submit, poll, and list traffic at the service and see how
+it holds up.
+
+Jobs run on a stub engine that downloads its input from and uploads its
+outputs to a local S3 stand-in, with either a fixed (instant) or a
+sleep-based inference step.  Each kind of request is sent at a set rate for
+--duration seconds, then the server is given --drain seconds to finish the
+queue.  The report has the submit throughput, how long jobs waited to be
+dispatched, the API latency for each kind of request, and jobs per hour.
+Run it before and after a scheduler or database change and compare.
+"""
+import argparse
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import requests
+from requests.adapters import HTTPAdapter
+import common
+from engines.registry import engine_registry
+from standins import S3StandIn
+
+
+def paced(rate: float, duration: float, pool: ThreadPoolExecutor, fn):
+    """Hand fn to the pool rate times a second for duration seconds.  The
+       schedule doesn't wait for the requests to finish, so a slow server
+       gets the same offered load as a fast one."""
+    if rate <= 0:
+        return
+    start = time.time()
+    n = 0
+    while n / rate < duration:
+        delay = start + n / rate - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        pool.submit(fn)
+        n += 1
+
+
+def all_jobs(session: requests.Session, server: common.BenchServer) -> list[dict]:
+    """Every job in the database, a page at a time"""
+    jobs = []
+    after = 0
+    while True:
+        r = session.get(server.url + "/transcription/", headers=server.headers, params={'after': after})
+        r.raise_for_status()
+        jobs.extend(r.json())
+        if 'X-Next-Cursor' not in r.headers:
+            return jobs
+        after = r.headers['X-Next-Cursor']
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to send traffic for")
+    parser.add_argument("--drain", type=float, default=60, help="Seconds to wait for the queue to empty afterwards")
+    parser.add_argument("--submit-rate", type=float, default=10, help="Jobs submitted per second")
+    parser.add_argument("--poll-rate", type=float, default=50, help="Job status requests per second")
+    parser.add_argument("--list-rate", type=float, default=2, help="List requests per second")
+    parser.add_argument("--clients", type=int, default=32, help="Client threads sending the requests")
+    parser.add_argument("--inference", choices=['fixed', 'sleep'], default='sleep',
+                        help="Stub inference: fixed returns at once, sleep waits --delay seconds")
+    parser.add_argument("--delay", type=float, default=0.5, help="Seconds of sleep-based inference")
+    parser.add_argument("--slots", type=int, default=4, help="Jobs which can run at the same time")
+    parser.add_argument("--s3-delay", type=float, default=0.0, help="Seconds the S3 stand-in takes per request")
+    parser.add_argument("--input-size", type=int, default=1048576, help="Bytes in the input media")
+    args = parser.parse_args()
+
+    delay = args.delay if args.inference == 'sleep' else 0.0
+    engine_registry.processors['whisper.cpp'] = common.transfer_processor(delay)
+    with tempfile.TemporaryDirectory() as tmpdir, S3StandIn(args.s3_delay) as s3:
+        input_url = s3.add("/input.wav", random.randbytes(args.input_size))
+        # the stub fetches its own input, so there's nothing to prefetch
+        config = common.make_config(Path(tmpdir),
+                                    prefetch={'jobs': 0},
+                                    workers={'cpu': args.slots,
+                                             'engines': {'whisper.cpp': {'cpu': 1}}})
+        with common.BenchServer(config) as server:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=args.clients, pool_maxsize=args.clients)
+            session.mount("http://", adapter)
+
+            latencies = {'submit': [], 'poll': [], 'list': []}
+            errors = {'submit': 0, 'poll': 0, 'list': 0}
+            ids = []
+            lock = threading.Lock()
+            def timed(kind: str, method: str, url: str, **kwargs):
+                start = time.time()
+                try:
+                    r = session.request(method, url, headers=server.headers, timeout=60, **kwargs)
+                    ok = r.ok
+                except requests.RequestException:
+                    r, ok = None, False
+                with lock:
+                    latencies[kind].append(time.time() - start)
+                    if not ok:
+                        errors[kind] += 1
+                return r if ok else None
+
+            def submit():
+                n = random.getrandbits(32)
+                outputs = {fmt: f"{s3.url}/outputs/{n}.{fmt.split('_')[0]}"
+                           for fmt in ('json_url', 'vtt_url', 'txt_url', 'csv_url')}
+                r = timed('submit', 'POST', server.url + "/transcription/",
+                          json=common.stub_request(input_url=input_url, outputs=outputs))
+                if r is not None:
+                    with lock:
+                        ids.append(r.json()['id'])
+
+            def poll():
+                with lock:
+                    if not ids:
+                        return
+                    job_id = random.choice(ids)
+                timed('poll', 'GET', f"{server.url}/transcription/{job_id}")
+
+            def list_jobs():
+                timed('list', 'GET', server.url + "/transcription/", params={'limit': 100})
+
+            with ThreadPoolExecutor(max_workers=args.clients) as pool:
+                drivers = [threading.Thread(target=paced, args=(rate, args.duration, pool, fn))
+                           for rate, fn in ((args.submit_rate, submit),
+                                            (args.poll_rate, poll),
+                                            (args.list_rate, list_jobs))]
+                begin = time.time()
+                for d in drivers:
+                    d.start()
+                for d in drivers:
+                    d.join()
+            sent = time.time() - begin
+
+            # let the queue drain
+            deadline = time.time() + args.drain
+            while time.time() < deadline:
+                if not any(session.get(server.url + "/transcription/", headers=server.headers,
+                                       params={'state': state, 'limit': 1}).json()
+                           for state in ('queued', 'running')):
+                    break
+                time.sleep(0.25)
+            jobs = all_jobs(session, server)
+
+    finished = [j for j in jobs if j['state'] == 'finished']
+    dispatch = [j['start_time'] - j['queue_time'] for j in jobs if j['start_time']]
+    print(f"{args.inference} inference ({delay}s), {args.slots} slots, "
+          f"offered {args.submit_rate}/{args.poll_rate}/{args.list_rate} submit/poll/list per second "
+          f"for {args.duration}s")
+    print(f"submitted {len(ids)} jobs in {sent:.1f}s ({len(ids) / sent:.1f}/s), "
+          f"errors: {', '.join(f'{k} {v}' for k, v in errors.items())}")
+    for kind, values in latencies.items():
+        print(common.summarize(kind, values))
+    print(common.summarize("dispatch latency", dispatch))
+    states = {}
+    for j in jobs:
+        states[j['state']] = states.get(j['state'], 0) + 1
+    print(f"jobs: {', '.join(f'{k} {v}' for k, v in sorted(states.items()))}")
+    if finished:
+        span = max(j['finish_time'] for j in finished) - min(j['queue_time'] for j in finished)
+        print(f"{len(finished)} jobs finished in {span:.1f}s: {3600 * len(finished) / span:.0f} jobs/hour")
+    print(f"s3: {s3.gets} GETs ({s3.bytes_out} bytes), {s3.puts} PUTs ({s3.bytes_in} bytes)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+#!/bin/env python3
+"""Run several transcription nodes against one database file.
+
+Each node is a separate process running the service with a stub engine and
+its own spool and logs, but they all share the database and claim jobs from
+it with leases.  Jobs are submitted round-robin to the nodes, and the run
+reports how the jobs were spread over the nodes and whether any job was
+started more than once.
+
+With --kill-after one of the nodes is killed (SIGKILL, so it can't clean up)
+partway through.  Its jobs are stuck until their leases run out and another
+node requeues them, so the run also reports how long that took.  The jobs
+the dead node was running are the only ones that should be started twice.
+"""
+import argparse
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+import requests
+import common
+
+
+def run_node(args):
+    """The node process: serve until killed, logging each job start"""
+    from engines.registry import engine_registry
+    workdir = Path(args.workdir, f"node{args.node}")
+    workdir.mkdir(parents=True, exist_ok=True)
+    starts = open(Path(workdir, "starts"), "a")
+    def on_start(job):
+        starts.write(f"{job.id} {time.time()}\n")
+        starts.flush()
+    engine_registry.processors['whisper.cpp'] = common.stub_processor(args.delay, on_start)
+    config = common.make_config(workdir,
+                                prefetch={'jobs': 0},
+                                scheduler={'node_id': f"node{args.node}",
+                                           'lease_time': args.lease,
+                                           'heartbeat_interval': args.heartbeat},
+                                workers={'cpu': args.slots,
+                                         'engines': {'whisper.cpp': {'cpu': 1}}})
+    config.files.database = str(Path(args.workdir, "transcription.db"))
+    with common.BenchServer(config) as server:
+        print(server.url, flush=True)
+        while True:
+            time.sleep(60)
+
+
+def job_states(db: str) -> Counter:
+    """How many jobs are in each state.  The database has the enum names."""
+    with sqlite3.connect(db) as conn:
+        return Counter({state.lower(): n for state, n in
+                        conn.execute("select state, count(*) from transcriptionjob group by state")})
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=3, help="Number of node processes")
+    parser.add_argument("--jobs", type=int, default=300, help="Number of jobs to submit")
+    parser.add_argument("--delay", type=float, default=0.1, help="Stub inference time in seconds")
+    parser.add_argument("--slots", type=int, default=2, help="Jobs each node can run at the same time")
+    parser.add_argument("--lease", type=float, default=3.0, help="Lease time in seconds")
+    parser.add_argument("--heartbeat", type=float, default=1.0, help="Heartbeat interval in seconds")
+    parser.add_argument("--kill-after", type=float, default=0.0,
+                        help="Kill the last node this many seconds after the jobs are submitted (0 = don't)")
+    parser.add_argument("--timeout", type=float, default=300.0, help="Give up after this many seconds")
+    parser.add_argument("--node", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.node is not None:
+        return run_node(args)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = str(Path(tmpdir, "transcription.db"))
+        nodes = []
+        try:
+            # the first node creates the tables, so it has to be up before
+            # the others start
+            for i in range(args.nodes):
+                p = subprocess.Popen([sys.executable, __file__, "--node", str(i), "--workdir", tmpdir,
+                                      "--delay", str(args.delay), "--slots", str(args.slots),
+                                      "--lease", str(args.lease), "--heartbeat", str(args.heartbeat)],
+                                     stdout=subprocess.PIPE, encoding='utf-8')
+                nodes.append((p, p.stdout.readline().strip()))
+
+            session = requests.Session()
+            headers = {'Authorization': f"Bearer {common.BENCH_TOKEN}"}
+            start = time.time()
+            for n in range(args.jobs):
+                url = nodes[n % len(nodes)][1]
+                session.post(url + "/transcription/", headers=headers,
+                             json=common.stub_request()).raise_for_status()
+            submitted = time.time()
+
+            killed = None
+            while time.time() - start < args.timeout:
+                if args.kill_after and killed is None and time.time() - submitted >= args.kill_after:
+                    nodes[-1][0].send_signal(signal.SIGKILL)
+                    killed = time.time()
+                states = job_states(db)
+                if states['finished'] == args.jobs:
+                    break
+                time.sleep(0.1)
+            elapsed = time.time() - start
+        finally:
+            for p, _ in nodes:
+                p.send_signal(signal.SIGTERM)
+            for p, _ in nodes:
+                try:
+                    p.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    p.kill()
+
+        per_node = Counter()
+        runs: dict[int, list[float]] = {}
+        for i in range(args.nodes):
+            path = Path(tmpdir, f"node{i}", "starts")
+            if not path.exists():
+                continue
+            for line in path.read_text().splitlines():
+                id, when = line.split()
+                per_node[f"node{i}"] += 1
+                runs.setdefault(int(id), []).append(float(when))
+
+    print(f"{args.nodes} nodes x {args.slots} slots, {args.jobs} jobs of {args.delay}s, "
+          f"lease {args.lease}s, heartbeat {args.heartbeat}s")
+    print(f"finished {states['finished']} of {args.jobs} in {elapsed:.2f}s "
+          f"({states['finished'] / elapsed:.1f} jobs/s), states: {dict(states)}")
+    print("jobs started by node: " + ", ".join(f"{k}={v}" for k, v in sorted(per_node.items())))
+    duplicates = sorted(id for id, starts in runs.items() if len(starts) > 1)
+    print(f"jobs started more than once: {len(duplicates)} {duplicates[:20]}")
+    if killed:
+        restarts = [max(runs[id]) - killed for id in duplicates]
+        print(f"killed node{args.nodes - 1} {killed - submitted:.2f}s after submitting")
+        print(common.summarize("kill to restart of its jobs", restarts, 1, "s"))
+
+
+if __name__ == "__main__":
+    main()
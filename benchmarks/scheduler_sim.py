@@ -0,0 +1,171 @@
+#!/bin/env python3
+"""Simulate the scheduling policies and time how long they take to pick jobs.
+
+The simulation runs each policy against a queue in memory, with simulated
+time, so days of queueing take a few seconds.  The default workload is the
+one that hurts under strict priority:
+* hog submits 5000 NORMAL jobs all at once
+* alice submits a NORMAL job every couple of minutes for a day
+* carol submits an URGENT job every hour or so
+* bob submits 50 BATCH jobs at the start
+Jobs take an exponentially distributed time to run, and the wait time of
+each owner's jobs is reported for each policy.
+
+The second part fills a real database with queued jobs and times one pick
+of the dispatcher's lookahead with each policy, which shouldn't grow much
+with the size of the queue.
+"""
+import argparse
+import heapq
+import random
+import tempfile
+import time
+from collections import deque
+from pathlib import Path
+from sqlmodel import SQLModel, Session, create_engine
+import common
+from config_model import Scheduler
+from job_model import TranscriptionJob, TranscriptionState, TranscriptionPriority
+from scheduling import QueueView, QueuedJob, DatabaseQueue, POLICIES
+
+
+class MemoryQueue(QueueView):
+    """The queued jobs by owner and priority, oldest first"""
+    def __init__(self):
+        self.queues: dict[tuple[str, int], deque[QueuedJob]] = {}
+
+
+    def add(self, job: QueuedJob):
+        self.queues.setdefault((job.owner, job.priority), deque()).append(job)
+
+
+    def remove(self, job: QueuedJob):
+        queue = self.queues[(job.owner, job.priority)]
+        queue.remove(job)
+        if not queue:
+            del self.queues[(job.owner, job.priority)]
+
+
+    def front(self, limit: int) -> list[QueuedJob]:
+        jobs = [job for queue in self.queues.values() for job in list(queue)[:limit]]
+        return sorted(jobs, key=lambda j: (-j.priority, j.queue_time))[:limit]
+
+
+    def owners(self) -> list[str]:
+        return sorted({owner for owner, _ in self.queues})
+
+
+    def oldest(self, owners: list[str] | None, limit: int) -> list[QueuedJob]:
+        if owners is None:
+            jobs = []
+            for priority in {p for _, p in self.queues}:
+                jobs.extend(sorted((job for (_, p), queue in self.queues.items() if p == priority
+                                    for job in list(queue)[:limit]),
+                                   key=lambda j: j.queue_time)[:limit])
+            return jobs
+        return [job for owner in owners for (o, _), queue in self.queues.items() if o == owner
+                for job in list(queue)[:limit]]
+
+
+def workload(hours: float, rng: random.Random) -> list[QueuedJob]:
+    """The jobs, in the order they're submitted"""
+    jobs = []
+    def submit(owner, priority, when):
+        jobs.append(QueuedJob(len(jobs) + 1, 'whisper.cpp', owner, priority, when))
+    for _ in range(5000):
+        submit('hog', TranscriptionPriority.NORMAL, 0.0)
+    for _ in range(50):
+        submit('bob', TranscriptionPriority.BATCH, 0.0)
+    when = 0.0
+    while when < hours * 3600:
+        submit('alice', TranscriptionPriority.NORMAL, when)
+        when += rng.expovariate(1 / 120)
+    when = 0.0
+    while when < hours * 3600:
+        submit('carol', TranscriptionPriority.URGENT, when)
+        when += rng.expovariate(1 / 3600)
+    return sorted(jobs, key=lambda j: j.queue_time)
+
+
+def simulate(policy, jobs: list[QueuedJob], slots: int, runtime: float, rng: random.Random) -> dict[str, list[float]]:
+    """Run the jobs through the policy and return each owner's wait times"""
+    queue = MemoryQueue()
+    arrivals = deque(jobs)
+    finishes = []
+    waits: dict[str, list[float]] = {}
+    now = 0.0
+    while arrivals or finishes or queue.queues:
+        # move to the next arrival or finish
+        next_arrival = arrivals[0].queue_time if arrivals else float('inf')
+        next_finish = finishes[0] if finishes else float('inf')
+        now = min(next_arrival, next_finish)
+        while arrivals and arrivals[0].queue_time <= now:
+            queue.add(arrivals.popleft())
+        while finishes and finishes[0] <= now:
+            heapq.heappop(finishes)
+        free = slots - len(finishes)
+        if free > 0 and queue.queues:
+            for job in policy.order(queue, free, now):
+                queue.remove(job)
+                policy.started(job, now)
+                waits.setdefault(job.owner, []).append(now - job.queue_time)
+                heapq.heappush(finishes, now + rng.expovariate(1 / runtime))
+    return waits
+
+
+def fill_database(path: Path, rows: int, owners: int, rng: random.Random):
+    """A database with rows queued jobs, most of them one owner's, and as
+       many finished ones"""
+    engine = create_engine("sqlite:///" + str(path))
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        batch = []
+        for i in range(2 * rows):
+            owner = 'hog' if rng.random() < 0.8 else f"user{rng.randrange(owners)}"
+            state = TranscriptionState.QUEUED if i < rows else TranscriptionState.FINISHED
+            batch.append({'owner': owner, 'engine': 'whisper.cpp', 'state': state.name,
+                          'message': '', 'request': '{}', 'queue_time': float(i),
+                          'priority': rng.choice(list(TranscriptionPriority)).value})
+        session.execute(TranscriptionJob.__table__.insert(), batch)
+        session.commit()
+    return engine
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--slots", type=int, default=8, help="Jobs which can run at the same time")
+    parser.add_argument("--runtime", type=float, default=300.0, help="Mean job run time in seconds")
+    parser.add_argument("--hours", type=float, default=24.0, help="How long alice and carol keep submitting")
+    parser.add_argument("--aging", type=float, default=3600.0, help="Aging interval in seconds (0 = off)")
+    parser.add_argument("--rows", default="1000,10000,100000", help="Queued rows for the pick timing")
+    parser.add_argument("--lookahead", type=int, default=100, help="Jobs the dispatcher asks for")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    jobs = workload(args.hours, random.Random(args.seed))
+    print(f"{len(jobs)} jobs, {args.slots} slots, {args.runtime}s mean run time, aging every {args.aging}s")
+    for name, policy_class in POLICIES.items():
+        config = Scheduler(policy=name, aging_interval=args.aging)
+        waits = simulate(policy_class(config), jobs, args.slots, args.runtime, random.Random(args.seed))
+        print(f"{name}:")
+        for owner in sorted(waits):
+            print("  " + common.summarize(f"{owner} wait", waits[owner], 1 / 3600, "h"))
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for rows in [int(x) for x in args.rows.split(",")]:
+            engine = fill_database(Path(tmpdir, f"queue-{rows}.db"), rows, 20, rng)
+            for name, policy_class in POLICIES.items():
+                policy = policy_class(Scheduler(policy=name, aging_interval=args.aging))
+                times = []
+                with Session(engine) as session:
+                    for _ in range(20):
+                        start = time.perf_counter()
+                        policy.order(DatabaseQueue(session), args.lookahead, float(rows))
+                        times.append(time.perf_counter() - start)
+                print(common.summarize(f"{rows} queued, {name} pick of {args.lookahead}", times))
+            engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
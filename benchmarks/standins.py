@@ -0,0 +1,125 @@
+"""Local stand-ins for the external services the server talks to, so the
+benchmarks can see how it behaves when they're slow or broken."""
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # the default backlog of 5 resets connections under load
+    request_queue_size = 128
+
+
+class WebhookStandIn:
+    """A notification endpoint which takes delay seconds to answer each PUT
+       and fails (with a 503) fail_rate of the time.  The time of every
+       successful delivery is recorded by the job id in the payload."""
+    def __init__(self, delay: float = 0.0, fail_rate: float = 0.0):
+        self.delay = delay
+        self.fail_rate = fail_rate
+        self.requests = 0
+        self.failures = 0
+        self.delivered: dict[int, float] = {}
+        self.lock = threading.Lock()
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_PUT(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                time.sleep(standin.delay)
+                with standin.lock:
+                    standin.requests += 1
+                    failed = random.random() < standin.fail_rate
+                    if failed:
+                        standin.failures += 1
+                    else:
+                        standin.delivered.setdefault(json.loads(body)['id'], time.time())
+                self.send_response(503 if failed else 200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = StandInServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/notify"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class S3StandIn:
+    """A bucket for the job inputs and outputs.  A GET returns the object
+       that was added (or PUT) at that path and a PUT stores the body, after
+       delay seconds either way.  The requests and bytes in each direction
+       are counted."""
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.objects: dict[str, bytes] = {}
+        self.gets = 0
+        self.puts = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.lock = threading.Lock()
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                time.sleep(standin.delay)
+                with standin.lock:
+                    body = standin.objects.get(self.path)
+                    if body is not None:
+                        standin.gets += 1
+                        standin.bytes_out += len(body)
+                if body is None:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_PUT(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                time.sleep(standin.delay)
+                with standin.lock:
+                    standin.objects[self.path] = body
+                    standin.puts += 1
+                    standin.bytes_in += len(body)
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = StandInServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def add(self, path: str, body: bytes) -> str:
+        """Put an object in the bucket and return its URL"""
+        with self.lock:
+            self.objects[path] = body
+        return self.url + path
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
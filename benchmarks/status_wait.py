@@ -0,0 +1,86 @@
+#!/bin/env python3
+"""Hold a lot of clients waiting on jobs and see what it costs.
+
+--waiters clients wait on --jobs jobs, either with the long-poll `wait`
+parameter or with the event stream.  While they're all waiting, plain status
+requests are timed, and when the jobs finish the time for the news to reach
+each waiter is measured.
+"""
+import argparse
+import asyncio
+import tempfile
+import threading
+import time
+from pathlib import Path
+import httpx
+import common
+from engines.registry import engine_registry
+
+
+async def raw_get(port: int, path: str, headers: dict) -> bytes:
+    """A bare-bones HTTP GET so the client side doesn't dominate with this
+       many connections.  Returns everything the server sent."""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    lines = [f"GET {path} HTTP/1.1", "Host: 127.0.0.1", "Connection: close"]
+    lines += [f"{k}: {v}" for k, v in headers.items()]
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode())
+    await writer.drain()
+    data = await reader.read()
+    writer.close()
+    return data
+
+
+async def wait_for_jobs(server, ids: list[int], waiters: int, mode: str, release: threading.Event,
+                        finished: dict, results: dict):
+    async def waiter(n: int):
+        id = ids[n % len(ids)]
+        if mode == 'poll':
+            path = f"/transcription/{id}?wait=120"
+        else:
+            path = f"/transcription/{id}/events"
+        data = await raw_get(server.port, path, server.headers)
+        if b'"finished"' not in data:
+            results['errors'] += 1
+        results['latency'].append(time.time() - finished[id])
+
+    tasks = [asyncio.create_task(waiter(n)) for n in range(waiters)]
+    # let them all get settled in before timing the other requests
+    await asyncio.sleep(2)
+    async with httpx.AsyncClient(base_url=server.url, headers=server.headers) as client:
+        for _ in range(50):
+            start = time.time()
+            (await client.get("/transcription/", params={'limit': 10})).raise_for_status()
+            results['status'].append(time.time() - start)
+    release.set()
+    await asyncio.gather(*tasks)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--waiters", type=int, default=1000, help="Number of waiting clients")
+    parser.add_argument("--jobs", type=int, default=10, help="Number of jobs they wait on")
+    parser.add_argument("--mode", choices=['poll', 'events'], default='poll', help="Long-poll or event stream")
+    args = parser.parse_args()
+
+    release = threading.Event()
+    finished = {}
+    def on_start(job):
+        release.wait()
+        finished[job.id] = time.time()
+
+    engine_registry.processors['whisper.cpp'] = common.stub_processor(0, on_start)
+    results = {'status': [], 'latency': [], 'errors': 0}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = common.make_config(Path(tmpdir), workers={'cpu': 8 * args.jobs})
+        with common.BenchServer(config) as server:
+            ids = [httpx.post(server.url + "/transcription/", headers=server.headers,
+                              json=common.stub_request()).json()['id'] for _ in range(args.jobs)]
+            asyncio.run(wait_for_jobs(server, ids, args.waiters, args.mode, release, finished, results))
+
+    print(common.summarize(f"list with {args.waiters} waiting", results['status']))
+    print(common.summarize(f"finish-to-{args.mode}", results['latency']))
+    print(f"{results['errors']} waiters didn't see the job finish")
+
+
+if __name__ == "__main__":
+    main()
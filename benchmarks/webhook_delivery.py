@@ -0,0 +1,66 @@
+#!/bin/env python3
+"""Measure url notification delivery against a slow or flaky endpoint.
+
+Jobs with url notification are run with a stub engine while the webhook
+stand-in takes --webhook-delay seconds to answer and fails --fail-rate of
+the requests.  A slow endpoint shouldn't hold up the jobs behind it, so the
+queue-to-start latency is reported along with how long it took for each
+notification to get through.
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+import requests
+import common
+import standins
+import rest_server
+from engines.registry import engine_registry
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=50, help="Number of jobs")
+    parser.add_argument("--delay", type=float, default=0.01, help="Stub inference time in seconds")
+    parser.add_argument("--webhook-delay", type=float, default=1.0, help="Seconds the webhook takes to answer")
+    parser.add_argument("--fail-rate", type=float, default=0.2, help="Fraction of webhook requests which fail")
+    parser.add_argument("--timeout", type=float, default=120, help="Seconds to wait for all of the notifications")
+    args = parser.parse_args()
+
+    starts = []
+    finishes = {}
+    def on_start(job):
+        starts.append(time.time() - job.queue_time)
+        finishes[job.id] = time.time() + args.delay
+
+    engine_registry.processors['whisper.cpp'] = common.stub_processor(args.delay, on_start)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = common.make_config(Path(tmpdir),
+                                    notifications={'backoff_base': 0.2, 'backoff_max': 2.0,
+                                                   'breaker_cooldown': 1.0})
+        with standins.WebhookStandIn(args.webhook_delay, args.fail_rate) as webhook:
+            with common.BenchServer(config) as server:
+                session = requests.Session()
+                begin = time.time()
+                for _ in range(args.jobs):
+                    session.post(server.url + "/transcription/",
+                                 headers=server.headers,
+                                 json=common.stub_request(notification_type='url',
+                                                          notification_url=webhook.url)).raise_for_status()
+                while len(starts) < args.jobs and time.time() - begin < args.timeout:
+                    time.sleep(0.05)
+                jobs_done = time.time() - begin
+                while len(webhook.delivered) < args.jobs and time.time() - begin < args.timeout:
+                    time.sleep(0.05)
+                notifier = rest_server.notifier.stats()
+
+    delivery = [webhook.delivered[id] - finishes[id] for id in webhook.delivered if id in finishes]
+    print(f"all jobs started after {jobs_done:.2f}s")
+    print(common.summarize("queue-to-start", starts))
+    print(common.summarize("finish-to-notified", delivery, scale=1, unit="s"))
+    print(f"webhook requests={webhook.requests} failures={webhook.failures} "
+          f"delivered={len(webhook.delivered)}/{args.jobs} notifier={notifier}")
+
+
+if __name__ == "__main__":
+    main()
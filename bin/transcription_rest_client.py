@@ -2,11 +2,19 @@
 
 import argparse
 from os import environ
+from pathlib import Path
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 import requests
 import json
+import time
+import threading
 import boto3
 from botocore.config import Config
 
+TERMINAL_STATES = ('finished', 'canceled', 'error', 'expired')
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -14,8 +22,16 @@ def main():
     subparsers = parser.add_subparsers(dest="action", required=True)
     
     list_parser = subparsers.add_parser("list", help="List all jobs in the service")
+    list_parser.add_argument("--state", choices=['queued', 'running', 'canceled', 'finished', 'error', 'expired'],
+                             help="Only list jobs in this state")
+    list_parser.add_argument("--priority", type=int, choices=[0, 1, 2], help="Only list jobs with this priority")
+    list_parser.add_argument("--owner", help="Only list jobs for this owner (admin only)")
     
-    purge_parser = subparsers.add_parser("purge", help="Purge any jobs where the client never finalized it")
+    purge_parser = subparsers.add_parser("purge", help="Purge any jobs where the client never finalized it (admin only)")
+    purge_parser.add_argument("--state", action="append", choices=['canceled', 'finished', 'error', 'expired'],
+                              help="Only purge jobs in this state (can be given more than once)")
+    purge_parser.add_argument("--owner", help="Only purge jobs for this owner")
+    purge_parser.add_argument("--older-than", type=float, default=0, help="Only purge jobs which finished at least this many seconds ago")
 
     info_parser = subparsers.add_parser("info", help="Information about a job")    
     info_parser.add_argument("id", type=int, help="Job ID")
@@ -62,6 +78,24 @@ def main():
     for fmt in ('json', 'vtt', 'txt', 'csv', 'meta'):
         submit.add_argument(f"--{fmt}", type=str, help=f"object name for {fmt} output")
 
+    bulk = subparsers.add_parser("bulk", help="Submit all of the jobs in a JSONL manifest")
+    bulk.add_argument("s3_endpoint", type=str, help="S3 server endpoint")
+    bulk.add_argument("manifest", type=Path, 
+                      help="JSONL file with one job per line: input_bucket, input_object, outputs (format to object name) and optionally key, output_bucket, engine, model, language, and priority")
+    bulk.add_argument("results", type=Path, 
+                      help="JSONL file to record the job ids in.  Jobs already in it are skipped, so an interrupted run can be resumed")
+    bulk.add_argument("--engine", default="whisper.cpp", choices=["whisper.cpp", "openai-whisper"], help="Default engine")
+    bulk.add_argument("--model", default="small.en", help="Default model")
+    bulk.add_argument("--language", default="en", choices=['auto', 'en', 'es', 'fr', 'de'], help="Default language")
+    bulk.add_argument('--priority', default=1, type=int, choices=[0, 1, 2], help="Default job priority")
+    bulk.add_argument("--output_bucket", type=str, default=None, help="Default bucket for the output files (if different than input bucket)")
+    bulk.add_argument("--concurrency", type=int, default=8, help="Number of batches to prepare and submit at once")
+    bulk.add_argument("--batch", type=int, default=100, help="Number of jobs per submission")
+
+    watch = subparsers.add_parser("watch", help="Wait for all of the jobs from a bulk submission to finish")
+    watch.add_argument("results", type=Path, help="JSONL results file from bulk")
+    watch.add_argument("--interval", type=float, default=10, help="Seconds between checks")
+
     lock = subparsers.add_parser("lock", help="Lock/Unlock the submission queue")
     lock.add_argument("state", choices=["on", "off"], help="Turn on/off the submission queue lock")
 
@@ -73,7 +107,7 @@ def main():
         print("You must set the TRANSCRIPTION_TOKEN environment variable")
         exit(1)
 
-    if args.action in ('whisper', 'whispercpp'):
+    if args.action in ('whisper', 'whispercpp', 'bulk'):
         # we need to have S3_ACCESS_KEY and S3_SECRET_KEY environment
         # variables to talk to S3
         args.access_key = environ.get('S3_ACCESS_KEY', None)
@@ -89,26 +123,41 @@ def main():
         'delete': delete_job,
         'whisper': whisper,
         'whispercpp': whisper_cpp,
+        'bulk': bulk_submit,
+        'watch': watch_jobs,
         'lock': manage_lock}[args.action](args)
     except Exception as e:
         print(f"Error: {e}")    
 
 
 def list_jobs(args):
-    r = requests.get(args.endpoint + "/transcription/",
-                     headers={'Authorization': f'Bearer {args.token}'})
-    r.raise_for_status()
-    dump_json(r.json())
+    # follow the cursor until we've gotten all of the pages
+    params = {k: v for k, v in (('state', args.state), ('priority', args.priority),
+                                ('owner', args.owner)) if v is not None}
+    jobs = []
+    while True:
+        r = requests.get(args.endpoint + "/transcription/",
+                         params=params,
+                         headers={'Authorization': f'Bearer {args.token}'})
+        r.raise_for_status()
+        jobs.extend(r.json())
+        if 'X-Next-Cursor' not in r.headers:
+            break
+        params['after'] = r.headers['X-Next-Cursor']
+    dump_json(jobs)
 
 
 def purge_jobs(args):
-    r = requests.get(args.endpoint + "/transcription/",
-                     headers={'Authorization': f"Bearer {args.token}"})
-    for j in r.json():
-         r = requests.get(args.endpoint + f"/transcription/{j['id']}",
-                     headers={'Authorization': f"Bearer {args.token}"})   
-
-    print("Extraneous rows should be purged")
+    purge = {'older_than': args.older_than}
+    if args.state:
+        purge['states'] = args.state
+    if args.owner:
+        purge['owner'] = args.owner
+    r = requests.post(args.endpoint + "/transcription/purge",
+                      headers={'Authorization': f"Bearer {args.token}"},
+                      json=purge)
+    r.raise_for_status()
+    dump_json(r.json())
 
 
 def job_info(args):    
@@ -195,6 +244,116 @@ def submit_job(args, options):
     dump_json(r.json())
 
 
+def bulk_submit(args):
+    "Submit everything in the manifest which isn't already in the results"
+    done = set()
+    if args.results.exists():
+        for l in args.results.read_text().splitlines():
+            if l.strip():
+                result = json.loads(l)
+                if result.get('id') is not None:
+                    done.add(result['key'])
+    items = []
+    with open(args.manifest) as f:
+        for l in f:
+            if not l.strip():
+                continue
+            item = json.loads(l)
+            item.setdefault('key', item['input_object'])
+            if item['key'] not in done:
+                items.append(item)
+    print(f"Submitting {len(items)} jobs, {len(done)} were already submitted")
+
+    # one connection pool for all of the submissions
+    session = requests.Session()
+    session.mount(args.endpoint, HTTPAdapter(pool_connections=args.concurrency, 
+                                             pool_maxsize=args.concurrency))
+    session.headers['Authorization'] = f'Bearer {args.token}'
+
+    def submit_batch(batch):
+        try:
+            reqs = [bulk_request(args, item) for item in batch]
+            r = session.post(args.endpoint + "/transcription/batch", json=reqs)
+            r.raise_for_status()
+            return [{'key': item['key'], 'id': result['id'], 'error': result['error']}
+                    for item, result in zip(batch, r.json())]
+        except Exception as e:
+            return [{'key': item['key'], 'id': None, 'error': str(e)} for item in batch]
+
+    batches = [items[i:i + args.batch] for i in range(0, len(items), args.batch)]
+    submitted = failed = 0
+    with open(args.results, "a") as out, ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for results in pool.map(submit_batch, batches):
+            for result in results:
+                out.write(json.dumps(result) + "\n")
+                if result['id'] is None:
+                    failed += 1
+                else:
+                    submitted += 1
+            out.flush()
+            print(f"{submitted} submitted, {failed} failed")
+
+
+def bulk_request(args, item):
+    "Build the transcription request for a manifest item"
+    options = {'engine': item.get('engine', args.engine),
+               'language': item.get('language', args.language),
+               'model': item.get('model', args.model)}
+    input_object = item['input_object']
+    if input_object.startswith('http://') or input_object.startswith('https://'):
+        options['input'] = input_object
+    else:
+        options['input'] = gen_presigned(args.access_key, args.secret_key,
+                                         args.s3_endpoint, 'get', item['input_bucket'],
+                                         input_object, 7*24*3600-1)
+    output_bucket = item.get('output_bucket', args.output_bucket) or item['input_bucket']
+    options['outputs'] = {}
+    for fmt, out_obj in item['outputs'].items():
+        if out_obj.startswith('http://') or out_obj.startswith('https://'):
+            options['outputs'][f"{fmt}_url"] = out_obj
+        else:
+            options['outputs'][f"{fmt}_url"] = gen_presigned(args.access_key, args.secret_key,
+                                                             args.s3_endpoint, 'put', output_bucket,
+                                                             out_obj, 7*24*3600-1)
+    return {'version': '1',
+            'priority': item.get('priority', args.priority),
+            'options': options}
+
+
+def watch_jobs(args):
+    "Check on the jobs in a bulk results file until they're all done"
+    ids = set()
+    for l in args.results.read_text().splitlines():
+        if l.strip():
+            result = json.loads(l)
+            if result.get('id') is not None:
+                ids.add(result['id'])
+    session = requests.Session()
+    session.headers['Authorization'] = f'Bearer {args.token}'
+    pending = sorted(ids)
+    counts = {}
+    while pending:
+        still_pending = []
+        for i in range(0, len(pending), 1000):
+            chunk = pending[i:i + 1000]
+            r = session.get(args.endpoint + "/transcription/status",
+                            params={'ids': ",".join(str(x) for x in chunk)})
+            r.raise_for_status()
+            found = {j['id']: j for j in r.json()}
+            for id in chunk:
+                if id not in found:
+                    # it's been removed, so it's as done as it's going to get
+                    counts['gone'] = counts.get('gone', 0) + 1
+                elif found[id]['state'] in TERMINAL_STATES:
+                    counts[found[id]['state']] = counts.get(found[id]['state'], 0) + 1
+                else:
+                    still_pending.append(id)
+        pending = still_pending
+        print(f"{len(pending)} of {len(ids)} pending: {json.dumps(counts, sort_keys=True)}")
+        if pending:
+            time.sleep(args.interval)
+
+
 def manage_lock(args):
     "Turn on/off the job queue lock"
     if args.state == "on":
@@ -208,16 +367,32 @@ def dump_json(data):
     print(json.dumps(data, indent=2, sort_keys=True))
 
 
+# the bulk submissions presign from several threads.  A boto3 client can
+# be shared between threads but creating one isn't thread safe.
+s3_client_lock = threading.Lock()
+
+
+def get_s3_client(access_key, secret_key, endpointurl):
+    "The client is the expensive part of presigning so only make one"
+    with s3_client_lock:
+        return make_s3_client(access_key, secret_key, endpointurl)
+
+
+@lru_cache
+def make_s3_client(access_key, secret_key, endpointurl):
+    return boto3.client('s3',
+                        endpoint_url=endpointurl,
+                        use_ssl=endpointurl.startswith("https:"),
+                        aws_access_key_id=access_key,
+                        aws_secret_access_key=secret_key,
+                        region_name="us-east-1",
+                        config=Config(s3={'addressing_style': 'path'},
+                                      signature_version='s3v4')
+                        )
+
+
 def gen_presigned(access_key, secret_key, endpointurl, method, bucket, object, expires):
-    s3_client = boto3.client('s3',
-                             endpoint_url=endpointurl,
-                             use_ssl=endpointurl.startswith("https:"),
-                             aws_access_key_id=access_key,
-                             aws_secret_access_key=secret_key,
-                             region_name="us-east-1",
-                             config=Config(s3={'addressing_style': 'path'},
-                                           signature_version='s3v4')
-                             )
+    s3_client = get_s3_client(access_key, secret_key, endpointurl)
     return s3_client.generate_presigned_url(f'{method}_object', 
                                            Params={'Bucket': bucket, 
                                                    'Key': object},
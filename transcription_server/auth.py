@@ -0,0 +1,71 @@
+"""Check bearer tokens against the users file"""
+import hashlib
+import os
+import time
+import threading
+import logging
+
+
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class CredentialStore:
+    """An in-memory index of the users file, which is reloaded when the
+       file changes.  Each line of the file is is_admin:user:token, where the
+       token can be given as sha256:<hex digest> rather than in the clear.
+       Only the token hashes are kept in memory."""
+    def __init__(self, users_file: str, check_interval: float = 1.0):
+        self.users_file = users_file
+        self.check_interval = check_interval
+        self.index: dict[str, tuple[str, bool]] = {}
+        self.signature = None
+        self.last_check = 0
+        self.lock = threading.Lock()
+
+
+    def lookup(self, credential: str) -> tuple[str, bool] | None:
+        """Return the user and whether they're an admin for a user:token
+           credential, or None if it's not valid"""
+        self.refresh()
+        user, _, token = credential.partition(':')
+        return self.index.get(f"{user}:{hash_token(token)}", None)
+
+
+    def refresh(self):
+        """Reload the file if it has changed, but don't look more often
+           than the check interval"""
+        now = time.time()
+        if now - self.last_check < self.check_interval:
+            return
+        with self.lock:
+            if now - self.last_check < self.check_interval:
+                return
+            self.last_check = now
+            try:
+                st = os.stat(self.users_file)
+                signature = (st.st_mtime_ns, st.st_size, st.st_ino)
+                if signature != self.signature:
+                    self.index = self.load()
+                    self.signature = signature
+            except Exception as e:
+                logging.warning(f"Cannot read credentials file: {e}.  Will deny access")
+                self.index = {}
+                self.signature = None
+
+
+    def load(self) -> dict[str, tuple[str, bool]]:
+        index = {}
+        with open(self.users_file) as f:
+            for l in f.readlines():
+                l = l.strip()
+                if not l or l.startswith('#'):
+                    continue
+                is_admin, user, token = l.split(':', 2)
+                if token.startswith('sha256:'):
+                    token_hash = token[7:].lower()
+                else:
+                    token_hash = hash_token(token)
+                index[f"{user}:{token_hash}"] = (user, is_admin.lower()[0] == 'y')
+        logging.info(f"Loaded {len(index)} credentials from {self.users_file}")
+        return index
@@ -0,0 +1,91 @@
+"""Let a running job know it has been canceled"""
+import threading
+from contextlib import contextmanager
+
+
+class CancelToken:
+    """Set when a job is canceled.  An engine can check it, wait on it, or
+       register a callback to stop whatever it's running."""
+    def __init__(self):
+        self.event = threading.Event()
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+
+    @property
+    def cancelled(self) -> bool:
+        return self.event.is_set()
+
+
+    def cancel(self):
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+    def wait(self, timeout: float = None) -> bool:
+        return self.event.wait(timeout)
+
+
+    def on_cancel(self, callback):
+        """Call callback when the job is canceled, or right away if it
+           already has been"""
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback()
+
+
+    def discard(self, callback):
+        """Forget a callback.  Once this returns it won't be called unless
+           it already has been, which cancelled will say."""
+        with self.lock:
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+
+
+class Cancellations:
+    """The tokens for the running jobs, by job id"""
+    def __init__(self):
+        self.tokens: dict[int, CancelToken] = {}
+        self.lock = threading.Lock()
+
+
+    @contextmanager
+    def track(self, job_id: int):
+        """A token for the job while it runs"""
+        token = CancelToken()
+        with self.lock:
+            self.tokens[job_id] = token
+        try:
+            yield token
+        finally:
+            with self.lock:
+                if self.tokens.get(job_id) is token:
+                    del self.tokens[job_id]
+
+
+    def token(self, job_id: int) -> CancelToken:
+        """The job's token.  A job that isn't being tracked gets one which is
+           never canceled."""
+        with self.lock:
+            return self.tokens.get(job_id) or CancelToken()
+
+
+    def cancel(self, job_id: int) -> bool:
+        """Cancel the job if it's running here"""
+        with self.lock:
+            token = self.tokens.get(job_id)
+        if token is None:
+            return False
+        token.cancel()
+        return True
+
+
+# one for the whole server
+cancellations = Cancellations()
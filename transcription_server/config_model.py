@@ -1,17 +1,26 @@
-from pydantic import BaseModel, Field, field_validator
+from pydantic import BaseModel, Field, ValidationInfo, field_validator
+from typing import Literal
 from pathlib import Path
 import sys
+import os
 
 class Server(BaseModel):
     port: int = 8000
     host: str = "0.0.0.0"
     root: str | None  = None
+    # the most jobs which can be submitted or checked in one request
+    max_batch: int = 1000
+    # the engines this server runs.  Empty means all of the registered ones,
+    # but an engine's module isn't loaded until it has a job.
+    engines: list[str] = []
 
 class Files(BaseModel):
     database: str = "var/transcription.db"
     log_dir: str = "var"
     models_dir: str = "models"
     users: str = "etc/users.txt"
+    spool_dir: str = "var/spool"
+    transcript_cache: str = "var/transcript_cache"
 
     # all of the files are to be treated relative to the service root,
     # i.e. the repo, if they are relative paths.
@@ -27,6 +36,194 @@ class Files(BaseModel):
     
     
 
+class Database(BaseModel):
+    # queries are run on this many threads so they don't hold up the
+    # event loop
+    threads: int = 4
+    # connections kept open to the database
+    pool_size: int = 8
+    # milliseconds to wait for a lock before giving up
+    busy_timeout: int = 5000
+    # write-ahead logging, so readers don't wait on a commit
+    wal: bool = True
+
+
+class Scheduler(BaseModel):
+    # the dispatcher is woken up whenever a job is submitted or finishes, so
+    # this is only how often the database cleanup and notification retries
+    # happen.
+    maintenance_interval: float = 30.0
+    # Several nodes can run jobs from one database.  A node claims a job
+    # under node_id (hostname-pid when it's empty) with a lease of
+    # lease_time seconds, which it renews every heartbeat_interval seconds
+    # while the job runs.  When a node goes away its jobs are requeued by
+    # whichever node notices the lease has run out.  A node with a fixed
+    # node_id takes its own jobs back as soon as it restarts.
+    node_id: str = ""
+    lease_time: float = 60.0
+    heartbeat_interval: float = 15.0
+    # how the next job is picked: 'priority' is strict priority and then
+    # first come first served, 'fair' lets the owners with queued jobs take
+    # turns within each priority, in proportion to their weights.  Owners
+    # who aren't in owner_weights get 1.
+    policy: str = "fair"
+    owner_weights: dict[str, float] = {}
+    # a queued job is promoted one priority level for every aging_interval
+    # seconds it waits, up to aging_max (1 is NORMAL).  0 turns aging off.
+    aging_interval: float = 3600.0
+    aging_max: int = 1
+
+    @field_validator('heartbeat_interval', mode='after')
+    @classmethod
+    def check_heartbeat(cls, value: float, info: ValidationInfo) -> float:
+        if value <= 0 or value >= info.data.get('lease_time', 60.0):
+            raise ValueError("heartbeat_interval must be positive and shorter than lease_time")
+        return value
+
+    @field_validator('owner_weights', mode='after')
+    @classmethod
+    def check_weights(cls, value: dict[str, float]) -> dict[str, float]:
+        for owner, weight in value.items():
+            if weight <= 0:
+                raise ValueError(f"The weight for {owner} must be positive")
+        return value
+
+
+class Metrics(BaseModel):
+    # serve prometheus metrics at /metrics
+    enabled: bool = True
+    # seconds between event loop lag checks
+    loop_lag_interval: float = 1.0
+
+
+class Prefetch(BaseModel):
+    # how many jobs at the front of the queue to download and decode ahead
+    # of time.  0 turns prefetching off.
+    jobs: int = 2
+    # MB of decoded audio the spool can hold
+    max_spool: int = 4096
+
+
+class ResultCache(BaseModel):
+    # keep the outputs for media we've seen before so the same media with
+    # the same engine, model, and language doesn't need to be run again.
+    enabled: bool = True
+    # MB of outputs to keep
+    max_size: int = 10240
+
+
+class Notifications(BaseModel):
+    # url notifications are delivered in the background and retried with
+    # exponential backoff (in seconds) until max_attempts is reached.
+    concurrency: int = 8
+    timeout: float = 10.0
+    max_attempts: int = 10
+    backoff_base: float = 5.0
+    backoff_max: float = 600.0
+    # after this many failures in a row a host is left alone for the
+    # cooldown (seconds)
+    breaker_threshold: int = 5
+    breaker_cooldown: float = 60.0
+    # how often the outbox is checked if nothing wakes it up
+    poll_interval: float = 30.0
+    # a node claims a notification while it sends it.  If the node goes
+    # away another one sends it once the claim (seconds) runs out.
+    claim_time: float = 120.0
+
+
+class Uploads(BaseModel):
+    # the outputs for a job are uploaded at the same time, over connections
+    # which are kept alive.  This is the total for all of the jobs.
+    concurrency: int = 8
+    timeout: float = 300.0
+    # gzip the json output (Content-Encoding: gzip) when it's at least
+    # gzip_min_size bytes.  The destination has to be ok with that.
+    gzip_json: bool = False
+    gzip_min_size: int = 1048576
+
+
+class EngineResources(BaseModel):
+    """Resources a single job on an engine will tie up while it runs"""
+    cpu: int = 1
+    memory: int = 0
+    accelerator: int = 0
+
+
+def default_engine_resources() -> dict[str, EngineResources]:
+    return {'openai-whisper': EngineResources(cpu=1, memory=0, accelerator=1),
+            'whisper.cpp': EngineResources(cpu=8, memory=0, accelerator=0)}
+
+
+class Workers(BaseModel):
+    # the total resources the jobs can use.  Memory is in MB and a value of
+    # 0 means it isn't tracked.  An accelerator is a GPU (or a slice of one)
+    cpu: int = Field(default_factory=lambda: os.cpu_count() or 1)
+    memory: int = 0
+    accelerator: int = 1
+    # the maximum number of simultaneous jobs, 0 for no limit beyond the
+    # resources.
+    max_jobs: int = 0
+    # how far down the queue to look for a job that fits in the free resources
+    lookahead: int = 100
+    engines: dict[str, EngineResources] = Field(default_factory=default_engine_resources,
+                                                description="Resources needed by each engine")
+
+
+class OpenAIWhisper(BaseModel):
+    # memory (MB) used to keep models loaded between jobs.  A model that's
+    # bigger than this is unloaded when the job is finished.  With
+    # isolation: process every worker has a cache this size.
+    model_cache: int = 8192
+    # models which are loaded at startup and are never evicted
+    preload: list[str] = []
+    # 'process' runs the jobs in worker processes, which keep their own
+    # models loaded between jobs and are killed when a job is canceled.
+    # 'thread' runs them in the server process.
+    isolation: Literal['process', 'thread'] = 'process'
+    # stop worker processes which have been idle this many seconds, 0 to
+    # keep them around
+    idle_timeout: float = 0
+
+
+class WhisperCPP(BaseModel):
+    # 'server' keeps whisper-resident processes around with the models
+    # loaded and 'cli' runs whisper-cli for every job.  Both write the same
+    # outputs.
+    backend: Literal['server', 'cli'] = 'server'
+    # seconds an unused whisper-resident process is kept running
+    idle_timeout: float = 600.0
+    # seconds to wait for a new whisper-resident process to load its model
+    startup_timeout: float = 300.0
+    # a job is killed if it runs longer than deadline_base seconds plus the
+    # media length times the factor for its model, which is matched by the
+    # longest prefix of the model name.  A deadline_base of 0 turns this off.
+    deadline_base: float = 300.0
+    deadline_factors: dict[str, float] = {'tiny': 0.5, 'base': 0.75, 'small': 1.5, 'medium': 3.0,
+                                          'large-v3-turbo': 2.0, 'large': 6.0}
+
+    def deadline(self, model: str, media_length: float) -> float:
+        """Seconds a job on the model with this much media can run, 0 for
+           no limit"""
+        if self.deadline_base <= 0:
+            return 0.0
+        matches = [k for k in self.deadline_factors if model.startswith(k)]
+        if matches:
+            factor = self.deadline_factors[max(matches, key=len)]
+        else:
+            factor = max(self.deadline_factors.values(), default=0.0)
+        return self.deadline_base + factor * media_length
+
+
 class ServerConfig(BaseModel):
     server: Server = Field(default_factory=Server, description="Server configuration")
     files: Files = Field(default_factory=Files, description="File locations")
+    database: Database = Field(default_factory=Database, description="Database configuration")
+    scheduler: Scheduler = Field(default_factory=Scheduler, description="Job scheduler configuration")
+    notifications: Notifications = Field(default_factory=Notifications, description="URL notification delivery configuration")
+    workers: Workers = Field(default_factory=Workers, description="Worker pool configuration")
+    metrics: Metrics = Field(default_factory=Metrics, description="Metrics configuration")
+    prefetch: Prefetch = Field(default_factory=Prefetch, description="Media prefetch configuration")
+    transcript_cache: ResultCache = Field(default_factory=ResultCache, description="Transcript cache configuration")
+    uploads: Uploads = Field(default_factory=Uploads, description="Output upload configuration")
+    openai_whisper: OpenAIWhisper = Field(default_factory=OpenAIWhisper, description="openai-whisper engine configuration")
+    whispercpp: WhisperCPP = Field(default_factory=WhisperCPP, description="whisper.cpp engine configuration")
@@ -0,0 +1,104 @@
+"""Database access which doesn't hold up the event loop"""
+import asyncio
+import logging
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import event, literal, Connection
+from sqlmodel import SQLModel, Session, create_engine
+from config_model import Database
+
+engine = None
+executor: ThreadPoolExecutor = None
+
+
+def open_database(config: Database, database_file: str):
+    """Create the engine and the tables, and the threads which will run the
+       queries."""
+    global engine, executor
+    # the timeout is sqlite3's busy timeout, in seconds
+    engine = create_engine("sqlite:///" + database_file,
+                           connect_args={'check_same_thread': False,
+                                         'timeout': config.busy_timeout / 1000},
+                           pool_size=config.pool_size,
+                           max_overflow=0)
+
+    @event.listens_for(engine, "connect")
+    def configure_connection(dbapi_connection, connection_record):
+        # WAL lets the readers carry on while something is committing.
+        cursor = dbapi_connection.cursor()
+        if config.wal:
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={int(config.busy_timeout)}")
+        cursor.close()
+
+    SQLModel.metadata.create_all(engine)
+    with engine.begin() as connection:
+        migrate(connection)
+    executor = ThreadPoolExecutor(max_workers=config.threads, thread_name_prefix="db")
+    logging.info(f"Opened {database_file} with {config.threads} database threads")
+    return engine
+
+
+# fill in a column that was added to an existing table from what the rows
+# already have.  Without these, old queued jobs would never match an engine
+# and old finished ones would never expire.
+BACKFILLS = {
+    ('transcriptionjob', 'engine'):
+        "UPDATE transcriptionjob SET engine = coalesce(json_extract(request, '$.options.engine'), '')",
+    ('transcriptionjob', 'notification_type'):
+        "UPDATE transcriptionjob SET notification_type = coalesce(json_extract(request, '$.notification_type'), 'poll')",
+    ('transcriptionjob', 'expire_at'):
+        "UPDATE transcriptionjob SET expire_at = finish_time + coalesce(json_extract(request, '$.expiration'), 3600.0) "
+        "WHERE state IN ('FINISHED', 'ERROR', 'EXPIRED')",
+}
+
+
+# indexes older versions made which nothing uses anymore
+OBSOLETE_INDEXES = ['ix_transcriptionjob_owner', 'ix_transcriptionjob_engine',
+                    'ix_transcriptionjob_worker_id', 'ix_transcriptionjob_state_owner']
+
+
+def migrate(connection: Connection):
+    """Bring the tables from an older version up to date.  create_all only
+       makes the tables which don't exist, so any columns and indexes added
+       since then are added here, with their defaults, and backfilled if
+       need be.  Columns are never removed or changed."""
+    for table in SQLModel.metadata.sorted_tables:
+        existing = {row[1] for row in connection.exec_driver_sql(f"PRAGMA table_info({table.name})")}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(connection.dialect)}"
+            default = column.default.arg if column.default is not None and not callable(column.default.arg) else None
+            # SQLite can only add a NOT NULL column if it has a default
+            if default is not None:
+                value = literal(default, column.type).compile(dialect=connection.dialect,
+                                                              compile_kwargs={'literal_binds': True})
+                ddl += f" DEFAULT {value}" + ("" if column.nullable else " NOT NULL")
+            logging.info(f"Adding column {column.name} to {table.name}")
+            connection.exec_driver_sql(ddl)
+            if (table.name, column.name) in BACKFILLS:
+                connection.exec_driver_sql(BACKFILLS[(table.name, column.name)])
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+    for name in OBSOLETE_INDEXES:
+        connection.exec_driver_sql(f"DROP INDEX IF EXISTS {name}")
+
+
+def close_database():
+    executor.shutdown(wait=True)
+    engine.dispose()
+
+
+def with_session(fn, *args):
+    """Call fn(session, *args) with a new session.  Objects stay usable after
+       the commit since they'll be read on the other side of the executor."""
+    with Session(engine, expire_on_commit=False) as session:
+        return fn(session, *args)
+
+
+async def run_db(fn, *args):
+    """Run fn(session, *args) on the database threads"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, partial(with_session, fn, *args))
@@ -0,0 +1,166 @@
+"""Get the input media into the form the engines want"""
+import subprocess
+import threading
+import logging
+import wave
+import json
+import hashlib
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import requests
+
+SAMPLE_RATE = 16000
+
+
+class MediaExpired(Exception):
+    """The media URL was denied, so the presigned URL has likely expired"""
+
+
+class MediaAborted(Exception):
+    """Somebody didn't want the media any more"""
+
+
+class DecodedMedia:
+    """16kHz mono audio, either as samples or in a wav file"""
+    def __init__(self, samples=None, wav_file: str = None,
+                 input_bytes: int = 0, duration: float = 0.0, digest: str = None):
+        self.samples = samples
+        self.wav_file = wav_file
+        self.input_bytes = input_bytes
+        self.duration = duration
+        # sha256 of the original media
+        self.digest = digest
+
+
+def ffmpeg_command(source: str, wav_file: str = None) -> list[str]:
+    """Decode the source to 16kHz mono 16-bit PCM, either raw on stdout or
+       into a wav file"""
+    cmd = ['ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error',
+           '-i', source, '-vn', '-ac', '1', '-ar', str(SAMPLE_RATE), '-c:a', 'pcm_s16le']
+    if wav_file:
+        return cmd + ['-y', wav_file]
+    return cmd + ['-f', 's16le', 'pipe:1']
+
+
+def open_url(url: str) -> requests.Response:
+    r = requests.get(url=url, stream=True)
+    if r.status_code == 403:
+        # it was denied.  Just assume the presigned URL has expired.
+        r.close()
+        raise MediaExpired("The Presigned URL has likely expired")
+    r.raise_for_status()
+    return r
+
+
+def decode_media(url: str, wav_file: str = None, chunk_size: int = 65536,
+                 abort: threading.Event = None) -> DecodedMedia:
+    """Stream the media at url straight into ffmpeg and get 16kHz mono audio
+       back.  If wav_file is given the audio is written there, otherwise the
+       samples are returned as a float32 numpy array.  Setting abort stops
+       the download."""
+    with open_url(url) as r:
+        p = subprocess.Popen(ffmpeg_command('pipe:0', wav_file),
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        counts = {'bytes': 0}
+        hasher = hashlib.sha256()
+        def feed():
+            try:
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    if abort and abort.is_set():
+                        raise MediaAborted("Media download was aborted")
+                    p.stdin.write(chunk)
+                    hasher.update(chunk)
+                    counts['bytes'] += len(chunk)
+            except BrokenPipeError:
+                # ffmpeg gave up on the input, its exit code will tell us why.
+                pass
+            except Exception as e:
+                counts['error'] = e
+            finally:
+                try:
+                    p.stdin.close()
+                except BrokenPipeError:
+                    pass
+        errors = []
+        feeder = threading.Thread(target=feed, daemon=True)
+        stderr = threading.Thread(target=lambda: errors.append(p.stderr.read()), daemon=True)
+        feeder.start()
+        stderr.start()
+        pcm = p.stdout.read()
+        p.wait()
+        feeder.join()
+        stderr.join()
+
+    if 'error' in counts:
+        raise counts['error']
+    if p.returncode != 0:
+        # some containers (mp4 with the index at the end, for one) can't be
+        # decoded from a pipe, so fall back to decoding a downloaded copy.
+        logging.warning(f"Cannot decode streamed media, falling back to a download: {b''.join(errors).decode(errors='replace').strip()}")
+        return decode_downloaded(url, wav_file, chunk_size)
+    return finish_decode(pcm, wav_file, counts['bytes'], hasher.hexdigest())
+
+
+def decode_downloaded(url: str, wav_file: str = None, chunk_size: int = 65536) -> DecodedMedia:
+    """Download the media to a temporary file and decode that"""
+    with TemporaryDirectory() as tmpdir:
+        input_bytes = 0
+        hasher = hashlib.sha256()
+        with open_url(url) as r:
+            with open(tmpdir + "/input_audio.dat", 'wb') as f:
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+                    hasher.update(chunk)
+                    input_bytes += len(chunk)
+        p = subprocess.run(ffmpeg_command(tmpdir + "/input_audio.dat", wav_file),
+                           stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                           stderr=subprocess.PIPE)
+        if p.returncode != 0:
+            raise Exception(f"Cannot decode media: {p.stderr.decode(errors='replace').strip()}")
+        return finish_decode(p.stdout, wav_file, input_bytes, hasher.hexdigest())
+
+
+def load_wav(wav_file: str, input_bytes: int = 0, as_samples: bool = True,
+             digest: str = None) -> DecodedMedia:
+    """Load audio that's already been decoded to a 16kHz mono wav"""
+    if not as_samples:
+        return finish_decode(None, wav_file, input_bytes, digest)
+    with wave.open(wav_file, 'rb') as w:
+        pcm = w.readframes(w.getnframes())
+    return finish_decode(pcm, None, input_bytes, digest)
+
+
+def spool_entry(spool_dir: str, job_id: int) -> Path | None:
+    """The prefetched wav for the job, if it's ready.  The metadata is
+       written last so it marks a complete entry."""
+    entry = Path(spool_dir, str(job_id))
+    if Path(entry, "media.json").exists():
+        return entry
+    return None
+
+
+def fetch_media(job_id: int, url: str, spool_dir: str, wav_file: str = None) -> DecodedMedia:
+    """Get the decoded media for a job, using the prefetched copy if there is
+       one.  If wav_file is given the audio will be in a wav file (which may
+       not be wav_file), otherwise it will be samples."""
+    entry = spool_entry(spool_dir, job_id)
+    if entry:
+        logging.info(f"Using prefetched media for job {job_id}")
+        meta = json.loads(Path(entry, "media.json").read_text())
+        return load_wav(str(Path(entry, "input_audio.wav")), meta['input_bytes'], wav_file is None,
+                        meta.get('digest', None))
+    return decode_media(url, wav_file)
+
+
+def finish_decode(pcm: bytes, wav_file: str, input_bytes: int, digest: str = None) -> DecodedMedia:
+    if wav_file:
+        with wave.open(wav_file, 'rb') as w:
+            duration = w.getnframes() / SAMPLE_RATE
+        return DecodedMedia(wav_file=wav_file, input_bytes=input_bytes, duration=duration,
+                            digest=digest)
+    import numpy as np
+    # this is the same conversion that whisper.load_audio does.
+    samples = np.frombuffer(pcm, np.int16).flatten().astype(np.float32) / 32768.0
+    return DecodedMedia(samples=samples, input_bytes=input_bytes,
+                        duration=len(samples) / SAMPLE_RATE, digest=digest)
@@ -0,0 +1,120 @@
+"""Keep loaded models resident between jobs"""
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+import logging
+
+
+def model_size(model) -> int:
+    """The number of bytes of parameters and buffers in a torch module"""
+    size = 0
+    for t in list(model.parameters()) + list(model.buffers()):
+        size += t.numel() * t.element_size()
+    return size
+
+
+class CachedModel:
+    """A loaded model and the bookkeeping to go with it"""
+    def __init__(self, model, size: int, unload):
+        self.model = model
+        self.size = size
+        self.unload = unload
+        self.users = 0
+        # models aren't safe to use from more than one job at once.
+        self.lock = threading.Lock()
+
+
+class ModelCache:
+    """A least-recently-used cache of models, limited by the memory they take.
+       Models are keyed by whatever the caller wants -- usually the model 
+       name and the device it's loaded on."""
+    def __init__(self, budget: int = 0):
+        self.budget = budget
+        self.pinned = set()
+        self.entries: OrderedDict[tuple, CachedModel] = OrderedDict()
+        self.lock = threading.Lock()
+        self.loading: dict[tuple, threading.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def configure(self, budget: int, pinned: set[tuple] = None):
+        """Set the memory budget (in bytes) and the keys that are never evicted"""
+        with self.lock:
+            self.budget = budget
+            self.pinned = set(pinned or ())
+            self._evict()
+
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'models': len(self.entries),
+                    'bytes': sum(x.size for x in self.entries.values()),
+                    'budget': self.budget}
+
+
+    def loaded(self) -> list[tuple]:
+        """The keys of the models in the cache"""
+        with self.lock:
+            return list(self.entries)
+
+
+    @contextmanager
+    def lease(self, key: tuple, loader, unload=None):
+        """Get the model for key, loading it if needed, and hold it until
+           the context exits"""
+        entry = self._get(key)
+        if entry is None:
+            # only one thread gets to load any given model
+            with self.lock:
+                key_lock = self.loading.setdefault(key, threading.Lock())
+            with key_lock:
+                entry = self._get(key)
+                if entry is None:
+                    model = loader()
+                    entry = CachedModel(model, model_size(model), unload)
+                    with self.lock:
+                        self.misses += 1
+                        self.entries[key] = entry
+                        entry.users += 1
+                    logging.info(f"Loaded model {key} ({entry.size / 1048576:0.1f}MB)")
+        try:
+            with entry.lock:
+                yield entry.model
+        finally:
+            with self.lock:
+                entry.users -= 1
+                self._evict()
+
+
+    def _get(self, key: tuple) -> CachedModel | None:
+        """Look for a model in the cache and mark it as in use"""
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is not None:
+                self.hits += 1
+                entry.users += 1
+                self.entries.move_to_end(key)
+            return entry
+
+
+    def _evict(self):
+        """Remove idle models, oldest first, until we're under budget.  This
+           needs to be called with the lock held."""
+        total = sum(x.size for x in self.entries.values())
+        for key in list(self.entries.keys()):
+            if total <= self.budget:
+                break
+            entry = self.entries[key]
+            if entry.users > 0 or key in self.pinned:
+                continue
+            del self.entries[key]
+            total -= entry.size
+            self.evictions += 1
+            logging.info(f"Evicting model {key} from the cache")
+            if entry.unload:
+                entry.unload(entry.model)
@@ -0,0 +1,175 @@
+"""The transcription engines the server knows about.
+
+Each engine has an options model, which is small and is imported up front
+so requests can be validated, and a module which does the actual work.  The
+work module can pull in a lot (openai-whisper brings torch along) so it
+isn't imported until a job needs it.
+
+Besides the built-in engines, other packages can provide an engine with an
+entry point in the 'transcription_server.engines' group which refers to an
+EngineSpec.
+"""
+import threading
+import logging
+import importlib
+from importlib.metadata import entry_points
+from types import ModuleType
+from typing import Callable
+from pydantic import BaseModel
+from .whisper_model import WhisperOptions
+from .whispercpp_model import WhisperCPPOptions
+
+ENTRY_POINT_GROUP = "transcription_server.engines"
+
+
+class EngineSpec:
+    """How to find the pieces of an engine.  The hooks are (dotted) names of
+       things in the engine's module:
+       * process(job, config) - run a job
+       * preload(config) - called at startup when wants_preload(config)
+       * maintenance(config) - called periodically once the engine is loaded
+       * shutdown() - called when the server stops, if the engine was loaded
+       * stats - {metric prefix: (name of a function returning a dict, the
+         keys which are counters)}"""
+    def __init__(self, name: str, options: type[BaseModel], module: str, process: str,
+                 preload: str = None, wants_preload: Callable = None,
+                 maintenance: str = None, shutdown: str = None,
+                 stats: dict[str, tuple[str, set[str]]] = None):
+        self.name = name
+        self.options = options
+        self.module = module
+        self.process = process
+        self.preload = preload
+        self.wants_preload = wants_preload or (lambda config: False)
+        self.maintenance = maintenance
+        self.shutdown = shutdown
+        self.stats = stats or {}
+
+
+BUILTIN_ENGINES = [EngineSpec('openai-whisper', WhisperOptions, 'engines.whisper_workers', 'process_whisper',
+                              preload='preload_models',
+                              wants_preload=lambda config: bool(config.openai_whisper.preload),
+                              maintenance='reap_idle_workers',
+                              shutdown='worker_pool.shutdown',
+                              stats={'transcription_model_cache': ('model_cache_stats',
+                                                                   {'hits', 'misses', 'evictions'}),
+                                     'transcription_whisper_workers': ('worker_pool.stats',
+                                                                       {'crashes', 'kills'})}),
+                   EngineSpec('whisper.cpp', WhisperCPPOptions, 'engines.whispercpp_process', 'process_whispercpp',
+                              maintenance='reap_idle_servers',
+                              shutdown='server_pool.shutdown',
+                              stats={'transcription_whisper_servers': ('server_pool.stats', set())})]
+
+
+class EngineRegistry:
+    """The registered engines, and the modules of the ones that have been
+       used"""
+    def __init__(self, specs: list[EngineSpec]):
+        self.specs: dict[str, EngineSpec] = {}
+        for spec in specs:
+            self.register(spec)
+        # the engines this server runs.  None is all of them.
+        self.enabled: set[str] | None = None
+        self.modules: dict[str, ModuleType] = {}
+        # the process function for each engine, filled in the first time
+        # it's needed.  The benchmarks put their stub engines in here.
+        self.processors: dict[str, Callable] = {}
+        self.lock = threading.Lock()
+
+
+    def register(self, spec: EngineSpec):
+        if spec.name in self.specs:
+            logging.warning(f"Engine {spec.name} is already registered, replacing it")
+        self.specs[spec.name] = spec
+
+
+    def load_entry_points(self):
+        """Add the engines other packages provide"""
+        for ep in entry_points(group=ENTRY_POINT_GROUP):
+            try:
+                self.register(ep.load())
+            except Exception as e:
+                logging.exception(f"Cannot load engine entry point {ep.name}: {e}")
+
+
+    def names(self) -> list[str]:
+        return list(self.specs)
+
+
+    def options_models(self) -> tuple[type[BaseModel], ...]:
+        return tuple(spec.options for spec in self.specs.values())
+
+
+    def enable(self, names: list[str]):
+        """Only run these engines.  An empty list means all of them."""
+        unknown = set(names) - set(self.specs)
+        if unknown:
+            raise ValueError(f"Unknown engines: {', '.join(sorted(unknown))}")
+        self.enabled = set(names) if names else None
+
+
+    def is_enabled(self, name: str) -> bool:
+        return name in self.specs and (self.enabled is None or name in self.enabled)
+
+
+    def enabled_names(self) -> list[str]:
+        """The engines this server runs"""
+        return [name for name in self.specs if self.is_enabled(name)]
+
+
+    def module(self, name: str) -> ModuleType:
+        """Import the engine's module, if it hasn't been already"""
+        with self.lock:
+            if name not in self.modules:
+                logging.info(f"Loading engine {name} from {self.specs[name].module}")
+                self.modules[name] = importlib.import_module(self.specs[name].module)
+            return self.modules[name]
+
+
+    def hook(self, name: str, attr: str):
+        thing = self.module(name)
+        for part in attr.split('.'):
+            thing = getattr(thing, part)
+        return thing
+
+
+    def processor(self, name: str) -> Callable | None:
+        """The function which runs jobs for the engine, or None if it isn't
+           available here"""
+        if not self.is_enabled(name):
+            return None
+        if name not in self.processors:
+            self.processors[name] = self.hook(name, self.specs[name].process)
+        return self.processors[name]
+
+
+    def preload(self, config):
+        for name, spec in self.specs.items():
+            if spec.preload and self.is_enabled(name) and spec.wants_preload(config):
+                self.hook(name, spec.preload)(config)
+
+
+    def maintenance(self, config):
+        for name in list(self.modules):
+            if self.specs[name].maintenance:
+                self.hook(name, self.specs[name].maintenance)(config)
+
+
+    def shutdown(self):
+        for name in list(self.modules):
+            if self.specs[name].shutdown:
+                self.hook(name, self.specs[name].shutdown)()
+
+
+    def stats(self) -> list[tuple[str, Callable, set[str]]]:
+        """(prefix, stats function, counters) for each engine's stats.  An
+           engine which hasn't been loaded doesn't have any."""
+        def lazy(name, attr):
+            return lambda: self.hook(name, attr)() if name in self.modules else {}
+        return [(prefix, lazy(name, attr), counters)
+                for name, spec in self.specs.items()
+                for prefix, (attr, counters) in spec.stats.items()]
+
+
+engine_registry = EngineRegistry(BUILTIN_ENGINES)
+engine_registry.load_entry_points()
@@ -0,0 +1,120 @@
+"""Run engine child processes so they can be stopped when their job is
+canceled or runs too long, and account for the CPU time they burn"""
+import os
+import signal
+import threading
+import subprocess
+import logging
+from cancellation import CancelToken
+
+
+class ChildFailed(Exception):
+    """A child process was killed or failed.  reason is 'canceled',
+       'deadline', or 'failed' and cpu_time is how many CPU seconds it
+       used, which went to waste."""
+    def __init__(self, message: str, reason: str, cpu_time: float = 0.0):
+        super().__init__(message)
+        self.reason = reason
+        self.cpu_time = cpu_time
+
+
+class Watchdog:
+    """Call kill if the job is canceled or the deadline (seconds from now)
+       passes while the context is active.  reason says which happened."""
+    def __init__(self, token: CancelToken, deadline: float, kill):
+        self.token = token
+        self.deadline = deadline
+        self.kill = kill
+        self.reason = None
+        self.lock = threading.Lock()
+        self.active = False
+        self.timer = None
+
+
+    def fire(self, reason: str):
+        with self.lock:
+            if not self.active or self.reason:
+                return
+            self.reason = reason
+            self.kill()
+
+
+    def canceled(self):
+        self.fire('canceled')
+
+
+    def __enter__(self):
+        self.active = True
+        if self.deadline > 0:
+            self.timer = threading.Timer(self.deadline, self.fire, args=('deadline',))
+            self.timer.daemon = True
+            self.timer.start()
+        self.token.on_cancel(self.canceled)
+        return self
+
+
+    def __exit__(self, *exc):
+        # once this returns kill won't be called
+        with self.lock:
+            self.active = False
+        self.token.discard(self.canceled)
+        if self.timer:
+            self.timer.cancel()
+
+
+def kill_group(pid: int):
+    """Kill a process and anything it started"""
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def cpu_seconds(pid: int) -> float:
+    """User and system CPU time used so far by a running process and the
+       children it has waited for.  Zero if it can't be read."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # the command name is in parentheses and can have spaces
+            fields = f.read().rsplit(')', 1)[1].split()
+        # utime, stime, cutime, cstime are fields 14-17, counting from the pid
+        ticks = sum(int(x) for x in fields[11:15])
+        return ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+class ProcessResult:
+    def __init__(self, returncode: int, output: str, cpu_time: float):
+        self.returncode = returncode
+        self.output = output
+        self.cpu_time = cpu_time
+
+
+def run_process(cmd: list[str], token: CancelToken, deadline: float) -> ProcessResult:
+    """Run cmd in its own process group and collect its output.  The whole
+       group is killed if the job is canceled or the deadline passes, which
+       raises ChildFailed."""
+    p = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT, encoding='utf-8',
+                         start_new_session=True)
+    output = []
+    reader = threading.Thread(target=lambda: output.append(p.stdout.read()), daemon=True)
+    reader.start()
+    with Watchdog(token, deadline, lambda: kill_group(p.pid)) as watchdog:
+        # wait for it to exit without reaping it, so the pid (and the group)
+        # can't be reused before the watchdog is done with it.
+        os.waitid(os.P_PID, p.pid, os.WEXITED | os.WNOWAIT)
+    # anything it left running in the group is an orphan now
+    kill_group(p.pid)
+    _, status, usage = os.wait4(p.pid, 0)
+    p.returncode = os.waitstatus_to_exitcode(status)
+    reader.join()
+    p.stdout.close()
+    cpu_time = usage.ru_utime + usage.ru_stime
+    if watchdog.reason == 'canceled':
+        raise ChildFailed(f"{cmd[0]} was stopped because the job was canceled", 'canceled', cpu_time)
+    if watchdog.reason == 'deadline':
+        raise ChildFailed(f"{cmd[0]} was stopped after running for {deadline:.0f} seconds", 'deadline', cpu_time)
+    logging.debug(f"{cmd[0]} used {cpu_time:.1f} CPU seconds")
+    return ProcessResult(p.returncode, ''.join(output), cpu_time)
@@ -0,0 +1,32 @@
+"""Keep track of where the time goes while a job is processed"""
+import time
+import json
+from contextlib import contextmanager
+
+
+class StageTimer:
+    """The wall time and bytes moved for each stage of a job.  A stage can
+       be entered more than once and the times add up."""
+    def __init__(self):
+        self.stages: dict[str, dict] = {}
+
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time the body.  The stage's entry is yielded so the bytes can be
+           filled in."""
+        entry = self.stages.setdefault(name, {'seconds': 0.0, 'bytes': 0})
+        start = time.perf_counter()
+        try:
+            yield entry
+        finally:
+            entry['seconds'] += time.perf_counter() - start
+
+
+    def seconds(self, name: str) -> float:
+        return self.stages.get(name, {}).get('seconds', 0.0)
+
+
+    def to_json(self) -> str:
+        return json.dumps({k: {'seconds': round(v['seconds'], 4), 'bytes': v['bytes']}
+                           for k, v in self.stages.items()})
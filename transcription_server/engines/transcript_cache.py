@@ -0,0 +1,128 @@
+"""Keep the transcripts for media we've already seen so resubmissions don't
+need to be transcribed again"""
+import hashlib
+import json
+import shutil
+import os
+import logging
+import threading
+from pathlib import Path
+from tempfile import mkdtemp
+
+# a sweep evicts down to this fraction of the budget, so a full cache isn't
+# swept again on the very next store
+LOW_WATER = 0.9
+
+
+class TranscriptCache:
+    """Transcript outputs on disk, keyed by the media hash and the options
+       which affect the transcript.  The least recently used entries are
+       removed when the cache is over budget.
+
+       The size of the cache is kept as a running total, and the directory
+       is only walked when that goes over budget.  The total only counts
+       what this process has stored since the last walk, so with several
+       processes storing into the cache it can go over budget until one of
+       them walks it."""
+    def __init__(self, cache_dir: str, budget: int):
+        self.cache_dir = Path(cache_dir)
+        self.budget = budget
+        # None until the first walk
+        self.total: int | None = None
+        self.lock = threading.Lock()
+
+
+    @staticmethod
+    def key(digest: str, engine: str, model: str, language: str, variant: str = "") -> str:
+        """The key for the outputs.  variant is anything else about the way
+           the engine is run which changes the outputs, such as the
+           whisper.cpp backend."""
+        parts = [digest, engine, model, language] + ([variant] if variant else [])
+        return hashlib.sha256("|".join(parts).encode()).hexdigest()
+
+
+    def entry_path(self, key: str) -> Path:
+        return Path(self.cache_dir, key[:2], key)
+
+
+    def lookup(self, key: str) -> tuple[Path, dict] | None:
+        """Find the entry for key and return the directory and metadata"""
+        entry = self.entry_path(key)
+        try:
+            meta = json.loads(Path(entry, "meta.json").read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+        # the modification time is the LRU order
+        try:
+            os.utime(entry)
+        except FileNotFoundError:
+            # it was evicted after we read it
+            return None
+        return entry, meta
+
+
+    def store(self, key: str, files: dict[str, Path], meta: dict):
+        """Copy the output files (by format) into the cache"""
+        entry = self.entry_path(key)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        # build it on the side and move it into place so a reader never sees
+        # a partial entry.
+        staging = Path(mkdtemp(dir=entry.parent, prefix=".staging-"))
+        try:
+            for fmt, src in files.items():
+                shutil.copyfile(src, Path(staging, f"output.{fmt}"))
+            Path(staging, "meta.json").write_text(json.dumps(meta))
+            size = sum(f.stat().st_size for f in staging.iterdir())
+            try:
+                staging.rename(entry)
+            except OSError:
+                # someone else beat us to it
+                size = 0
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        with self.lock:
+            if self.total is not None:
+                self.total += size
+            if self.total is None or self.total > self.budget:
+                self.total = self.evict()
+
+
+    def evict(self) -> int:
+        """Remove the oldest entries until we're under the low water mark,
+           and return the size of what's left"""
+        entries = []
+        total = 0
+        for entry in self.cache_dir.glob("*/*"):
+            if entry.name.startswith("."):
+                continue
+            try:
+                size = sum(f.stat().st_size for f in entry.iterdir())
+                entries.append((entry.stat().st_mtime, size, entry))
+            except FileNotFoundError:
+                # it was evicted out from under us
+                continue
+            total += size
+        entries.sort()
+        if total > self.budget:
+            while total > self.budget * LOW_WATER and entries:
+                _, size, entry = entries.pop(0)
+                logging.info(f"Evicting {entry.name} from the transcript cache")
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
+        return total
+
+
+# one cache object per directory, so they all share the running total
+_caches: dict[str, TranscriptCache] = {}
+_lock = threading.Lock()
+
+
+def open_cache(config) -> TranscriptCache | None:
+    """The transcript cache, if it's enabled"""
+    if not config.transcript_cache.enabled:
+        return None
+    with _lock:
+        cache = _caches.setdefault(config.files.transcript_cache,
+                                   TranscriptCache(config.files.transcript_cache, 0))
+        cache.budget = config.transcript_cache.max_size * 1048576
+        return cache
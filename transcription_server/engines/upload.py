@@ -0,0 +1,137 @@
+"""Send the outputs to their destinations"""
+import gzip
+import os
+import shutil
+import time
+import threading
+import logging
+from pathlib import Path
+from tempfile import mkstemp
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from config_model import Uploads
+from metrics import upload_bytes, upload_failures
+
+
+class UploadExpired(Exception):
+    """An output URL was denied, so the presigned URL has likely expired"""
+
+
+# all of the uploads share one session (and its connection pool) so the
+# connections to the storage service are kept alive between outputs and jobs.
+_session: requests.Session = None
+_pool: ThreadPoolExecutor = None
+_lock = threading.Lock()
+
+COUNTERS = {'bytes': upload_bytes, 'failures': upload_failures}
+# a worker process can't export metrics, so it holds on to its counts and
+# hands them to the server with each job's result instead
+_held: dict[tuple[str, str], int] | None = None
+
+
+def count(name: str, fmt: str, n: int = 1):
+    """Add to one of the upload counters"""
+    with _lock:
+        if _held is None:
+            COUNTERS[name].labels(fmt).inc(n)
+        else:
+            _held[(name, fmt)] = _held.get((name, fmt), 0) + n
+
+
+def hold_counts():
+    """Keep the counts for take_counts() rather than exporting them"""
+    global _held
+    with _lock:
+        _held = {}
+
+
+def take_counts() -> list[tuple[str, str, int]]:
+    """The counts held since the last call, as (counter, format, n)"""
+    with _lock:
+        counts = [(name, fmt, n) for (name, fmt), n in (_held or {}).items()]
+        if _held:
+            _held.clear()
+    return counts
+
+
+def upload_session(config: Uploads) -> tuple[requests.Session, ThreadPoolExecutor]:
+    """The shared session and the threads to run the uploads on"""
+    global _session, _pool
+    with _lock:
+        if _session is None:
+            adapter = HTTPAdapter(pool_connections=config.concurrency,
+                                  pool_maxsize=config.concurrency)
+            _session = requests.Session()
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+            _pool = ThreadPoolExecutor(max_workers=config.concurrency,
+                                       thread_name_prefix="upload")
+        return _session, _pool
+
+
+def upload_file(fmt: str, url: str, file: Path, config: Uploads) -> dict:
+    """PUT one output, streaming it from disk.  Large json files are gzipped
+       first if that's turned on."""
+    session, _ = upload_session(config)
+    size = file.stat().st_size
+    headers = {}
+    body = file
+    if config.gzip_json and fmt == 'json' and size >= config.gzip_min_size:
+        # the file may be in the transcript cache, so compress it elsewhere
+        fd, body = mkstemp(suffix=f".{fmt}.gz")
+        body = Path(body)
+        with open(file, 'rb') as src, os.fdopen(fd, 'wb') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6) as dst:
+                shutil.copyfileobj(src, dst, 1048576)
+        headers['Content-Encoding'] = 'gzip'
+    start = time.time()
+    try:
+        with open(body, 'rb') as f:
+            r = session.put(url, data=f, headers=headers, timeout=config.timeout)
+    finally:
+        if body != file:
+            body.unlink(missing_ok=True)
+    if not r.ok:
+        count('failures', fmt)
+    if r.status_code == 403:
+        raise UploadExpired(f"Expired URL when uploading {fmt} to {url}")
+    r.raise_for_status()
+    count('bytes', fmt, int(r.request.headers.get('Content-Length', size)))
+    return {'bytes': size,
+            'sent_bytes': int(r.request.headers.get('Content-Length', size)),
+            'encoding': headers.get('Content-Encoding', 'identity'),
+            'seconds': round(time.time() - start, 4)}
+
+
+def upload_outputs(outputs, outdir: Path, formats: list[str], config: Uploads) -> dict[str, dict]:
+    """Upload every requested format at the same time and return the stats
+       for each one.  outputs is the engine's outputs model, with a
+       {fmt}_url field for each format."""
+    _, pool = upload_session(config)
+    futures = {}
+    for fmt in formats:
+        url = getattr(outputs, f"{fmt}_url", None)
+        if url:
+            futures[fmt] = pool.submit(upload_file, fmt, str(url), Path(outdir, f"output.{fmt}"), config)
+    stats = {}
+    errors = []
+    for fmt, future in futures.items():
+        try:
+            stats[fmt] = future.result()
+            logging.debug(f"Uploaded {fmt}: {stats[fmt]}")
+        except Exception as e:
+            errors.append(e)
+    # an expired url trumps anything else that went wrong
+    for e in sorted(errors, key=lambda e: not isinstance(e, UploadExpired)):
+        raise e
+    return stats
+
+
+def upload_meta(url, payload: str, config: Uploads):
+    """Write the job metadata.  Failing isn't a big deal."""
+    session, _ = upload_session(config)
+    try:
+        session.put(str(url), data=payload, timeout=config.timeout)
+    except Exception as e:
+        logging.warning(f"Cannot write metadata to {url}: {e}")
@@ -1,86 +1,153 @@
 """Process a whisper transcript request"""
 import time
-import requests
 from tempfile import TemporaryDirectory
 import whisper
 from job_model import TranscriptionJob, TranscriptionState
 from .whisper_model import WhisperOptions
+from .model_cache import ModelCache
+from .media import fetch_media, MediaExpired
+from .transcript_cache import open_cache
+from .upload import upload_outputs, upload_meta, UploadExpired
+from .timing import StageTimer
+from events import job_events
 import json
-import sys
-from io import StringIO
+from pathlib import Path
 from whisper.utils import WriteJSON, WriteTXT, WriteVTT
 from whisper.transcribe import transcribe
-import subprocess
 from config_model import ServerConfig
 import logging
+from contextlib import contextmanager, ExitStack
 import torch
 
+# models stay loaded between jobs, as long as they fit in the budget.
+model_cache = ModelCache()
+
+
+def get_device() -> str:
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def configure_model_cache(config: ServerConfig):
+    """Apply the cache settings from the configuration"""
+    device = get_device()
+    model_cache.configure(config.openai_whisper.model_cache * 1048576,
+                          {(m, device) for m in config.openai_whisper.preload})
+
+
+def unload_model(model):
+    """Free up the memory for a model that's been evicted"""
+    del model.encoder
+    del model.decoder
+    torch.cuda.empty_cache()
+
+
+@contextmanager
+def cached_model(name: str, config: ServerConfig):
+    """Borrow a model from the cache, loading it if needed"""
+    device = get_device()
+    loader = lambda: whisper.load_model(name, download_root=config.files.models_dir + "/openai-whisper",
+                                        device=device)
+    with model_cache.lease((name, device), loader, unload_model) as model:
+        yield model
+
+
+def preload_models(config: ServerConfig):
+    """Load the pinned models so the first job doesn't have to wait"""
+    configure_model_cache(config)
+    for name in config.openai_whisper.preload:
+        with cached_model(name, config):
+            pass
+
+
 def process_whisper(job: TranscriptionJob, config: ServerConfig):
     """The heavy lifting.  This actually runs a whisper job based on
        the parameters."""
-    # we're in a separate thread from the rest of the asyncio stuff, which
-    # means we're not going to bog down the web interface.  Maybe.  It may
-    # still need to be pushed into a different process, we'll see.    
-    model = None
+    # this normally runs in one of the worker processes (whisper_workers.py)
+    # so it doesn't compete with the web interface for the GIL.  With
+    # openai_whisper.isolation set to thread it's in a thread in the server.
+    timer = StageTimer()
     try:        
         # Get our original request from the job
         req = WhisperOptions(**json.loads(job.request)['options'])
         with TemporaryDirectory() as tmpdir:
-            # download the file
-            with requests.get(url=req.input, stream=True) as r:
-                if r.status_code == 403:
-                    # it was denied.  Just assume the presigned URL has
-                    # expired.
-                    job.state = TranscriptionState.EXPIRED
-                    job.message = "The Presigned URL has likely expired"
-                    return                    
-                r.raise_for_status()                    
-                with open(tmpdir + "/input_audio.dat", 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=65536):
-                        f.write(chunk)
-
-
-            # convert the file to wave.
-            p = subprocess.run(['ffmpeg', '-i', tmpdir + "/input_audio.dat",
-                            tmpdir + "/input_audio.wav"], stderr=subprocess.STDOUT,
-                            stdout=subprocess.PIPE, check=True)
-
-            # load the model
-            #model = whisper.load_model(req.model, download_root=sys.path[0] + "/models/openai-whisper")
-            logging.debug(f"Cuda is {'available' if torch.cuda.is_available() else 'not available'}.")
-            model = whisper.load_model(req.model, download_root=config.files.models_dir + "/openai-whisper",
-                                       device="cuda" if torch.cuda.is_available() else "cpu")
-
-            # prep and load the file
-            audio = whisper.load_audio(tmpdir + "/input_audio.dat", 16000)
-            job.media_length = len(audio) / 16000
-            start = time.time()
-            lang = str(req.language)
-            result = transcribe(model, audio, 
-                                language=lang if lang != 'auto' else None,
-                                word_timestamps=True)
-            job.processing_time = time.time() - start
-            job.language_used = req.language
-            # produce the outputs and write them to the destinations
-            for fmt, url, cls, opts in (('json', req.outputs.json_url, WriteJSON, {}),
-                                        ('vtt', req.outputs.vtt_url, WriteVTT, {}),
-                                        ('txt', req.outputs.txt_url, WriteTXT, {})):
-                if url:
-                    f = StringIO()
-                    c = cls('/tmp')   
-                    c.write_result(result, f, opts)                     
-                    r = requests.put(url, data=f.getvalue(),)
-                    if r.status_code == 403:
-                        job.state = TranscriptionState.EXPIRED
-                        job.message = f"Expired URL when uploading {fmt} to {url}"
-                    r.raise_for_status()
-            
+            # stream the input straight through ffmpeg into memory, unless
+            # it's already been prefetched
+            try:
+                with timer.stage('media') as stage:
+                    media = fetch_media(job.id, req.input, config.files.spool_dir)
+                    stage['bytes'] = media.input_bytes
+            except MediaExpired as e:
+                job.state = TranscriptionState.EXPIRED
+                job.message = str(e)
+                return
+            audio = media.samples
+            job.media_length = media.duration
+
+            # if we've transcribed this media with these options before we
+            # can just send the old outputs.
+            cache = open_cache(config)
+            key = None
+            if cache and media.digest:
+                key = cache.key(media.digest, 'openai-whisper', str(req.model), str(req.language))
+            job_events.publish(job.id, job.state, "Media is ready", 0.1)
+            with timer.stage('cache'):
+                cached = cache.lookup(key) if key else None
+            if cached:
+                outdir, meta = cached
+                logging.info(f"Job {job.id} found in the transcript cache")
+                job.cache_hit = True
+                job.language_used = meta['language_used']
+            else:
+                # get the model from the cache (or load it) and transcribe
+                logging.debug(f"Cuda is {'available' if torch.cuda.is_available() else 'not available'}.")
+                configure_model_cache(config)
+                with ExitStack() as stack:
+                    # this includes waiting for another job to finish with
+                    # the model
+                    with timer.stage('model_load'):
+                        model = stack.enter_context(cached_model(str(req.model), config))
+                    start = time.time()
+                    lang = str(req.language)
+                    with timer.stage('inference'):
+                        result = transcribe(model, audio, 
+                                            language=lang if lang != 'auto' else None,
+                                            word_timestamps=True)
+                    job.processing_time = time.time() - start
+                logging.debug(f"Model cache: {model_cache.stats()}")
+                job.language_used = req.language
+
+                # produce all of the outputs so they can be cached
+                outdir = Path(tmpdir)
+                outputs = {}
+                with timer.stage('outputs'):
+                    for fmt, cls in (('json', WriteJSON), ('vtt', WriteVTT), ('txt', WriteTXT)):
+                        outputs[fmt] = Path(outdir, f"output.{fmt}")
+                        with open(outputs[fmt], "w", encoding="utf-8") as f:
+                            cls(tmpdir).write_result(result, f, {})
+                if key:
+                    with timer.stage('cache'):
+                        cache.store(key, outputs, {'language_used': job.language_used,
+                                                   'media_length': job.media_length})
+
+            # write the outputs to the destinations
+            job_events.publish(job.id, job.state, "Uploading outputs", 0.9)
+            try:
+                with timer.stage('upload') as stage:
+                    stats = upload_outputs(req.outputs, outdir, ['json', 'vtt', 'txt'], config.uploads)
+                    stage['bytes'] = sum(x['sent_bytes'] for x in stats.values())
+            except UploadExpired as e:
+                job.state = TranscriptionState.EXPIRED
+                job.message = str(e)
+                return
+            job.upload_stats = json.dumps(stats)
+
             job.state = TranscriptionState.FINISHED
             job.message = "Transcription has completed successfully"    
 
             if req.outputs.meta_url:
                 # try to write the metadata out.  I don't really care if it fails.
-                r = requests.put(req.outputs.meta_url, data=job.model_dump_json())
+                job.stage_timings = timer.to_json()
+                upload_meta(req.outputs.meta_url, job.model_dump_json(), config.uploads)
 
     except Exception as e:
         job.state = TranscriptionState.ERROR
@@ -88,8 +155,6 @@ def process_whisper(job: TranscriptionJob, config: ServerConfig):
         logging.exception(f"Transcription Exception for job {job}: {e}")
 
     finally:
-        if model:
-            del model.encoder
-            del model.decoder
-            model = None
+        job.stage_timings = timer.to_json()
+        # the model stays around, but the intermediate buffers can go.
         torch.cuda.empty_cache()
@@ -0,0 +1,330 @@
+"""Run openai-whisper jobs in worker processes.
+
+In a thread the transcription competes with the API for the GIL, and a
+thread can't be stopped when its job is canceled.  Each worker is a spawned
+process which runs one job at a time and has its own model cache, so the
+models stay loaded between jobs.  Canceling a job kills its worker (which
+frees the model memory with it) and a worker which dies only takes its own
+job down.
+
+This module is what the engine registry loads for openai-whisper, so it
+must not import whisper or torch itself -- only the workers do that.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import multiprocessing
+from multiprocessing.connection import Connection
+from config_model import ServerConfig
+from job_model import TranscriptionJob, TranscriptionState
+from .whisper_model import WhisperOptions
+from events import job_events
+from cancellation import cancellations, CancelToken
+from . import upload
+
+# seconds a worker gets to exit after SIGTERM before it gets SIGKILL
+TERMINATE_TIMEOUT = 5.0
+
+CACHE_COUNTERS = ('hits', 'misses', 'evictions')
+
+
+def worker_main(conn: Connection, config: dict, preload: bool):
+    """The worker process.  Jobs come in on conn as json and go back out the
+       same way when they're done, with the job's progress events, the model
+       cache stats, the upload counts, and the names of the models it has
+       loaded."""
+    config = ServerConfig(**config)
+    logging.basicConfig(filename=config.files.log_dir + "/whisper-worker.log", level=logging.INFO,
+                        format=f"%(asctime)s - worker {os.getpid()} - %(levelname)s - %(message)s")
+    send_lock = threading.Lock()
+    def send(*message):
+        with send_lock:
+            conn.send(message)
+    job_events.forward(lambda *event: send('event', event))
+
+    from . import whisper_process
+    upload.hold_counts()
+    def models():
+        return [name for name, device in whisper_process.model_cache.loaded()]
+    try:
+        if preload:
+            whisper_process.preload_models(config)
+        send('ready', whisper_process.model_cache.stats(), models())
+        while True:
+            request = conn.recv()
+            if request is None:
+                break
+            job = TranscriptionJob.model_validate(json.loads(request))
+            whisper_process.process_whisper(job, config)
+            send('done', job.model_dump_json(), whisper_process.model_cache.stats(), upload.take_counts(),
+                 models())
+    except (EOFError, BrokenPipeError, KeyboardInterrupt):
+        # the server has gone away
+        pass
+
+
+class WhisperWorker:
+    """A worker process and the server's end of its pipe"""
+    def __init__(self, config: ServerConfig, preload: bool = False):
+        ctx = multiprocessing.get_context('spawn')
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=worker_main, args=(child, config.model_dump(), preload),
+                                   name="whisper-worker", daemon=True)
+        self.process.start()
+        child.close()
+        self.ready = False
+        self.stats: dict = {}
+        # the models it had loaded when it last said
+        self.models: set[str] = set()
+        self.last_used = time.time()
+        logging.info(f"Started whisper worker {self.process.pid}")
+
+
+    def receive(self):
+        """The next message from the worker, or None if it has gone away"""
+        try:
+            return self.conn.recv()
+        except (EOFError, OSError):
+            return None
+
+
+    def wait_ready(self) -> bool:
+        """Wait for the worker to start up (and preload its models)"""
+        while not self.ready:
+            message = self.receive()
+            if message is None:
+                return False
+            if message[0] == 'ready':
+                self.ready = True
+                self.stats = message[1]
+                self.models = set(message[2])
+        return True
+
+
+    def terminate(self):
+        """Ask the worker to stop, right now.  This is safe to call from any
+           thread."""
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+    def stop(self):
+        """Stop the worker and wait for it to go away"""
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(TERMINATE_TIMEOUT)
+        self.kill()
+
+
+    def kill(self):
+        """Make sure the worker is gone"""
+        self.terminate()
+        self.process.join(TERMINATE_TIMEOUT)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class WhisperWorkerPool:
+    """The idle workers, and the ones running jobs"""
+    def __init__(self):
+        self.idle: list[WhisperWorker] = []
+        self.busy: set[WhisperWorker] = set()
+        self.lock = threading.Lock()
+        # model cache counters from workers which are gone, so the totals
+        # don't go backwards
+        self.retired = {k: 0 for k in CACHE_COUNTERS}
+        self.crashes = 0
+        self.kills = 0
+
+
+    def checkout(self, config: ServerConfig, model: str) -> WhisperWorker:
+        """An idle worker, preferably one which already has the model loaded,
+           or a new one if they're all busy"""
+        with self.lock:
+            for worker in [w for w in self.idle if not w.process.is_alive()]:
+                self.idle.remove(worker)
+                self.retire(worker)
+            # the most recently used workers are at the end
+            warm = [w for w in self.idle if model in w.models]
+            if warm or self.idle:
+                worker = (warm or self.idle)[-1]
+                self.idle.remove(worker)
+                self.busy.add(worker)
+                return worker
+        worker = WhisperWorker(config)
+        with self.lock:
+            self.busy.add(worker)
+        return worker
+
+
+    def checkin(self, worker: WhisperWorker):
+        worker.last_used = time.time()
+        with self.lock:
+            self.busy.discard(worker)
+            self.idle.append(worker)
+
+
+    def retire(self, worker: WhisperWorker):
+        """Forget about a worker.  This needs to be called with the lock held."""
+        self.busy.discard(worker)
+        for k in CACHE_COUNTERS:
+            self.retired[k] += worker.stats.get(k, 0)
+
+
+    def run(self, job: TranscriptionJob, config: ServerConfig, token: CancelToken):
+        """Run the job on a worker and copy the results back into it.  If
+           the job is canceled the worker is killed."""
+        worker = self.checkout(config, str(WhisperOptions(**json.loads(job.request)['options']).model))
+        token.on_cancel(worker.terminate)
+        result = None
+        try:
+            worker.conn.send(job.model_dump_json())
+            while result is None:
+                message = worker.receive()
+                if message is None:
+                    break
+                if message[0] == 'event':
+                    job_events.publish(*message[1])
+                elif message[0] == 'ready':
+                    worker.ready = True
+                    worker.stats = message[1]
+                    worker.models = set(message[2])
+                elif message[0] == 'done':
+                    result = TranscriptionJob.model_validate(json.loads(message[1]))
+                    worker.stats = message[2]
+                    for name, fmt, n in message[3]:
+                        upload.count(name, fmt, n)
+                    worker.models = set(message[4])
+        except (OSError, ValueError) as e:
+            logging.warning(f"Lost touch with whisper worker {worker.process.pid}: {e}")
+
+        # once the callback is gone a cancel can't kill the worker, so it's
+        # safe to hand it to another job
+        token.discard(worker.terminate)
+        if result is not None and not token.cancelled:
+            for k in TranscriptionJob.model_fields:
+                setattr(job, k, getattr(result, k))
+            self.checkin(worker)
+            return
+
+        # the worker was killed or it died.  Either way it's gone and its
+        # memory with it.
+        worker.kill()
+        with self.lock:
+            self.retire(worker)
+            if token.cancelled:
+                self.kills += 1
+            else:
+                self.crashes += 1
+        if token.cancelled:
+            job.state = TranscriptionState.CANCELED
+            job.message = "Job was canceled while it was running"
+        else:
+            logging.error(f"Whisper worker {worker.process.pid} died running job {job.id} "
+                          f"(exit code {worker.process.exitcode})")
+            job.state = TranscriptionState.ERROR
+            job.message = f"The transcription worker died (exit code {worker.process.exitcode})"
+        if config.openai_whisper.preload:
+            # the pinned models went with it, so get them loaded again before
+            # a job needs them
+            threading.Thread(target=self.replace, args=(config,), name="whisper-worker-replace",
+                             daemon=True).start()
+
+
+    def preload(self, config: ServerConfig):
+        """Start a worker with the pinned models loaded"""
+        worker = WhisperWorker(config, preload=True)
+        if not worker.wait_ready():
+            worker.kill()
+            raise Exception(f"Whisper worker died preloading models (exit code {worker.process.exitcode})")
+        self.checkin(worker)
+
+
+    def replace(self, config: ServerConfig):
+        """Start a preloaded worker in place of one which is gone"""
+        try:
+            self.preload(config)
+        except Exception as e:
+            logging.error(f"Cannot start a replacement whisper worker: {e}")
+
+
+    def reap(self, idle_timeout: float):
+        """Stop workers which haven't had a job in idle_timeout seconds"""
+        if idle_timeout <= 0:
+            return
+        with self.lock:
+            stale = [w for w in self.idle if time.time() - w.last_used > idle_timeout]
+            for worker in stale:
+                self.idle.remove(worker)
+                self.retire(worker)
+        for worker in stale:
+            logging.info(f"Stopping idle whisper worker {worker.process.pid}")
+            worker.stop()
+
+
+    def shutdown(self):
+        with self.lock:
+            workers = self.idle + list(self.busy)
+            self.idle = []
+            self.busy = set()
+        for worker in workers:
+            worker.stop()
+
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'idle': len(self.idle),
+                    'busy': len(self.busy),
+                    'crashes': self.crashes,
+                    'kills': self.kills}
+
+
+    def model_cache_stats(self) -> dict:
+        """The model caches of all of the workers, added up"""
+        with self.lock:
+            stats = dict(self.retired)
+            for worker in self.idle + list(self.busy):
+                for k, v in worker.stats.items():
+                    stats[k] = stats.get(k, 0) + v
+        return stats
+
+
+worker_pool = WhisperWorkerPool()
+
+
+def process_whisper(job: TranscriptionJob, config: ServerConfig):
+    """Run the job in a worker process, or in this one if that's what the
+       configuration says"""
+    if config.openai_whisper.isolation == 'thread':
+        from . import whisper_process
+        return whisper_process.process_whisper(job, config)
+    worker_pool.run(job, config, cancellations.token(job.id))
+
+
+def preload_models(config: ServerConfig):
+    if config.openai_whisper.isolation == 'thread':
+        from . import whisper_process
+        return whisper_process.preload_models(config)
+    worker_pool.preload(config)
+
+
+def reap_idle_workers(config: ServerConfig):
+    worker_pool.reap(config.openai_whisper.idle_timeout)
+
+
+def model_cache_stats() -> dict:
+    """The model cache stats from the workers, or from this process if the
+       jobs are run here"""
+    stats = worker_pool.model_cache_stats()
+    local = sys.modules.get(f"{__package__}.whisper_process")
+    if local is not None:
+        for k, v in local.model_cache.stats().items():
+            stats[k] = stats.get(k, 0) + v
+    return stats
@@ -5,96 +5,191 @@ from tempfile import TemporaryDirectory
 from job_model import TranscriptionJob, TranscriptionState
 from .whispercpp_model import WhisperCPPOptions
 import json
-import subprocess
 from pathlib import Path
 import re
-from config_model import ServerConfig
+from contextlib import ExitStack
+from config_model import ServerConfig, EngineResources
 import logging
+from .whispercpp_server import WhisperServerPool
+from .media import fetch_media, MediaExpired
+from .transcript_cache import open_cache
+from .upload import upload_outputs, upload_meta, UploadExpired
+from .timing import StageTimer
+from .subprocesses import run_process, cpu_seconds, kill_group, Watchdog, ChildFailed
+from events import job_events
+from cancellation import cancellations, CancelToken
+
+# resident whisper.cpp processes for the server backend
+server_pool = WhisperServerPool()
+
+
+def run_cli(wav_file: str, tmpdir: str, model_file: Path, threads: int, language: str, config: ServerConfig,
+            token: CancelToken, deadline: float):
+    """Run whisper-cli on the input, which loads the model every time.
+       Returns the language and media length."""
+    whispercpp = config.server.root + "/whisper.cpp/whisper-cli"
+    cmd = [str(whispercpp), 
+           wav_file,
+           '--model', str(model_file),
+           '-of', tmpdir + "/output",
+           '-ojf', '-otxt', '-ovtt', '-ocsv', 
+           '-t', str(threads), '-l', language]
+    p = run_process(cmd, token, deadline)
+    if p.returncode != 0:
+        logging.error(f"Cannot run {cmd}: {p.output}")
+        raise ChildFailed(f"returned non-zero return code {p.returncode}", 'failed', p.cpu_time)
+    m = re.search(r'samples, (\d+\.\d+) sec\),.+, lang = (..)', p.output)
+    if m:
+        return m.group(2), float(m.group(1))
+    logging.warning(f"Cannot parse sample data! {p.output}")
+    return None, 0.0
+
+
+def run_server(wav_file: str, tmpdir: str, model_file: Path, threads: int, language: str, config: ServerConfig,
+               timer: StageTimer, token: CancelToken, deadline: float):
+    """Send the input to a whisper-resident process that has the model
+       loaded.  Returns the language and media length."""
+    whispercpp = config.server.root + "/whisper.cpp/whisper-resident"
+    with ExitStack() as stack:
+        # getting a server may mean starting one and loading the model
+        with timer.stage('model_load'):
+            server = stack.enter_context(server_pool.server(whispercpp, str(model_file), threads,
+                                                            config.files.log_dir + "/whisper-resident.log",
+                                                            config.whispercpp.startup_timeout))
+        # the process is busy with nothing but this job, so killing it is
+        # how the job is stopped.  The pool won't reuse a dead one.
+        start_cpu = cpu_seconds(server.process.pid)
+        used = []
+        def kill():
+            used.append(cpu_seconds(server.process.pid) - start_cpu)
+            kill_group(server.process.pid)
+        with timer.stage('inference'):
+            with Watchdog(token, deadline, kill) as watchdog:
+                try:
+                    return server.transcribe(wav_file, tmpdir + "/output", language)
+                except Exception:
+                    if not watchdog.reason:
+                        raise
+            if watchdog.reason == 'canceled':
+                raise ChildFailed("whisper-resident was stopped because the job was canceled", 'canceled', used[0])
+            raise ChildFailed(f"whisper-resident was stopped after running for {deadline:.0f} seconds", 'deadline', used[0])
+
+
+def reap_idle_servers(config: ServerConfig):
+    """Stop whisper-resident processes that haven't been used in a while"""
+    server_pool.reap(config.whispercpp.idle_timeout)
+
 
 def process_whispercpp(job: TranscriptionJob, config: ServerConfig):
     """The heavy lifting.  This actually runs a whisper.cpp job based on
        the parameters."""   
+    timer = StageTimer()
+    token = cancellations.token(job.id)
     try:
         # Get our original request from the job
         req = WhisperCPPOptions(**json.loads(job.request)['options'])
         with TemporaryDirectory() as tmpdir:  
-            # download the file
-            with requests.get(url=req.input, stream=True) as r:
-                if r.status_code == 403:
-                    # it was denied.  Just assume the presigned URL has
-                    # expired.
-                    job.state = TranscriptionState.EXPIRED
-                    job.message = "The Presigned URL has likely expired"
-                    return                    
-                r.raise_for_status()                    
-                with open(tmpdir + "/input_audio.dat", 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=65536):
-                        f.write(chunk)
-
-            # convert the file to wave.
-            p = subprocess.run(['ffmpeg', '-i', tmpdir + "/input_audio.dat",
-                            tmpdir + "/input_audio.wav"], stderr=subprocess.STDOUT,
-                            stdout=subprocess.PIPE, check=True)
-
-            # get the rest service root directory 
-            model_file = Path(config.files.models_dir, 'whisper.cpp', f"ggml-{req.model}.bin")
-            if not model_file.exists():
-                # download the file.                
-                logging.info(f"Downloading whisper.cpp model {req.model}")
-                model_file.parent.mkdir(parents=True, exist_ok=True)
-                src = "https://huggingface.co/ggerganov/whisper.cpp"
-                prefix = "resolve/main/ggml"
-                r = requests.get(f"{src}/{prefix}-{req.model}.bin")
-                r.raise_for_status()
-                with open(model_file, "wb") as f:
-                    for chunk in r.iter_content(chunk_size=1048576):
-                        if chunk:
-                            f.write(chunk)
-
-            whispercpp = config.server.root + "/whisper.cpp/whisper-cli"
-            start = time.time()
-            p = subprocess.run([str(whispercpp), 
-                                tmpdir + "/input_audio.wav",
-                                '--model', str(model_file),
-                                '-of', tmpdir + "/output",
-                                '-ojf', '-otxt', '-ovtt', '-ocsv', 
-                                '-t', '8', '-l', str(req.language)], 
-                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, 
-                                encoding='utf-8')
-            if p.returncode != 0:
-                logging.error(f"Cannot run {p.args}: {p.stdout}")
-                raise Exception(f"returned non-zero return code {p.returncode}")
-
-            job.processing_time = time.time() - start
-            for fmt, url in (('json', req.outputs.json_url),
-                                ('vtt', req.outputs.vtt_url),
-                                ('csv', req.outputs.csv_url),
-                                ('txt', req.outputs.txt_url)):
-                if url:
-                    data = Path(tmpdir, f"output.{fmt}").read_bytes()  # was read_text() and it'd fail.
-                    r = requests.put(url, data=data)
-                    if r.status_code == 403:
-                        job.state = TranscriptionState.EXPIRED
-                        job.message = f"Expired URL when uploading {fmt} to {url}"
-                    r.raise_for_status()
-            
-            # fill in the language and media time.
-            m = re.search(r'samples, (\d+\.\d+) sec\),.+, lang = (..)', p.stdout)
-            if m:
-                job.language_used = m.group(2)
-                job.media_length = float(m.group(1))
+            # stream the input through ffmpeg into a 16kHz mono wav, which
+            # is what whisper.cpp wants, unless it's already been prefetched
+            try:
+                with timer.stage('media') as stage:
+                    media = fetch_media(job.id, req.input, config.files.spool_dir, tmpdir + "/input_audio.wav")
+                    stage['bytes'] = media.input_bytes
+            except MediaExpired as e:
+                job.state = TranscriptionState.EXPIRED
+                job.message = str(e)
+                return
+
+            # if we've transcribed this media with these options before we
+            # can just send the old outputs.
+            cache = open_cache(config)
+            key = None
+            if cache and media.digest:
+                key = cache.key(media.digest, 'whisper.cpp', str(req.model), str(req.language),
+                                config.whispercpp.backend)
+            job_events.publish(job.id, job.state, "Media is ready", 0.1)
+            with timer.stage('cache'):
+                cached = cache.lookup(key) if key else None
+            if cached:
+                outdir, meta = cached
+                logging.info(f"Job {job.id} found in the transcript cache")
+                job.cache_hit = True
+                language, media_length = meta['language_used'], meta['media_length']
             else:
-                logging.warning(f"Cannot parse sample data! {p.stdout}")
+                # get the rest service root directory 
+                model_file = Path(config.files.models_dir, 'whisper.cpp', f"ggml-{req.model}.bin")
+                if not model_file.exists():
+                    # download the file.                
+                    logging.info(f"Downloading whisper.cpp model {req.model}")
+                    model_file.parent.mkdir(parents=True, exist_ok=True)
+                    src = "https://huggingface.co/ggerganov/whisper.cpp"
+                    prefix = "resolve/main/ggml"
+                    with timer.stage('model_download') as stage:
+                        r = requests.get(f"{src}/{prefix}-{req.model}.bin")
+                        r.raise_for_status()
+                        with open(model_file, "wb") as f:
+                            for chunk in r.iter_content(chunk_size=1048576):
+                                if chunk:
+                                    f.write(chunk)
+                                    stage['bytes'] += len(chunk)
+
+                # use as many threads as the job has cpu slots reserved.
+                slots = config.workers.engines.get('whisper.cpp', EngineResources(cpu=8))
+                threads = max(1, min(slots.cpu, config.workers.cpu))
+                deadline = config.whispercpp.deadline(str(req.model), media.duration)
+                start = time.time()
+                if config.whispercpp.backend == 'server':
+                    language, media_length = run_server(media.wav_file, tmpdir, model_file, threads, str(req.language), config,
+                                                        timer, token, deadline)
+                else:
+                    # whisper-cli loads the model and writes the outputs itself
+                    with timer.stage('inference'):
+                        language, media_length = run_cli(media.wav_file, tmpdir, model_file, threads, str(req.language), config,
+                                                         token, deadline)
+                job.processing_time = time.time() - start
+                outdir = Path(tmpdir)
+                if key:
+                    with timer.stage('cache'):
+                        cache.store(key, {fmt: Path(outdir, f"output.{fmt}") for fmt in ('json', 'vtt', 'csv', 'txt')},
+                                    {'language_used': language, 'media_length': media_length})
+
+            # fill in the language and media time.
+            job.media_length = media.duration
+            if language is not None:
+                job.language_used = language
+                job.media_length = media_length
+
+            job_events.publish(job.id, job.state, "Uploading outputs", 0.9)
+            try:
+                with timer.stage('upload') as stage:
+                    stats = upload_outputs(req.outputs, outdir, ['json', 'vtt', 'csv', 'txt'], config.uploads)
+                    stage['bytes'] = sum(x['sent_bytes'] for x in stats.values())
+            except UploadExpired as e:
+                job.state = TranscriptionState.EXPIRED
+                job.message = str(e)
+                return
+            job.upload_stats = json.dumps(stats)
 
             job.state = TranscriptionState.FINISHED
             job.message = "Transcription has completed successfully"    
 
             if req.outputs.meta_url:
                 # try to write the metadata out.  I don't really care if it fails.
-                r = requests.put(req.outputs.meta_url, data=job.model_dump_json())
+                job.stage_timings = timer.to_json()
+                upload_meta(req.outputs.meta_url, job.model_dump_json(), config.uploads)
+
+    except ChildFailed as e:
+        # the process is gone and the temporary directory with it
+        logging.warning(f"whisper.cpp for job {job.id} {e.reason}: {e} ({e.cpu_time:.1f} CPU seconds)")
+        job.wasted_cpu_time = e.cpu_time
+        job.state = TranscriptionState.CANCELED if e.reason == 'canceled' else TranscriptionState.ERROR
+        job.message = str(e)
 
     except Exception as e:
         logging.exception(f"Transcription Exception for job {job}: {e}")
         job.state = TranscriptionState.ERROR
         job.message = str(e)
 
+    finally:
+        job.stage_timings = timer.to_json()
+
@@ -0,0 +1,171 @@
+"""Keep whisper.cpp models loaded in resident processes so each job doesn't
+have to load the model from disk again.  The processes run whisper-resident,
+which is whisper-cli reading its jobs from a pipe, so the outputs are the
+same as whisper-cli's."""
+import subprocess
+import threading
+import select
+import signal
+import time
+import os
+import logging
+from contextlib import contextmanager
+
+
+class WhisperServer:
+    """A single whisper-resident process which takes jobs on stdin"""
+    def __init__(self, binary: str, model_file: str, threads: int, log_file: str):
+        self.model_file = model_file
+        self.last_used = time.time()
+        with open(log_file, "a") as log:
+            # put it in its own process group so we can take down anything
+            # it starts along with it.
+            self.process = subprocess.Popen([binary,
+                                             '--model', model_file,
+                                             '-t', str(threads),
+                                             '-ojf', '-otxt', '-ovtt', '-ocsv'],
+                                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                            stderr=log, start_new_session=True)
+        logging.info(f"Started whisper-resident {self.process.pid} for {model_file}")
+
+
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+
+    def reply(self) -> list[str]:
+        """Read a reply line, which is empty if the process has gone away"""
+        return self.process.stdout.readline().decode('utf-8').rstrip('\n').split('\t')
+
+
+    def wait_ready(self, timeout: float):
+        """It says it's ready once the model is loaded"""
+        ready, _, _ = select.select([self.process.stdout], [], [], timeout)
+        if not ready:
+            self.stop()
+            raise Exception(f"whisper-resident didn't load {self.model_file} within {timeout} seconds")
+        reply = self.reply()
+        if reply != ['ready']:
+            self.stop()
+            raise Exception(f"whisper-resident cannot load {self.model_file}: {reply} (code {self.process.returncode})")
+
+
+    def transcribe(self, wav_file: str, prefix: str, language: str) -> tuple[str, float]:
+        """Have it write the outputs for the audio to prefix.{json,txt,vtt,csv}.
+           Returns the language code and media length"""
+        self.last_used = time.time()
+        try:
+            self.process.stdin.write(f"{wav_file}\t{prefix}\t{language}\n".encode('utf-8'))
+            self.process.stdin.flush()
+            reply = self.reply()
+        except OSError as e:
+            raise Exception(f"whisper-resident has gone away: {e}")
+        finally:
+            self.last_used = time.time()
+        if reply[0] == 'ok' and len(reply) == 3:
+            return reply[1], float(reply[2])
+        if reply[0] == 'error':
+            raise Exception(f"whisper-resident failed: {' '.join(reply[1:])}")
+        raise Exception(f"whisper-resident has gone away (code {self.process.poll()})")
+
+
+    def stop(self):
+        """Shut down the process, forcefully if needed"""
+        if self.alive():
+            logging.info(f"Stopping whisper-resident {self.process.pid} for {self.model_file}")
+            try:
+                os.killpg(self.process.pid, signal.SIGTERM)
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                os.killpg(self.process.pid, signal.SIGKILL)
+                self.process.wait()
+            except ProcessLookupError:
+                pass
+        for pipe in (self.process.stdin, self.process.stdout):
+            try:
+                pipe.close()
+            except OSError:
+                pass
+
+
+class WhisperServerPool:
+    """whisper-resident processes, keyed by model and thread count.  Each
+       one only handles one job at a time."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle: dict[tuple, list[WhisperServer]] = {}
+        self.busy: set[WhisperServer] = set()
+
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'idle': sum(len(x) for x in self.idle.values()),
+                    'busy': len(self.busy)}
+
+
+    @contextmanager
+    def server(self, binary: str, model_file: str, threads: int, log_file: str,
+               startup_timeout: float):
+        """Borrow an idle server for the model or start a new one"""
+        key = (model_file, threads)
+        server = None
+        with self.lock:
+            while self.idle.get(key):
+                candidate = self.idle[key].pop()
+                if candidate.alive():
+                    server = candidate
+                    break
+                candidate.stop()
+            if server:
+                self.busy.add(server)
+        if server is None:
+            server = WhisperServer(binary, model_file, threads, log_file)
+            with self.lock:
+                self.busy.add(server)
+            try:
+                server.wait_ready(startup_timeout)
+            except Exception:
+                with self.lock:
+                    self.busy.discard(server)
+                raise
+        healthy = False
+        try:
+            yield server
+            healthy = True
+        finally:
+            with self.lock:
+                self.busy.discard(server)
+                if healthy and server.alive():
+                    self.idle.setdefault(key, []).append(server)
+                else:
+                    server.stop()
+
+
+    def reap(self, idle_timeout: float):
+        """Stop any servers which haven't been used in a while"""
+        now = time.time()
+        expired = []
+        with self.lock:
+            for key in list(self.idle.keys()):
+                keep = []
+                for server in self.idle[key]:
+                    if server.alive() and now - server.last_used < idle_timeout:
+                        keep.append(server)
+                    else:
+                        expired.append(server)
+                if keep:
+                    self.idle[key] = keep
+                else:
+                    del self.idle[key]
+        for server in expired:
+            server.stop()
+
+
+    def shutdown(self):
+        """Stop everything"""
+        with self.lock:
+            servers = [s for v in self.idle.values() for s in v] + list(self.busy)
+            self.idle.clear()
+            self.busy.clear()
+        for server in servers:
+            server.stop()
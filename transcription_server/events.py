@@ -0,0 +1,74 @@
+"""Let clients wait for job state changes without polling the database"""
+import asyncio
+import time
+from contextlib import contextmanager
+
+TERMINAL_STATES = ('finished', 'canceled', 'error', 'expired')
+
+
+class JobEvents:
+    """In-process publish/subscribe for job updates.  Each subscriber gets
+       a queue of the updates for one job.  Publishing is safe from any
+       thread, so the engines can report their progress."""
+    def __init__(self, queue_size: int = 100):
+        self.queue_size = queue_size
+        self.loop: asyncio.AbstractEventLoop = None
+        self.subscribers: dict[int, set[asyncio.Queue]] = {}
+        self.forwarder = None
+
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        """Updates are delivered on this loop"""
+        self.loop = loop
+
+
+    def forward(self, forwarder):
+        """Hand the updates to forwarder(job_id, state, message, progress)
+           instead.  A worker process uses this to pass them to the server."""
+        self.forwarder = forwarder
+
+
+    def publish(self, job_id: int, state: str, message: str, progress: float = None):
+        """Send an update to anyone watching the job"""
+        if self.forwarder is not None:
+            self.forwarder(job_id, str(state), message, progress)
+            return
+        if self.loop is None or self.loop.is_closed():
+            return
+        event = {'id': job_id,
+                 'state': str(state),
+                 'message': message,
+                 'progress': progress,
+                 'time': time.time()}
+        self.loop.call_soon_threadsafe(self.deliver, job_id, event)
+
+
+    def deliver(self, job_id: int, event: dict):
+        for queue in self.subscribers.get(job_id, ()):
+            if queue.full():
+                # a slow reader only needs the latest news
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+
+    @contextmanager
+    def subscribe(self, job_id: int):
+        """A queue which receives the updates for the job, until the context
+           is left"""
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.subscribers.setdefault(job_id, set()).add(queue)
+        try:
+            yield queue
+        finally:
+            watchers = self.subscribers.get(job_id)
+            watchers.discard(queue)
+            if not watchers:
+                del self.subscribers[job_id]
+
+
+    def watchers(self) -> int:
+        return sum(len(x) for x in self.subscribers.values())
+
+
+# there's one event bus for the whole server
+job_events = JobEvents()
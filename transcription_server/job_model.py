@@ -1,16 +1,15 @@
-from typing import Literal, Optional, Self
+from typing import Literal, Optional, Self, Union
 from pydantic import BaseModel, model_validator
-from sqlmodel import SQLModel, Field
+from sqlmodel import SQLModel, Field, Index, text
 
 from enum import StrEnum, IntEnum
-from engines.whisper_model import WhisperOptions
-from engines.whispercpp_model import WhisperCPPOptions
+from engines.registry import engine_registry
 
 
 TranscriptionState = StrEnum("TranscriptionState", 
                              "QUEUED RUNNING CANCELED FINISHED ERROR EXPIRED")
 TranscriptionEngine = StrEnum("TranscriptionEngine", 
-                              "openai-whisper whisper.cpp")
+                              engine_registry.names())
 TranscriptionNotificationType = StrEnum("TranscriptionNotificationType",
                                         "poll expire url")
 
@@ -28,8 +27,9 @@ class TranscriptionRequest(BaseModel):
                               description="After the job has completed remove the database entry after this many seconds (reading the job info after completion will also remove it)")
     priority: TranscriptionPriority = Field(default=TranscriptionPriority.NORMAL,
                                             description="Transcription priority")
-    options: WhisperOptions | WhisperCPPOptions = Field(discriminator="engine",
-                                                        description="Engine-specific options")
+    # the options for any of the registered engines, told apart by 'engine'
+    options: Union[engine_registry.options_models()] = Field(discriminator="engine",
+                                                             description="Engine-specific options")
 
     @model_validator(mode='after')
     def check_for_a_url(self) -> Self:
@@ -39,11 +39,59 @@ class TranscriptionRequest(BaseModel):
         return self
 
 
+class TranscriptionStatus(BaseModel):
+    """The short version of a job's status"""
+    id: int
+    state: TranscriptionState
+    message: str
+    finish_time: float
+
+
+class TranscriptionBatchItem(BaseModel):
+    """The outcome of one request in a batch submission"""
+    index: int = Field(description="Position of the request in the batch")
+    id: int | None = Field(default=None, description="Transcription job id, if it was queued")
+    error: str | None = Field(default=None, description="Why the request was rejected")
+
+
+class TranscriptionPurge(BaseModel):
+    """Which finished jobs to remove"""
+    states: list[TranscriptionState] = Field(default=[TranscriptionState.FINISHED, TranscriptionState.CANCELED,
+                                                      TranscriptionState.ERROR, TranscriptionState.EXPIRED],
+                                             description="Remove jobs in these states, which can only be the ones a job ends in")
+    owner: str | None = Field(default=None, description="Only remove jobs for this owner")
+    older_than: float = Field(default=0.0, ge=0, description="Only remove jobs which finished at least this many seconds ago")
+
+    @model_validator(mode='after')
+    def check_for_terminal_states(self) -> Self:
+        for state in self.states:
+            if state in (TranscriptionState.QUEUED, TranscriptionState.RUNNING):
+                raise ValueError(f"Jobs which are {state} cannot be purged")
+        return self
+
+
 class TranscriptionJob(SQLModel, table=True):
     """A transcription job"""
+    # every index here is written on each state change, so there's only one
+    # for each kind of query.  The queue is always walked in priority desc,
+    # queue_time order, so the queue indexes need to match that ordering,
+    # and listings page through an owner's jobs in id order.
+    __table_args__ = (Index("ix_transcriptionjob_queue", 
+                            "state", text("priority DESC"), "queue_time"),
+                      Index("ix_transcriptionjob_owner_queue", 
+                            "owner", "state", text("priority DESC"), "queue_time"),
+                      Index("ix_transcriptionjob_owner_list",
+                            "owner", "id"),
+                      Index("ix_transcriptionjob_lease",
+                            "state", "lease_expires"),
+                      # ids are never reused, so an outbox entry or a
+                      # client's id can't end up pointing at a newer job
+                      # after its own was purged
+                      {'sqlite_autoincrement': True})
     id: Optional[int] = Field(default=None, primary_key=True,
                               description="Transcription job id")
-    owner: str = Field(index=True, description='Job owner')
+    owner: str = Field(description='Job owner')
+    engine: str = Field(default="", description="Transcription engine")
     state: TranscriptionState = Field(description="State of the transcription job")
     message: str = Field(description="Message accompanying the state")
     media_length: float = Field(default=0.0, description="Duration of media in seconds")    
@@ -53,6 +101,32 @@ class TranscriptionJob(SQLModel, table=True):
     start_time: float = Field(default=0.0, description="Time the job was started")
     finish_time: float = Field(default=0.0, description="Time the job completed")
     processing_time: float = Field(default=0.0, description="Time to process the job")
+    wasted_cpu_time: float = Field(default=0.0, description="CPU seconds used by engine processes which were killed or failed")
+    stage_timings: str = Field(default="", description="Seconds and bytes for each stage of the processing, as JSON")
+    upload_stats: str = Field(default="", description="Bytes sent and seconds taken for each output format, as JSON")
+    cache_hit: bool = Field(default=False, description="The outputs came from the transcript cache")
     url_notified: bool = Field(default=False,
                                description="If notification_type is 'url', Whether or not the notification_url has been notified")
-    priority: int = Field(default=0, description="Processing priority")    
\ No newline at end of file
+    notification_type: TranscriptionNotificationType = Field(default=TranscriptionNotificationType.poll, index=True,
+                                                             description="Type of notification to use when the job has finished")
+    notify_pending: bool = Field(default=False, index=True,
+                                 description="The notification_url still needs to be notified")
+    expire_at: Optional[float] = Field(default=None, index=True,
+                                       description="Time the finished job will be removed from the database")
+    priority: int = Field(default=0, description="Processing priority")    
+    worker_id: str = Field(default="", description="Node which claimed the job")
+    lease_expires: float = Field(default=0.0, description="Time the claim runs out unless the node renews it")
+
+
+class NotificationOutbox(SQLModel, table=True):
+    """A url notification waiting to be delivered"""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    job_id: int = Field(index=True, description="Transcription job id")
+    url: str = Field(description="URL to PUT the payload to")
+    payload: str = Field(description="The job, as JSON")
+    attempts: int = Field(default=0, description="Number of failed delivery attempts")
+    next_attempt: float = Field(default=0.0, index=True, description="Time of the next delivery attempt")
+    created: float = Field(default=0.0, description="Time the notification was queued")
+    last_error: str = Field(default="", description="Why the last attempt failed")
+    claimed_by: str = Field(default="", description="Node which is delivering it")
+    claim_expires: float = Field(default=0.0, description="Time another node may deliver it instead")
@@ -0,0 +1,115 @@
+"""Prometheus metrics for the queue, the scheduler, and the engines.  The
+counters and histograms are updated as things happen, which is cheap.
+Anything which needs a query or a look at another component's state is
+gathered when the metrics are scraped."""
+import asyncio
+import json
+import time
+import logging
+from sqlmodel import Session, select, func
+from prometheus_client import Counter, Histogram
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily, REGISTRY
+from prometheus_client.registry import Collector
+from job_model import TranscriptionJob, TranscriptionState
+from database import with_session
+
+# durations run from well under a second (a cache hit) to hours
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200)
+
+jobs_started = Counter("transcription_jobs_started", "Jobs started", ['engine', 'model'])
+jobs_finished = Counter("transcription_jobs_finished", "Jobs finished", ['engine', 'model', 'state'])
+stage_seconds = Histogram("transcription_stage_seconds", "Time spent in each stage of a job",
+                          ['engine', 'stage'], buckets=DURATION_BUCKETS)
+real_time_factor = Histogram("transcription_real_time_factor", "Processing time divided by media length",
+                             ['engine', 'model'],
+                             buckets=(0.01, 0.02, 0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2, 5))
+stage_bytes = Counter("transcription_stage_bytes", "Bytes moved in each stage of a job", ['engine', 'stage'])
+upload_bytes = Counter("transcription_upload_bytes", "Bytes sent for output uploads", ['format'])
+upload_failures = Counter("transcription_upload_failures", "Output uploads which failed", ['format'])
+loop_lag = Histogram("transcription_event_loop_lag_seconds", "How late the event loop was in waking up a task",
+                     buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+
+
+def record_finish(job: TranscriptionJob, model: str):
+    """Count a finished job and how long it took"""
+    jobs_finished.labels(job.engine, model, str(job.state)).inc()
+    if job.start_time:
+        stage_seconds.labels(job.engine, 'queue').observe(max(0, job.start_time - job.queue_time))
+        stage_seconds.labels(job.engine, 'total').observe(max(0, job.finish_time - job.start_time))
+    if job.stage_timings:
+        for stage, timing in json.loads(job.stage_timings).items():
+            stage_seconds.labels(job.engine, stage).observe(timing['seconds'])
+            if timing['bytes']:
+                stage_bytes.labels(job.engine, stage).inc(timing['bytes'])
+    if job.processing_time > 0 and job.media_length > 0 and not job.cache_hit:
+        real_time_factor.labels(job.engine, model).observe(job.processing_time / job.media_length)
+
+
+class QueueCollector(Collector):
+    """The size of the queue, by state and priority, and how long the oldest
+       queued job has been waiting"""
+    def describe(self):
+        # otherwise registering it would run the query
+        return []
+
+
+    def query(self, session: Session):
+        counts = session.exec(select(TranscriptionJob.state, TranscriptionJob.priority, func.count())
+                              .group_by(TranscriptionJob.state, TranscriptionJob.priority)).all()
+        oldest = session.exec(select(func.min(TranscriptionJob.queue_time))
+                              .where(TranscriptionJob.state == TranscriptionState.QUEUED)).one()
+        return counts, oldest
+
+
+    def collect(self):
+        counts, oldest = with_session(self.query)
+        jobs = GaugeMetricFamily("transcription_jobs", "Jobs in the database", labels=['state', 'priority'])
+        for state, priority, count in counts:
+            jobs.add_metric([str(state), str(priority)], count)
+        yield jobs
+        yield GaugeMetricFamily("transcription_oldest_queued_job_age_seconds",
+                                "How long the oldest queued job has been waiting",
+                                value=time.time() - oldest if oldest else 0)
+
+
+class StatsCollector(Collector):
+    """Expose a component's stats() dictionary.  The keys in counters only
+       ever go up, the rest are gauges."""
+    def __init__(self, prefix: str, stats, counters: set[str] = ()):
+        self.prefix = prefix
+        self.stats = stats
+        self.counters = set(counters)
+
+
+    def collect(self):
+        try:
+            stats = self.stats()
+        except Exception as e:
+            logging.warning(f"Cannot get the {self.prefix} stats: {e}")
+            return
+        for key, value in stats.items():
+            name = f"{self.prefix}_{key}"
+            if key in self.counters:
+                yield CounterMetricFamily(name, f"{self.prefix} {key}", value=value)
+            else:
+                yield GaugeMetricFamily(name, f"{self.prefix} {key}", value=value)
+
+
+_registered: list[Collector] = []
+
+def register_collectors(collectors: list[Collector]):
+    """Add the scrape-time collectors.  The server can be started more than
+       once in a process (the benchmarks do that) so replace any from before."""
+    while _registered:
+        REGISTRY.unregister(_registered.pop())
+    for c in collectors:
+        REGISTRY.register(c)
+        _registered.append(c)
+
+
+async def monitor_loop_lag(interval: float):
+    """Sleep for interval over and over and record how late we wake up"""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        loop_lag.observe(max(0, time.perf_counter() - start - interval))
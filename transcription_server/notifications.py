@@ -0,0 +1,209 @@
+"""Deliver the url notifications without holding up the scheduler"""
+import asyncio
+import random
+import time
+import logging
+from urllib.parse import urlsplit
+import httpx
+from sqlmodel import Session, select, update
+from database import run_db
+from job_model import TranscriptionJob, NotificationOutbox
+from config_model import Notifications
+
+
+class CircuitBreaker:
+    """Stop sending to a host that keeps failing, for a while"""
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+
+
+    def allow(self) -> bool:
+        # once the cooldown is over we let requests through again (half-open)
+        # and the first failure will trip it again.
+        return time.time() >= self.open_until
+
+
+    def success(self):
+        self.failures = 0
+        self.open_until = 0.0
+
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.open_until = time.time() + self.cooldown
+
+
+class WebhookNotifier:
+    """Send the notifications in the outbox table.  Each one is retried
+       with exponential backoff until it's delivered or we give up on it.
+       The nodes share the outbox, so a node claims a notification before
+       it sends it."""
+    def __init__(self, config: Notifications, node: str):
+        self.config = config
+        self.node = node
+        self.client = httpx.AsyncClient(timeout=config.timeout,
+                                        limits=httpx.Limits(max_connections=config.concurrency,
+                                                            max_keepalive_connections=config.concurrency))
+        self.semaphore = asyncio.Semaphore(config.concurrency)
+        self.breakers: dict[str, CircuitBreaker] = {}
+        self.in_flight: set[int] = set()
+        self.tasks: set[asyncio.Task] = set()
+        self.event = asyncio.Event()
+        self.delivered = 0
+        self.failed = 0
+        self.abandoned = 0
+
+
+    def wake(self):
+        """There's something new in the outbox"""
+        self.event.set()
+
+
+    def stats(self) -> dict:
+        return {'delivered': self.delivered,
+                'failed': self.failed,
+                'abandoned': self.abandoned,
+                'in_flight': len(self.in_flight),
+                'open_circuits': sum(1 for b in self.breakers.values() if not b.allow())}
+
+
+    async def run(self):
+        """Pick up the notifications that are due and send them"""
+        while True:
+            try:
+                self.event.clear()
+                due, next_note = await run_db(self.due, time.time())
+                for note_id, url, payload in due:
+                    if note_id in self.in_flight:
+                        continue
+                    self.in_flight.add(note_id)
+                    task = asyncio.create_task(self.deliver(note_id, url, payload))
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+                # sleep until the next one is due or something new shows up
+                timeout = self.config.poll_interval
+                if next_note is not None:
+                    timeout = min(timeout, max(0.0, next_note - time.time()))
+                try:
+                    await asyncio.wait_for(self.event.wait(), timeout)
+                except TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.exception(f"Notification delivery loop failed: {e}")
+                await asyncio.sleep(self.config.poll_interval)
+
+
+    def due(self, session: Session, now: float) -> tuple[list[tuple[int, str, str]], float | None]:
+        """Claim the notifications which are ready to go and aren't claimed
+           by another node, and say when the next one will be.  The claim
+           check is in the update itself so only one node sends each one."""
+        ready = session.exec(select(NotificationOutbox)
+                             .where(NotificationOutbox.next_attempt <= now,
+                                    NotificationOutbox.claim_expires <= now)
+                             .order_by(NotificationOutbox.next_attempt)
+                             .limit(self.config.concurrency * 4)).all()
+        due = []
+        for note in ready:
+            result = session.exec(update(NotificationOutbox)
+                                  .where(NotificationOutbox.id == note.id,
+                                         NotificationOutbox.next_attempt <= now,
+                                         NotificationOutbox.claim_expires <= now)
+                                  .values(claimed_by=self.node,
+                                          claim_expires=now + self.config.claim_time))
+            if result.rowcount:
+                due.append((note.id, note.url, note.payload))
+        session.commit()
+        next_note = session.exec(select(NotificationOutbox.next_attempt)
+                                 .where(NotificationOutbox.next_attempt > now)
+                                 .order_by(NotificationOutbox.next_attempt)
+                                 .limit(1)).first()
+        return due, next_note
+
+
+    async def deliver(self, note_id: int, url: str, payload: str):
+        """Try to send one notification"""
+        try:
+            host = urlsplit(url).netloc
+            breaker = self.breakers.setdefault(host, CircuitBreaker(self.config.breaker_threshold,
+                                                                    self.config.breaker_cooldown))
+            if not breaker.allow():
+                # don't count it as an attempt, just wait for the host to
+                # come back.
+                await run_db(self.reschedule, note_id, breaker.open_until, None, f"Circuit open for {host}")
+                return
+            error = None
+            async with self.semaphore:
+                try:
+                    r = await self.client.put(url, content=payload,
+                                              headers={'Content-Type': 'application/json'})
+                    if r.is_success:
+                        breaker.success()
+                        self.delivered += 1
+                        await run_db(self.delivered_to, note_id)
+                        return
+                    error = f"HTTP status {r.status_code}"
+                except httpx.HTTPError as e:
+                    error = f"{type(e).__name__}: {e}"
+            breaker.failure()
+            self.failed += 1
+            await run_db(self.reschedule, note_id, None, self.config.backoff_base, error)
+        except Exception as e:
+            logging.exception(f"Cannot deliver notification {note_id}: {e}")
+        finally:
+            self.in_flight.discard(note_id)
+            self.wake()
+
+
+    def reschedule(self, session: Session, note_id: int, when: float | None, backoff: float | None, error: str):
+        """Set up the next attempt, either at a given time or with backoff.
+           If we've run out of attempts, give up on it."""
+        note = session.get(NotificationOutbox, note_id)
+        if note is None or note.claimed_by != self.node:
+            # our claim ran out and another node has it now
+            return
+        note.last_error = error
+        if backoff is not None:
+            note.attempts += 1
+            if note.attempts >= self.config.max_attempts:
+                logging.warning(f"Giving up on notification for job {note.job_id} to {note.url}: {error}")
+                self.abandoned += 1
+                self.finish(session, note, False)
+                return
+            # exponential backoff with jitter so a recovering endpoint
+            # doesn't get everything at once.
+            delay = min(self.config.backoff_max, backoff * 2 ** (note.attempts - 1))
+            when = time.time() + delay * random.uniform(0.5, 1.0)
+        logging.info(f"Notification for job {note.job_id} failed ({error}), next attempt at {when:0.1f}")
+        note.next_attempt = when
+        note.claimed_by = ""
+        note.claim_expires = 0.0
+        session.commit()
+
+
+    def delivered_to(self, session: Session, note_id: int):
+        note = session.get(NotificationOutbox, note_id)
+        if note is not None:
+            self.finish(session, note, True)
+
+
+    def finish(self, session: Session, note: NotificationOutbox, delivered: bool):
+        """Remove the outbox entry and update the job (if it's still around)"""
+        session.exec(update(TranscriptionJob)
+                     .where(TranscriptionJob.id == note.job_id)
+                     .values(url_notified=delivered, notify_pending=False))
+        session.delete(note)
+        session.commit()
+
+
+    async def close(self):
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.client.aclose()
@@ -0,0 +1,143 @@
+"""Download and decode the media for upcoming jobs while the current ones run"""
+import asyncio
+import threading
+import shutil
+import json
+import logging
+import time
+from pathlib import Path
+from sqlmodel import Session, select, or_, and_
+from job_model import TranscriptionJob, TranscriptionState, TranscriptionRequest
+from engines.media import decode_media, spool_entry
+from config_model import ServerConfig
+from database import run_db
+from scheduling import SchedulingPolicy, DatabaseQueue
+
+
+class Prefetcher:
+    """Keep the decoded media for the jobs at the front of the queue in a
+       spool directory, one subdirectory per job"""
+    def __init__(self, config: ServerConfig, policy: SchedulingPolicy, node: str, engines: list[str]):
+        self.config = config
+        self.policy = policy
+        self.node = node
+        # the engines the node runs jobs for
+        self.engines = engines
+        self.spool = Path(config.files.spool_dir)
+        self.tasks: dict[int, asyncio.Task] = {}
+        self.aborts: dict[int, threading.Event] = {}
+        # jobs we couldn't prefetch.  The engine will have to get it and
+        # deal with whatever the problem was.
+        self.failed: set[int] = set()
+
+
+    def startup(self):
+        """Anything left in the spool is from a previous run and the job
+           ordering may be different now, so start clean."""
+        shutil.rmtree(self.spool, ignore_errors=True)
+        self.spool.mkdir(parents=True, exist_ok=True)
+
+
+    def spool_bytes(self) -> int:
+        return sum(f.stat().st_size for f in self.spool.glob("*/*") if f.is_file())
+
+
+    def nodes(self, session: Session, engines: list[str]) -> list[str]:
+        """The nodes running jobs for these engines, and this one"""
+        running = (select(TranscriptionJob.worker_id).distinct()
+                   .where(TranscriptionJob.state == TranscriptionState.RUNNING,
+                          TranscriptionJob.lease_expires >= time.time(),
+                          TranscriptionJob.engine.in_(engines)))
+        return sorted(set(session.exec(running).all()) | {self.node})
+
+
+    def upcoming(self, session: Session, want: int) -> list[tuple[int, str]]:
+        """The jobs this node is likely to start next, as the policy sees it.
+           Every node sharing the database sees the same queue, so rather
+           than all of them fetching the same few jobs they take turns down
+           it, and each one fetches every Nth job."""
+        nodes = self.nodes(session, self.engines)
+        jobs = self.policy.order(DatabaseQueue(session, self.engines), want * len(nodes), time.time())
+        ids = [job.id for job in jobs[nodes.index(self.node)::len(nodes)]]
+        requests = dict(session.exec(select(TranscriptionJob.id, TranscriptionJob.request)
+                                     .where(TranscriptionJob.id.in_(ids))).all())
+        return [(id, requests[id]) for id in ids if id in requests]
+
+
+    async def schedule(self):
+        """Start prefetching any of the next jobs which aren't already"""
+        want = self.config.prefetch.jobs
+        if want <= 0:
+            return
+        budget = self.config.prefetch.max_spool * 1048576
+        for id, request in await run_db(self.upcoming, want):
+            if id in self.tasks or id in self.failed or spool_entry(self.spool, id):
+                continue
+            if self.spool_bytes() >= budget:
+                break
+            req = TranscriptionRequest(**json.loads(request))
+            self.aborts[id] = threading.Event()
+            self.tasks[id] = asyncio.create_task(self.fetch(id, str(req.options.input)))
+
+
+    async def fetch(self, job_id: int, url: str):
+        """Decode the media into the spool"""
+        entry = Path(self.spool, str(job_id))
+        try:
+            entry.mkdir(parents=True, exist_ok=True)
+            media = await asyncio.to_thread(decode_media, url, str(Path(entry, "input_audio.wav")),
+                                            abort=self.aborts[job_id])
+            # the metadata file marks the entry as complete
+            Path(entry, "media.json").write_text(json.dumps({'input_bytes': media.input_bytes,
+                                                             'duration': media.duration,
+                                                             'digest': media.digest}))
+            logging.info(f"Prefetched {media.input_bytes} bytes of media for job {job_id}")
+        except Exception as e:
+            # a discarded job doesn't need remembering
+            if not self.aborts[job_id].is_set():
+                logging.info(f"Cannot prefetch media for job {job_id}: {e}")
+                self.failed.add(job_id)
+            shutil.rmtree(entry, ignore_errors=True)
+        finally:
+            self.tasks.pop(job_id, None)
+            if self.aborts.pop(job_id).is_set():
+                # it was discarded while we were working on it.
+                shutil.rmtree(entry, ignore_errors=True)
+
+
+    async def claim(self, job_id: int):
+        """The job is about to start so wait for its prefetch to finish, if
+           there is one in progress"""
+        task = self.tasks.get(job_id, None)
+        if task:
+            await asyncio.wait([task])
+
+
+    @staticmethod
+    def unclaimed(session: Session, job_ids: list[int], node: str) -> set[int]:
+        """The jobs which are gone, or which another node has claimed"""
+        mine = or_(TranscriptionJob.state == TranscriptionState.QUEUED,
+                   and_(TranscriptionJob.state == TranscriptionState.RUNNING,
+                        TranscriptionJob.worker_id == node))
+        return set(job_ids) - set(session.exec(select(TranscriptionJob.id)
+                                               .where(TranscriptionJob.id.in_(job_ids), mine)).all())
+
+
+    async def prune(self):
+        """Get rid of the spool entries for jobs this node won't be running"""
+        job_ids = [int(p.name) for p in self.spool.iterdir() if p.name.isdigit()]
+        if not job_ids:
+            return
+        for id in await run_db(self.unclaimed, job_ids, self.node):
+            logging.info(f"Dropping the prefetched media for job {id}")
+            self.discard(id)
+
+
+    def discard(self, job_id: int):
+        """Get rid of the spool entry for a job, stopping the prefetch if
+           it's still running"""
+        self.failed.discard(job_id)
+        if job_id in self.aborts:
+            self.aborts[job_id].set()
+        else:
+            shutil.rmtree(Path(self.spool, str(job_id)), ignore_errors=True)
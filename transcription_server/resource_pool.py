@@ -0,0 +1,58 @@
+"""Keep track of the resources used by running jobs"""
+from config_model import Workers, EngineResources
+
+
+class ResourcePool:
+    """The resource slots available to the running jobs"""
+    def __init__(self, config: Workers):
+        self.config = config
+        self.free = {'cpu': config.cpu, 
+                     'memory': config.memory, 
+                     'accelerator': config.accelerator}
+        self.running = 0
+
+
+    def requirements(self, engine: str) -> EngineResources:
+        """The resources a job on this engine needs.  A request can't be
+           larger than the pool or it would never be scheduled, so it's cut
+           down to the pool size, except that a pool with none of something
+           can't run anything which needs it.  Memory is the exception:
+           a pool with no memory doesn't track it."""
+        req = self.config.engines.get(engine, EngineResources())
+        def clamp(need: int, total: int) -> int:
+            return min(need, total) if total > 0 else need
+        return EngineResources(cpu=clamp(req.cpu, self.config.cpu),
+                               memory=min(req.memory, self.config.memory),
+                               accelerator=clamp(req.accelerator, self.config.accelerator))
+
+
+    def runnable(self, engine: str) -> bool:
+        """True if a job on the engine can ever fit in the pool"""
+        req = self.requirements(engine).model_dump()
+        return all(v <= self.config.model_dump()[k] for k, v in req.items())
+
+
+    def is_full(self) -> bool:
+        """True if no more jobs can be started, regardless of the engine"""
+        return self.config.max_jobs > 0 and self.running >= self.config.max_jobs
+
+
+    def acquire(self, engine: str) -> bool:
+        """Reserve the resources for a job on the engine if they're available"""
+        if self.is_full():
+            return False
+        # untracked memory is clamped to zero by requirements()
+        req = self.requirements(engine).model_dump()
+        if any(self.free[k] < v for k, v in req.items()):
+            return False
+        for k, v in req.items():
+            self.free[k] -= v
+        self.running += 1
+        return True
+    
+
+    def release(self, engine: str):
+        """Return the resources for a finished job on the engine"""
+        for k, v in self.requirements(engine).model_dump().items():
+            self.free[k] += v
+        self.running -= 1
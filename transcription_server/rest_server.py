@@ -1,81 +1,153 @@
 #!/bin/env python3
-from typing import Annotated
-from fastapi import Depends, FastAPI, HTTPException, Query
+from typing import Annotated, Any
+from fastapi import Body, Depends, FastAPI, HTTPException, Query, Response
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
-from sqlmodel import SQLModel, Session, create_engine, select
+from fastapi.responses import StreamingResponse
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from sqlmodel import Session, select, delete, update, or_
 from contextlib import asynccontextmanager
 import asyncio
-from job_model import TranscriptionJob, TranscriptionState, TranscriptionRequest
-from engines.whisper_process import process_whisper
-from engines.whispercpp_process import process_whispercpp
+from job_model import TranscriptionJob, TranscriptionState, TranscriptionRequest, TranscriptionPriority, NotificationOutbox
+from job_model import TranscriptionStatus, TranscriptionBatchItem, TranscriptionPurge
+from engines.registry import engine_registry
 from config_model import ServerConfig
+from resource_pool import ResourcePool
+from scheduling import SchedulingPolicy, DatabaseQueue, QueuedJob, make_policy
+from prefetch import Prefetcher
+from auth import CredentialStore
+from notifications import WebhookNotifier
+from database import open_database, close_database, run_db
+from events import job_events, TERMINAL_STATES
+from cancellation import cancellations
+from metrics import jobs_started, record_finish, monitor_loop_lag, register_collectors, QueueCollector, StatsCollector
 import json
 import logging
+import os
+import socket
 import time
-import requests
 
-engine = None
+resources: ResourcePool = None
+policy: SchedulingPolicy = None
+prefetcher: Prefetcher = None
+credentials_store: CredentialStore = None
+notifier: WebhookNotifier = None
+
+# the name this node claims jobs under
+node_id: str = None
+# the engines this node runs jobs for: the enabled ones which fit in the
+# workers' resources
+node_engines: list[str] = []
+
+# the tasks for the jobs which are currently running, and their ids
+running_jobs: set[asyncio.Task] = set()
+claimed_jobs: set[int] = set()
+
+# The dispatcher sleeps on this until there's something for it to do.
+dispatch_event = asyncio.Event()
+
+# status changes are only published on the node running the job, so a
+# client waiting on another node would never hear about them.  Waiting
+# clients re-read the job from the database this often (in seconds), and
+# idle event streams get a keepalive comment at the same time.
+STATE_RECHECK = 5.0
 
 security = HTTPBearer()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global engine
+    global resources, policy, prefetcher, credentials_store, notifier, node_id, node_engines
     # things at startup
     # -- create the database as needed
     # -- restart any background processes that need it
     app.server_lock = False  # start with the service accepting jobs
     config: ServerConfig = app.server_config
-    engine = create_engine("sqlite:///" + config.files.database,
-                           connect_args={'check_same_thread': False})
-    SQLModel.metadata.create_all(engine)
+    node_id = config.scheduler.node_id or f"{socket.gethostname()}-{os.getpid()}"
+    credentials_store = CredentialStore(config.files.users)
+    job_events.bind(asyncio.get_running_loop())
+    engine_registry.enable(config.server.engines)
+    open_database(config.database, config.files.database)
+    resources = ResourcePool(config.workers)
+    node_engines = []
+    for name in engine_registry.enabled_names():
+        if resources.runnable(name):
+            node_engines.append(name)
+        else:
+            logging.warning(f"The {name} engine needs more than the workers have "
+                            f"({resources.requirements(name)}), so this node won't run its jobs")
+    policy = make_policy(config.scheduler)
+    prefetcher = Prefetcher(config, policy, node_id, node_engines)
+    prefetcher.startup()
+    # get any pinned models into memory before we start taking jobs
+    try:
+        await asyncio.to_thread(engine_registry.preload, config)
+    except Exception as e:
+        logging.exception(f"Cannot preload models: {e}")
+    notifier = WebhookNotifier(config.notifications, node_id)
+    n = asyncio.create_task(notifier.run())
+    register_collectors([QueueCollector(),
+                         *[StatsCollector(prefix, stats, counters) for prefix, stats, counters in engine_registry.stats()],
+                         StatsCollector("transcription_notifications", notifier.stats, {'delivered', 'failed', 'abandoned'}),
+                         StatsCollector("transcription_resources_free", lambda: resources.free),
+                         StatsCollector("transcription_scheduler", policy.stats),
+                         StatsCollector("transcription_event_watchers", lambda: {'count': job_events.watchers()})])
+    lag = asyncio.create_task(monitor_loop_lag(config.metrics.loop_lag_interval))
     t = asyncio.create_task(process_transcription_queue())
-    logging.info("Ready to serve")
+    h = asyncio.create_task(heartbeat())
+    logging.info(f"Ready to serve as node {node_id}")
     yield
     # things at shutdown
-    t.cancel()
+    # -- stop starting jobs and renewing leases
+    # -- stop the running jobs.  They're left as they are in the database
+    #    and are requeued when this node comes back or their leases run out.
+    # -- wait for all of it before the database goes away
+    background = [t, h, n, lag]
+    for task in background:
+        task.cancel()
+    for id in list(claimed_jobs):
+        cancellations.cancel(id)
+    jobs = list(running_jobs)
+    for task in jobs:
+        task.cancel()
+    await asyncio.gather(*background, *jobs, return_exceptions=True)
+    await notifier.close()
+    engine_registry.shutdown()
+    close_database()
 
 
-def get_session():
-    """Bind a session to the underlying ORM"""
-    with Session(engine) as session:
-        yield session
-
-# Create a session dependency for the API calls.
-SessionDep = Annotated[Session, Depends(get_session)]
-
 app = FastAPI(lifespan=lifespan)
 
 def validate_credentials(credentials: HTTPAuthorizationCredentials):
     """Validate the bearer token against the ones we know."""
     if credentials.scheme != 'Bearer':
-        raise HTTPException(401, "Invalid authorization token")    
-    try:        
-        config: ServerConfig = app.server_config
-        with open(config.files.users) as f:
-            for l in f.readlines():
-                is_admin, user, token = l.strip().split(':')
-                if f"{user}:{token}" == credentials.credentials:
-                    return user, is_admin.lower()[0] == 'y'
-    except Exception as e:
-        logging.warning(f"Cannot read credentials file: {e}.  Will deny access")
-    raise HTTPException(401, "Invalid authorization token")
+        raise HTTPException(401, "Invalid authorization token")
+    found = credentials_store.lookup(credentials.credentials)
+    if found is None:
+        raise HTTPException(401, "Invalid authorization token")
+    return found
+
+
+def get_owned_job(session: Session, id: int, user: str, is_admin: bool) -> TranscriptionJob:
+    """Get a job, as long as the user is allowed to see it"""
+    job = session.get(TranscriptionJob, id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if not is_admin and job.owner != user:
+        raise HTTPException(status_code=403, detail="Unauthorized")
+    return job
 
 
 @app.get("/transcription/lock")
-async def lock_transcription_queue(session: SessionDep,
-                                   credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)]):
+async def lock_transcription_queue(credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)]):
     "Block new jobs from being submitted (admin only)"
     user, is_admin = validate_credentials(credentials)
     if not is_admin:
         raise HTTPException(401, "Unauthorized")
-    app.server_lock = True    
+    app.server_lock = True
     return {"ok": True}
-    
+
 
 @app.get("/transcription/unlock")
-async def unlock_transcription_queue(session: SessionDep,
-                                   credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)]):
+async def unlock_transcription_queue(credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)]):
     "Allow new jobs to be submitted (admin only)"
     user, is_admin = validate_credentials(credentials)
     if not is_admin:
@@ -85,164 +157,577 @@ async def unlock_transcription_queue(session: SessionDep,
 
 
 @app.get("/transcription/")
-async def get_transcription_list(session: SessionDep, 
-                                 credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)],
+async def get_transcription_list(credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)],
+                                 response: Response,
+                                 after: Annotated[int, Query(description="Only return jobs with an id greater than this (the X-Next-Cursor header from the previous page)")] = 0,
+                                 state: Annotated[TranscriptionState | None, Query(description="Only return jobs in this state")] = None,
+                                 priority: Annotated[TranscriptionPriority | None, Query(description="Only return jobs with this priority")] = None,
+                                 owner: Annotated[str | None, Query(description="Only return jobs for this owner (admin only)")] = None,
                                  offset: int = 0,
                                  limit: Annotated[int, Query(le=100)]= 100) -> list[TranscriptionJob]:
-    """Return a list of all of the transcription jobs"""
-    user, is_admin = validate_credentials(credentials)    
-    results = []
-    for x in session.exec(select(TranscriptionJob).offset(offset).limit(limit)).all():
-        if is_admin or x.owner == user:
-            results.append(x)
+    """Return a list of the transcription jobs, ordered by id.  If there may be
+       more jobs the X-Next-Cursor header will hold the value to use for
+       'after' to get the next page."""
+    user, is_admin = validate_credentials(credentials)
+    query = select(TranscriptionJob).where(TranscriptionJob.id > after)
+    if not is_admin:
+        query = query.where(TranscriptionJob.owner == user)
+    elif owner is not None:
+        query = query.where(TranscriptionJob.owner == owner)
+    if state is not None:
+        query = query.where(TranscriptionJob.state == state)
+    if priority is not None:
+        query = query.where(TranscriptionJob.priority == int(priority))
+    query = query.order_by(TranscriptionJob.id).offset(offset).limit(limit)
+    results = await run_db(lambda session: session.exec(query).all())
+    # limit=0 is an empty page, not a full one
+    if results and len(results) == limit:
+        response.headers['X-Next-Cursor'] = str(results[-1].id)
     return results
 
-@app.post("/transcription/")
-async def new_transcription_job(req: TranscriptionRequest, 
-                                session: SessionDep,
-                                credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)]) -> TranscriptionJob:
-    """Create a new transcription job"""
+
+def new_job(user: str, req: TranscriptionRequest) -> TranscriptionJob:
+    """Build the job for a request.  A ValueError is raised if this server
+       doesn't run the engine."""
+    if not engine_registry.is_enabled(req.options.engine):
+        raise ValueError(f"The {req.options.engine} engine is not enabled on this server")
     # Basically, we're going to convert the request into json and store it in the
     # database so we can reconsitute it at processing time.  The rest of the data
     # is the processing/status information that the processing will fill in.
-    user, is_admin = validate_credentials(credentials)  
+    return TranscriptionJob(owner=user,
+                            engine=req.options.engine,
+                            state=TranscriptionState.QUEUED,
+                            message="Job has been queued",
+                            request=req.model_dump_json(),
+                            priority=int(req.priority),
+                            notification_type=req.notification_type,
+                            queue_time=time.time())
+
+
+def add_jobs(session: Session, jobs: list[TranscriptionJob]) -> list[TranscriptionJob]:
+    """Insert the jobs in one transaction"""
+    session.add_all(jobs)
+    session.commit()
+    return jobs
+
+
+@app.post("/transcription/")
+async def new_transcription_job(req: TranscriptionRequest,
+                                credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)]) -> TranscriptionJob:
+    """Create a new transcription job"""
+    user, is_admin = validate_credentials(credentials)
     if app.server_lock:
         raise HTTPException(503, "Submitting new jobs is prohibited")
-    job = TranscriptionJob(owner=user,
-                           state=TranscriptionState.QUEUED,
-                           message="Job has been queued",
-                           request=req.model_dump_json(),
-                           priority=int(req.priority),
-                           queue_time=time.time())
-    
-    session.add(job)
-    session.commit()
-    session.refresh(job)    
+    try:
+        job = new_job(user, req)
+    except ValueError as e:
+        raise HTTPException(422, str(e))
+    job, = await run_db(add_jobs, [job])
+    job_events.publish(job.id, job.state, job.message)
+    wake_dispatcher()
     return job
 
 
-@app.delete("/transcription/{id}")
-async def delete_transcription_job(id: int, 
-                                   session: SessionDep,
+@app.post("/transcription/batch")
+async def new_transcription_batch(reqs: Annotated[list[dict[str, Any]], Body(description="A list of transcription requests")],
+                                  credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)]) -> list[TranscriptionBatchItem]:
+    """Create a transcription job for each valid request in the list, all
+       in one transaction.  The results are in the same order as the
+       requests and have either the new job id or the reason it was rejected."""
+    user, is_admin = validate_credentials(credentials)
+    if app.server_lock:
+        raise HTTPException(503, "Submitting new jobs is prohibited")
+    config: ServerConfig = app.server_config
+    if len(reqs) > config.server.max_batch:
+        raise HTTPException(413, f"A batch can have at most {config.server.max_batch} requests")
+    results = []
+    jobs = []
+    for index, item in enumerate(reqs):
+        try:
+            jobs.append(new_job(user, TranscriptionRequest.model_validate(item)))
+            results.append(TranscriptionBatchItem(index=index))
+        except ValueError as e:
+            # a bad request (ValidationError is a ValueError) or an engine we don't run
+            results.append(TranscriptionBatchItem(index=index, error=str(e)))
+    if jobs:
+        jobs = iter(await run_db(add_jobs, jobs))
+        for result in results:
+            if result.error is None:
+                job = next(jobs)
+                result.id = job.id
+                job_events.publish(job.id, job.state, job.message)
+        wake_dispatcher()
+    return results
+
+
+def job_statuses(session: Session, ids: list[int], user: str, is_admin: bool) -> list[TranscriptionStatus]:
+    query = (select(TranscriptionJob.id, TranscriptionJob.state, TranscriptionJob.message, TranscriptionJob.finish_time)
+             .where(TranscriptionJob.id.in_(ids)))
+    if not is_admin:
+        query = query.where(TranscriptionJob.owner == user)
+    return [TranscriptionStatus(id=id, state=state, message=message, finish_time=finish_time)
+            for id, state, message, finish_time in session.exec(query.order_by(TranscriptionJob.id)).all()]
+
+
+# this has to come before /transcription/{id} or it'll be taken for an id
+@app.get("/transcription/status")
+async def get_transcription_statuses(ids: Annotated[str, Query(description="Comma-separated list of job ids")],
+                                     credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)]) -> list[TranscriptionStatus]:
+    """Return the state of each of the jobs.  Jobs which don't exist (or
+       belong to someone else) are left out.  Unlike reading the job, this
+       never removes it from the database."""
+    user, is_admin = validate_credentials(credentials)
+    config: ServerConfig = app.server_config
+    try:
+        job_ids = sorted({int(x) for x in ids.split(',') if x.strip()})
+    except ValueError:
+        raise HTTPException(422, "ids must be a comma-separated list of integers")
+    if len(job_ids) > config.server.max_batch:
+        raise HTTPException(413, f"At most {config.server.max_batch} jobs can be checked at once")
+    return await run_db(job_statuses, job_ids, user, is_admin)
+
+
+def purge_jobs(session: Session, purge: TranscriptionPurge) -> dict[str, int]:
+    query = (delete(TranscriptionJob)
+             .where(TranscriptionJob.state.in_(purge.states))
+             .where(TranscriptionJob.finish_time <= time.time() - purge.older_than))
+    if purge.owner is not None:
+        query = query.where(TranscriptionJob.owner == purge.owner)
+    counts = {}
+    for state in session.exec(query.returning(TranscriptionJob.state)).scalars():
+        counts[state] = counts.get(state, 0) + 1
+    session.commit()
+    return counts
+
+
+@app.post("/transcription/purge")
+async def purge_transcription_jobs(purge: TranscriptionPurge,
                                    credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)]):
-    """Delete a transcription job.  If it is queued we'll delete it
-       from the database, otherwise we'll set it to canceled"""
-    user, is_admin = validate_credentials(credentials)  
-    job = session.get(TranscriptionJob, id)
-    if not job:
-        raise HTTPException(status_code=404, detail="Job not found")
-    if not is_admin and job.owner != user:
-        raise HTTPException(status_code=403, detail="Unauthorized")
+    """Remove the jobs which have ended that match the filter and return
+       how many were removed in each state (admin only)"""
+    user, is_admin = validate_credentials(credentials)
+    if not is_admin:
+        raise HTTPException(401, "Unauthorized")
+    counts = await run_db(purge_jobs, purge)
+    return {"deleted": sum(counts.values()), "states": counts}
 
+
+def stage_report(session: Session, since: float) -> dict:
+    """Summarize the stage timings of the jobs which finished since then"""
+    seconds = {}
+    moved = {}
+    for xscript_engine, timings in session.exec(select(TranscriptionJob.engine, TranscriptionJob.stage_timings)
+                                                .where(TranscriptionJob.finish_time >= since,
+                                                       TranscriptionJob.stage_timings != "")).all():
+        for stage, timing in json.loads(timings).items():
+            seconds.setdefault(xscript_engine, {}).setdefault(stage, []).append(timing['seconds'])
+            moved.setdefault(xscript_engine, {}).setdefault(stage, 0)
+            moved[xscript_engine][stage] += timing['bytes']
+    report = {}
+    for xscript_engine, stages in seconds.items():
+        report[xscript_engine] = {}
+        for stage, values in stages.items():
+            values.sort()
+            report[xscript_engine][stage] = {'jobs': len(values),
+                                             'total_seconds': round(sum(values), 3),
+                                             'mean_seconds': round(sum(values) / len(values), 3),
+                                             'p50_seconds': values[len(values) // 2],
+                                             'p95_seconds': values[min(len(values) - 1, int(len(values) * 0.95))],
+                                             'max_seconds': values[-1],
+                                             'bytes': moved[xscript_engine][stage]}
+    return report
+
+
+@app.get("/transcription/report")
+async def get_transcription_report(credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)],
+                                   hours: Annotated[float, Query(gt=0, description="Report on jobs which finished in this many hours")] = 24):
+    """Where the time went for the jobs still in the database, by engine
+       and stage (admin only)"""
+    user, is_admin = validate_credentials(credentials)
+    if not is_admin:
+        raise HTTPException(401, "Unauthorized")
+    return await run_db(stage_report, time.time() - hours * 3600)
+
+
+def remove_job(session: Session, id: int, user: str, is_admin: bool):
+    job = get_owned_job(session, id, user, is_admin)
     if job.state != TranscriptionState.RUNNING:
-        session.delete(job)        
+        session.delete(job)
+        message = "Job has been deleted"
     else:
         job.state = TranscriptionState.CANCELED
+        message = "Job has been canceled"
     session.commit()
+    # stop it, if the engine can
+    cancellations.cancel(id)
+    job_events.publish(id, TranscriptionState.CANCELED, message)
+
+
+@app.delete("/transcription/{id}")
+async def delete_transcription_job(id: int,
+                                   credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)]):
+    """Delete a transcription job.  If it is queued we'll delete it
+       from the database, otherwise we'll set it to canceled"""
+    user, is_admin = validate_credentials(credentials)
+    await run_db(remove_job, id, user, is_admin)
+    prefetcher.discard(id)
     return {"ok": True}
 
 
-@app.get("/transcription/{id}")
-async def get_transcript_job(id: int, 
-                             session: SessionDep,
-                             credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)]) -> TranscriptionJob:
-    """Return the information about a given transcription job"""
-    user, is_admin = validate_credentials(credentials)  
-    job = session.get(TranscriptionJob, id)    
-    if not job:
-        raise HTTPException(status_code=404, detail="Job not found")
-    if not is_admin and job.owner != user:
-        raise HTTPException(status_code=403, detail="Unauthorized")
-    if job.state in (TranscriptionState.FINISHED, TranscriptionState.CANCELED, 
+def read_job(session: Session, id: int, user: str, is_admin: bool) -> TranscriptionJob:
+    job = get_owned_job(session, id, user, is_admin)
+    if job.state in (TranscriptionState.FINISHED, TranscriptionState.CANCELED,
                      TranscriptionState.ERROR, TranscriptionState.EXPIRED):
         # clean up the database row -- they got their status so we can remove the job.
-        req = TranscriptionRequest(**json.loads(job.request))
-        if req.notification_type == 'poll':
+        if job.notification_type == 'poll':
             # the polling notification clears early
             session.delete(job)
             session.commit()
-    
     return job
 
 
+@app.get("/transcription/{id}")
+async def get_transcript_job(id: int,
+                             credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)],
+                             wait: Annotated[float, Query(ge=0, le=300, description="Wait up to this many seconds for the job's state to change before returning")] = 0) -> TranscriptionJob:
+    """Return the information about a given transcription job"""
+    user, is_admin = validate_credentials(credentials)
+    if wait:
+        # subscribe before looking so a change can't slip by in between.
+        with job_events.subscribe(id) as updates:
+            job = await run_db(get_owned_job, id, user, is_admin)
+            if job.state not in TERMINAL_STATES:
+                await wait_for_change(id, job.state, updates, wait)
+    return await run_db(read_job, id, user, is_admin)
+
+
+def job_state(session: Session, id: int) -> tuple[str, str] | None:
+    """The job's state and message, or None if it's gone"""
+    return session.exec(select(TranscriptionJob.state, TranscriptionJob.message)
+                        .where(TranscriptionJob.id == id)).first()
+
+
+async def wait_for_change(id: int, state: str, updates: asyncio.Queue, timeout: float):
+    """Wait until the job isn't in state anymore, or the time is up"""
+    deadline = time.monotonic() + timeout
+    while (remaining := deadline - time.monotonic()) > 0:
+        try:
+            if (await asyncio.wait_for(updates.get(), min(remaining, STATE_RECHECK)))['state'] != state:
+                return
+        except TimeoutError:
+            # another node may be running it
+            current = await run_db(job_state, id)
+            if current is None or current[0] != state:
+                return
+
+
+def sse(event: dict) -> str:
+    return f"data: {json.dumps(event)}\n\n"
+
+
+async def job_event_stream(id: int):
+    """The current state of the job, then every update until it's done"""
+    with job_events.subscribe(id) as updates:
+        job = await run_db(lambda session: session.get(TranscriptionJob, id))
+        if job is None:
+            return
+        yield sse({'id': id, 'state': str(job.state), 'message': job.message,
+                   'progress': None, 'time': time.time()})
+        state = job.state
+        while state not in TERMINAL_STATES:
+            try:
+                event = await asyncio.wait_for(updates.get(), STATE_RECHECK)
+            except TimeoutError:
+                # another node may be running it
+                current = await run_db(job_state, id)
+                if current is None:
+                    return
+                if current[0] == state:
+                    yield ": keepalive\n\n"
+                    continue
+                event = {'id': id, 'state': str(current[0]), 'message': current[1],
+                         'progress': None, 'time': time.time()}
+            state = event['state']
+            yield sse(event)
+
+
+@app.get("/transcription/{id}/events")
+async def stream_transcript_job_events(id: int,
+                                       credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)]):
+    """A server-sent event stream of the job's state and progress, which
+       ends when the job is done.  Unlike reading the job, this never
+       removes it from the database."""
+    user, is_admin = validate_credentials(credentials)
+    await run_db(get_owned_job, id, user, is_admin)
+    return StreamingResponse(job_event_stream(id), media_type="text/event-stream",
+                             headers={'Cache-Control': 'no-cache'})
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics for the service"""
+    if not app.server_config.metrics.enabled:
+        raise HTTPException(404, "Metrics are not enabled")
+    # some of the collectors query the database
+    return Response(await asyncio.to_thread(generate_latest), media_type=CONTENT_TYPE_LATEST)
+
+
+def wake_dispatcher():
+    """Let the queue processor know there may be work to do"""
+    dispatch_event.set()
+
+
+def queue_maintenance(session: Session):
+    """Clean up the database"""
+    # if some jobs have been canceled since we last ran our check, let's clean them up.
+    session.exec(delete(TranscriptionJob).where(TranscriptionJob.state == TranscriptionState.CANCELED))
+    session.commit()
+
+    # and remove anything that's expired
+    session.exec(delete(TranscriptionJob).where(TranscriptionJob.expire_at <= time.time()))
+    session.commit()
+
+
+def queued_jobs(session: Session, lookahead: int) -> list[QueuedJob]:
+    """The jobs at the front of the queue, in the order the scheduling
+       policy wants them started"""
+    return policy.order(DatabaseQueue(session, node_engines), lookahead, time.time())
+
+
+def start_jobs(session: Session, job_ids: list[int], node: str, lease_time: float) -> set[int]:
+    """Claim the jobs for the node, if they're still queued and it runs
+       their engines, and return the ones which were.  The state check is in
+       the update itself so only one node can win a job."""
+    started = set()
+    now = time.time()
+    for id in job_ids:
+        result = session.exec(update(TranscriptionJob)
+                              .where(TranscriptionJob.id == id,
+                                     TranscriptionJob.state == TranscriptionState.QUEUED,
+                                     TranscriptionJob.engine.in_(node_engines))
+                              .values(state=TranscriptionState.RUNNING,
+                                      message="Transcription started",
+                                      start_time=now,
+                                      worker_id=node,
+                                      lease_expires=now + lease_time))
+        if result.rowcount:
+            started.add(id)
+    session.commit()
+    return started
+
+
+async def dispatch_jobs():
+    """Start as many queued jobs as the free resources allow"""
+    config: ServerConfig = app.server_config
+    # jobs for an engine are started in order, so once one doesn't fit
+    # nothing else for that engine will be started on this pass.
+    blocked = set()
+    chosen: list[QueuedJob] = []
+    for job in await run_db(queued_jobs, config.workers.lookahead):
+        if resources.is_full():
+            break
+        if job.engine in blocked:
+            continue
+        if not resources.acquire(job.engine):
+            blocked.add(job.engine)
+            continue
+        chosen.append(job)
+    if not chosen:
+        return
+    started = await run_db(start_jobs, [job.id for job in chosen], node_id, config.scheduler.lease_time)
+    now = time.time()
+    for job in chosen:
+        id, xscript_engine = job.id, job.engine
+        if id not in started:
+            # it was deleted, or another node claimed it, while we were deciding
+            resources.release(xscript_engine)
+            prefetcher.discard(id)
+            continue
+        policy.started(job, now)
+        job_events.publish(id, TranscriptionState.RUNNING, "Transcription started", 0.0)
+        claimed_jobs.add(id)
+        task = asyncio.create_task(run_transcription_job(id, xscript_engine))
+        running_jobs.add(task)
+        task.add_done_callback(running_jobs.discard)
+
+
+def save_job(session: Session, job: TranscriptionJob, req: TranscriptionRequest) -> bool | None:
+    """Write the results of a job back to the database, along with its
+       notification if there is one.  Returns whether it needs to be sent, or
+       None if the job isn't ours to save anymore."""
+    current = session.get(TranscriptionJob, job.id)
+    if current is None:
+        # it's been removed while it was running
+        return False
+    if current.worker_id != job.worker_id:
+        # the lease ran out and the job was requeued, so it belongs to
+        # whichever node picks it up
+        logging.warning(f"Job {job.id} was requeued while it ran, dropping the results")
+        return None
+    if current.state == TranscriptionState.CANCELED and job.state != TranscriptionState.CANCELED:
+        # it was canceled on another node and finished before we heard
+        job.state = TranscriptionState.CANCELED
+        job.message = "Job was canceled while it was running"
+    for k, v in job.model_dump(exclude={'id'}).items():
+        setattr(current, k, v)
+    # queue the notification if the url notification scheme was selected.  It
+    # goes in with the job update so it can't be lost.
+    notify = req.notification_type == 'url'
+    if notify:
+        current.notify_pending = True
+        session.add(NotificationOutbox(job_id=current.id,
+                                       url=req.notification_url,
+                                       payload=current.model_dump_json(),
+                                       created=current.finish_time,
+                                       next_attempt=current.finish_time))
+    session.commit()
+    return notify
+
+
+async def run_transcription_job(job_id: int, xscript_engine: str):
+    """Run a single job, touching the database only at the beginning and
+       the end"""
+    config: ServerConfig = app.server_config
+    try:
+        # the token is set if the job is canceled while it runs
+        with cancellations.track(job_id) as token:
+            job = await run_db(lambda session: session.get(TranscriptionJob, job_id))
+            if job is None or job.state == TranscriptionState.CANCELED:
+                # it was removed or canceled between being dispatched and getting here.
+                return
+            req = TranscriptionRequest(**json.loads(job.request))
+            model = str(getattr(req.options, 'model', ''))
+            jobs_started.labels(xscript_engine, model).inc()
+            process = engine_registry.processor(xscript_engine)
+            if process is not None:
+                parms = {}
+                for k, v in req.options.model_dump().items():
+                    if k not in ('input', 'outputs'):
+                        parms[k] = v
+
+                logging.info(f"Starting transcription job {job.id} ({job.priority}, {job.queue_time}) on {xscript_engine}: {parms}")
+                await prefetcher.claim(job.id)
+                await asyncio.to_thread(process, job, config)
+                logging.info(f"Finished transcribing {job.id}, {job.state}: {job.message}")
+            else:
+                logging.warning(f"Client has requested an invalid transcription engine for job {job.id}: {xscript_engine}")
+                job.state = TranscriptionState.ERROR
+                job.message = f"Selected transcription engine {xscript_engine} is not available"
+
+            if token.cancelled:
+                # whatever the engine got done, nobody wants it now
+                job.state = TranscriptionState.CANCELED
+                job.message = "Job was canceled while it was running"
+
+        job.finish_time = time.time()
+        job.expire_at = job.finish_time + req.expiration
+        notify = await run_db(save_job, job, req)
+        if notify is None:
+            return
+        if notify:
+            notifier.wake()
+        job_events.publish(job.id, job.state, job.message, 1.0)
+        record_finish(job, model)
+    except Exception as e:
+        logging.exception(f"Job {job_id} sploded: {e}")
+    finally:
+        # give the resources back and let the dispatcher know there's room.
+        claimed_jobs.discard(job_id)
+        prefetcher.discard(job_id)
+        resources.release(xscript_engine)
+        wake_dispatcher()
+
+
+def requeue_abandoned(session: Session, node: str = None) -> int:
+    """Put running jobs back in the queue when their leases have run out,
+       along with the node's own jobs if it's given (they were left over
+       when it last stopped).  Returns how many there were."""
+    abandoned = TranscriptionJob.lease_expires < time.time()
+    if node:
+        abandoned = or_(abandoned, TranscriptionJob.worker_id == node)
+    result = session.exec(update(TranscriptionJob)
+                          .where(TranscriptionJob.state == TranscriptionState.RUNNING, abandoned)
+                          .values(state=TranscriptionState.QUEUED,
+                                  message="Job has been requeued",
+                                  worker_id="",
+                                  lease_expires=0.0))
+    session.commit()
+    return result.rowcount
+
+
+def renew_leases(session: Session, node: str, job_ids: list[int], lease_time: float) -> set[int]:
+    """Extend the leases on the jobs the node is running.  Returns the ones
+       it no longer holds, which have been canceled, or requeued because the
+       node missed its heartbeats."""
+    held = (TranscriptionJob.id.in_(job_ids),
+            TranscriptionJob.worker_id == node,
+            TranscriptionJob.state == TranscriptionState.RUNNING)
+    session.exec(update(TranscriptionJob)
+                 .where(*held)
+                 .values(lease_expires=time.time() + lease_time))
+    session.commit()
+    return set(job_ids) - set(session.exec(select(TranscriptionJob.id).where(*held)).all())
+
+
+async def heartbeat():
+    """Keep the leases on this node's jobs and stop any it has lost, and
+       requeue the jobs of nodes which have gone away"""
+    config: ServerConfig = app.server_config
+    while True:
+        await asyncio.sleep(config.scheduler.heartbeat_interval)
+        try:
+            if claimed_jobs:
+                for id in await run_db(renew_leases, node_id, list(claimed_jobs), config.scheduler.lease_time):
+                    # there's no lease to renew anymore
+                    claimed_jobs.discard(id)
+                    if cancellations.cancel(id):
+                        logging.warning(f"Job {id} has been canceled or taken from this node, stopping it")
+            requeued = await run_db(requeue_abandoned)
+            if requeued:
+                logging.warning(f"Requeued {requeued} jobs whose leases ran out")
+            # jobs submitted to the other nodes don't wake us up
+            wake_dispatcher()
+        except Exception as e:
+            logging.exception(f"Heartbeat failed: {e}")
+
+
 async def process_transcription_queue():
-    """This is a background thread that runs whisper jobs in order"""
+    """This is a background task that starts transcription jobs as the
+       resources become available"""
+    # we're just starting up so we need to do some maintenance: anything
+    # this node was running before is dead, as is anything whose lease ran
+    # out while nobody was looking.
+    requeued = await run_db(requeue_abandoned, node_id)
+    if requeued:
+        logging.info(f"Requeued {requeued} jobs which were running")
+
+    # now time for the core of this monstrosity.
+    config: ServerConfig = app.server_config
+    last_maintenance = 0
     while True:
         try:
-            with Session(engine) as session:
-                # we're just starting up so we need to do some maintenance
-                # reset anything that's running to queued.         
-                for running in session.exec(select(TranscriptionJob).where(TranscriptionJob.state == TranscriptionState.RUNNING)):
-                    running.state = TranscriptionState.QUEUED
-                session.commit()
-            
-                # now time for the core of this monstrosity.                
-                config: ServerConfig = app.server_config
-                while True:      
-                    # if some jobs have been canceled since we last ran our check, let's clean them up.
-                    for canceled in session.exec(select(TranscriptionJob).where(TranscriptionJob.state == TranscriptionState.CANCELED)):
-                        session.delete(canceled)                
-                    session.commit()
-
-                    # do the database cleanup, and handle any outstanding notifications
-                    for outstanding in session.exec(select(TranscriptionJob)):
-                        if outstanding.state in (TranscriptionState.FINISHED, TranscriptionState.EXPIRED, TranscriptionState.ERROR):
-                            req = TranscriptionRequest(**json.loads(outstanding.request))
-                            if req.notification_type == 'url' and not outstanding.url_notified:
-                                r = requests.put(req.notification_url, json=outstanding.model_dump())
-                                if r.status_code == 200:
-                                    outstanding.url_notified = True
-                            if time.time() > req.expiration + outstanding.finish_time:
-                                session.delete(outstanding)
-
-                    # TODO: handle if the cancel happens while we're running.  The processing needs to finish, but
-                    # we should throw away the database row.  Not sure how to track it.
-                    #for queued in session.exec(select(TranscriptionJob).where(TranscriptionJob.state == TranscriptionState.QUEUED)):
-
-                    queued = session.exec(select(TranscriptionJob)
-                                            .where(TranscriptionJob.state == TranscriptionState.QUEUED)
-                                            .order_by(TranscriptionJob.priority.desc(), TranscriptionJob.queue_time)
-                                            .limit(1)).first()
-                    if queued:                    
-                        queued.state = TranscriptionState.RUNNING
-                        queued.message = "Transcription started"
-                        queued.start_time = time.time()
-                        session.commit()
-                        # The engine to use is embedded in the request field, so we need to
-                        # extract it and make our choice.
-                        req = TranscriptionRequest(**json.loads(queued.request))
-                        xscript_engine = req.options.engine
-                        # real work would happen here.  
-                        processors = {'openai-whisper': process_whisper,
-                                      'whisper.cpp': process_whispercpp}
-                        if xscript_engine in processors:
-                            parms = {}
-                            for k, v in req.options.model_dump().items():
-                                if k not in ('input', 'outputs'):
-                                    parms[k] = v
-
-                            logging.info(f"Starting transcription job {queued.id} ({queued.priority}, {queued.queue_time}) on {xscript_engine}: {parms}")
-                            await asyncio.to_thread(processors[xscript_engine], queued, config)
-                            logging.info(f"Finished transcribing {queued.id}, {queued.state}: {queued.message}")
-                        else:
-                            logging.warning(f"Client has requested an invalid transcription engine for job {queued.id}: {xscript_engine}")
-                            queued.state = TranscriptionState.ERROR
-                            queued.message = f"Selected transcription engine {xscript_engine} is not available"
-                        
-                        queued.finish_time = time.time()    
-
-                        # attempt to notify the client if the url notification scheme was selected
-                        if req.notification_type == 'url':
-                            r = requests.put(req.notification_url, json=queued.model_dump())
-                            if r.status_code == 200:
-                                queued.url_notified = True
-
-                        session.commit()
-                    # give some time before polling the queue again.
-                    await asyncio.sleep(10)
+            # clear the wakeup before looking at the queue so a job
+            # submitted while we're busy isn't missed.
+            dispatch_event.clear()
+            if time.time() - last_maintenance >= config.scheduler.maintenance_interval:
+                await asyncio.to_thread(engine_registry.maintenance, config)
+                await run_db(queue_maintenance)
+                await prefetcher.prune()
+                last_maintenance = time.time()
+
+            await dispatch_jobs()
+            # and get the media ready for whatever is next in line
+            await prefetcher.schedule()
+
+            # sleep until a job is submitted, one finishes, or it's time for
+            # maintenance again.
+            timeout = max(0, last_maintenance + config.scheduler.maintenance_interval - time.time())
+            try:
+                await asyncio.wait_for(dispatch_event.wait(), timeout)
+            except TimeoutError:
+                pass
         except Exception as e:
-            logging.exception(f"Something sploded: {e}")                
-            # wait for 10 seconds in case it's a logic/syntax error so we can 
+            logging.exception(f"Something sploded: {e}")
+            # wait for 10 seconds in case it's a logic/syntax error so we can
             # actually kill it from the command line
             await asyncio.sleep(10)
-
@@ -0,0 +1,283 @@
+"""Which queued jobs to start next.
+
+The dispatcher asks the scheduling policy for the jobs at the front of the
+queue, in the order it should try to start them, and tells the policy which
+ones it actually started.  The policies only see the queue through a
+QueueView, which answers a few questions that the database can answer with
+index seeks, so picking jobs doesn't get slower as the queue grows.  It does
+get slower with the number of owners: finding the owners with jobs queued
+takes a couple of seeks for each owner in the table, and the fair policy
+needs a seek per queued owner and priority, although they're all made by one
+query.
+The simulator in benchmarks/ runs the same policies against a queue in
+memory.
+
+Two policies are built in:
+* priority - strict priority, then first come first served
+* fair - within a priority level, the owners with queued jobs take turns in
+  proportion to their weights (start-time fair queuing), so one owner with
+  thousands of jobs can't lock everyone else out.
+
+Both of them age jobs: a job is promoted a priority level for every
+aging_interval seconds it has been waiting, up to aging_max, so BATCH jobs
+can't starve forever.
+"""
+import abc
+import heapq
+import json
+import threading
+from collections import Counter, deque
+from typing import NamedTuple
+from sqlalchemy import true
+from sqlalchemy.orm import aliased
+from sqlmodel import Session, select, func, and_
+from config_model import Scheduler
+from job_model import TranscriptionJob, TranscriptionState, TranscriptionPriority
+
+# lowest first
+PRIORITIES = sorted(p.value for p in TranscriptionPriority)
+
+
+class QueuedJob(NamedTuple):
+    id: int
+    engine: str
+    owner: str
+    priority: int
+    queue_time: float
+
+
+class QueueView(abc.ABC):
+    """The queued jobs, as the policies see them"""
+    @abc.abstractmethod
+    def front(self, limit: int) -> list[QueuedJob]:
+        """The first jobs by priority and then queue time"""
+
+
+    @abc.abstractmethod
+    def owners(self) -> list[str]:
+        """The owners who have jobs queued"""
+
+
+    @abc.abstractmethod
+    def oldest(self, owners: list[str] | None, limit: int) -> list[QueuedJob]:
+        """The oldest limit jobs at each priority for each of the owners, or
+           for everybody together if owners is None"""
+
+
+class DatabaseQueue(QueueView):
+    """The queue in the database.  Each of these is a seek on one of the
+       queue indexes.  With engines, only the jobs for those engines are
+       seen, so a node sharing the database leaves the others' jobs alone."""
+    def __init__(self, session: Session, engines: list[str] | None = None):
+        self.session = session
+        self.engines = engines
+
+
+    def queued(self, job=TranscriptionJob):
+        """The condition for a job to be in this queue"""
+        condition = job.state == TranscriptionState.QUEUED
+        if self.engines is not None:
+            condition = and_(condition, job.engine.in_(self.engines))
+        return condition
+
+
+    @staticmethod
+    def columns():
+        return select(TranscriptionJob.id, TranscriptionJob.engine, TranscriptionJob.owner,
+                      TranscriptionJob.priority, TranscriptionJob.queue_time)
+
+
+    def front(self, limit: int) -> list[QueuedJob]:
+        return [QueuedJob(*row) for row in
+                self.session.exec(self.columns()
+                                  .where(self.queued())
+                                  .order_by(TranscriptionJob.priority.desc(), TranscriptionJob.queue_time)
+                                  .limit(limit)).all()]
+
+
+    def owners(self) -> list[str]:
+        # SELECT DISTINCT would read every row.  This hops from one owner to
+        # the next on the (owner, state, ...) index instead and keeps the
+        # ones with something queued, so it costs a couple of seeks for
+        # every owner who has jobs in the table, queued or not.
+        walk = select(func.min(TranscriptionJob.owner).label('owner')).cte('owners', recursive=True)
+        following = (select(func.min(TranscriptionJob.owner))
+                     .where(TranscriptionJob.owner > walk.c.owner)
+                     .scalar_subquery())
+        walk = walk.union_all(select(following).where(walk.c.owner.is_not(None)))
+        other = aliased(TranscriptionJob)
+        queued = select(other.id).where(other.owner == walk.c.owner, self.queued(other)).exists()
+        return list(self.session.exec(select(walk.c.owner).where(walk.c.owner.is_not(None), queued)).all())
+
+
+    def oldest(self, owners: list[str] | None, limit: int) -> list[QueuedJob]:
+        # one query with a seek for each owner and priority: the heads are
+        # the (owner, priority) pairs, and each one picks its oldest jobs
+        # with a correlated subquery on the queue indexes
+        priorities = func.json_each(json.dumps(PRIORITIES)).table_valued('value').alias('priorities')
+        if owners is None:
+            heads = select(priorities.c.value.label('priority'))
+        else:
+            listed = func.json_each(json.dumps(owners)).table_valued('value').alias('listed')
+            heads = (select(listed.c.value.label('owner'), priorities.c.value.label('priority'))
+                     .join_from(listed, priorities, true()))
+        heads = heads.subquery('heads')
+        other = aliased(TranscriptionJob)
+        ids = select(other.id).where(self.queued(other), other.priority == heads.c.priority)
+        if owners is not None:
+            ids = ids.where(other.owner == heads.c.owner)
+        ids = ids.order_by(other.queue_time).limit(limit)
+        query = self.columns().select_from(heads).join(TranscriptionJob, TranscriptionJob.id.in_(ids))
+        return [QueuedJob(*row) for row in self.session.exec(query).all()]
+
+
+class SchedulingPolicy(abc.ABC):
+    """Puts the queued jobs in the order they should be started"""
+    def __init__(self, config: Scheduler):
+        self.config = config
+
+
+    def level(self, job: QueuedJob, now: float) -> int:
+        """The job's priority, after aging"""
+        if self.config.aging_interval <= 0 or job.priority >= self.config.aging_max:
+            return job.priority
+        steps = int((now - job.queue_time) / self.config.aging_interval)
+        return min(self.config.aging_max, job.priority + steps)
+
+
+    def candidates(self, jobs: list[QueuedJob], limit: int, now: float) -> list[QueuedJob]:
+        """The first jobs by aged priority and then queue time, out of the
+           oldest limit jobs at each priority.  Within a priority the oldest
+           job is also the most aged, so the front of each priority is all
+           that needs to be looked at."""
+        return sorted(jobs, key=lambda j: (-self.level(j, now), j.queue_time))[:limit]
+
+
+    @abc.abstractmethod
+    def order(self, queue: QueueView, limit: int, now: float) -> list[QueuedJob]:
+        """Up to limit jobs, in the order they should be started"""
+
+
+    def started(self, job: QueuedJob, now: float):
+        """The dispatcher has started the job"""
+        pass
+
+
+    def stats(self) -> dict:
+        return {}
+
+
+class PriorityPolicy(SchedulingPolicy):
+    """Strict priority, then first come first served"""
+    def order(self, queue: QueueView, limit: int, now: float) -> list[QueuedJob]:
+        if self.config.aging_interval <= 0:
+            return queue.front(limit)
+        return self.candidates(queue.oldest(None, limit), limit, now)
+
+
+class FairSharePolicy(SchedulingPolicy):
+    """Weighted fair queuing between owners within each priority level.
+
+       Every owner has a virtual finish tag which moves forward by
+       1 / weight for each job of theirs which is started.  The owner whose
+       next job would start at the lowest tag goes next, and an owner who
+       has had nothing queued for a while starts from the current virtual
+       time, so idle time can't be saved up for a burst later.  The tags
+       are only kept in memory: they start over when the server restarts,
+       and each node sharing a database keeps its own."""
+    def __init__(self, config: Scheduler):
+        super().__init__(config)
+        self.vtime = 0.0
+        self.finish: dict[str, float] = {}
+        self.lock = threading.Lock()
+
+
+    def weight(self, owner: str) -> float:
+        return self.config.owner_weights.get(owner, 1.0)
+
+
+    def order(self, queue: QueueView, limit: int, now: float) -> list[QueuedJob]:
+        if limit <= 0:
+            return []
+        with self.lock:
+            vtime = self.vtime
+            finish = dict(self.finish)
+        owners = queue.owners()
+        # most owners only get a few of the picks, so start with a few of
+        # each one's jobs and go back for more when an owner runs out.
+        batch = min(limit, max(4, 2 * limit // max(1, len(owners))))
+        heads: dict[str, deque[QueuedJob]] = {owner: deque() for owner in owners}
+        fetched: dict[str, int] = {}
+        seen = set()
+        def fill(owner: str, jobs: list[QueuedJob], want: int):
+            # if every priority came up short, that's all of the owner's
+            # jobs and they're all in order
+            counts = Counter(job.priority for job in jobs)
+            everything = all(n < want for n in counts.values())
+            fetched[owner] = limit if everything else want
+            jobs = self.candidates(jobs, len(jobs) if everything else want, now)
+            heads[owner] = deque(job for job in jobs if job.id not in seen)
+
+        def refill(owner: str):
+            if fetched[owner] < limit:
+                want = min(limit, 2 * fetched[owner])
+                fill(owner, queue.oldest([owner], want), want)
+
+        jobs: dict[str, list[QueuedJob]] = {owner: [] for owner in owners}
+        for job in queue.oldest(owners, batch) if owners else []:
+            jobs[job.owner].append(job)
+        for owner in owners:
+            fill(owner, jobs[owner], batch)
+
+        # the tag each owner's next job would start at
+        heap = []
+        for owner in owners:
+            if heads[owner]:
+                job = heads[owner][0]
+                tag = max(vtime, finish.get(owner, 0.0))
+                heapq.heappush(heap, (-self.level(job, now), tag, job.queue_time, owner))
+
+        # play out the picks as if each job were started in turn
+        chosen = []
+        while heap and len(chosen) < limit:
+            _, tag, _, owner = heapq.heappop(heap)
+            job = heads[owner].popleft()
+            if job.id not in seen:
+                seen.add(job.id)
+                chosen.append(job)
+            if not heads[owner]:
+                refill(owner)
+            if heads[owner]:
+                tag += 1 / self.weight(owner)
+                job = heads[owner][0]
+                heapq.heappush(heap, (-self.level(job, now), tag, job.queue_time, owner))
+        return chosen
+
+
+    def started(self, job: QueuedJob, now: float):
+        with self.lock:
+            start = max(self.vtime, self.finish.get(job.owner, 0.0))
+            self.finish[job.owner] = start + 1 / self.weight(job.owner)
+            self.vtime = start
+            # an owner whose tag is behind the virtual time starts from
+            # the virtual time anyway
+            if len(self.finish) > 1000:
+                self.finish = {k: v for k, v in self.finish.items() if v > self.vtime}
+
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'virtual_time': self.vtime,
+                    'owners': len(self.finish)}
+
+
+# the policies scheduler.policy can name.  Another policy can be added here
+# before the server starts.
+POLICIES: dict[str, type[SchedulingPolicy]] = {'priority': PriorityPolicy,
+                                                'fair': FairSharePolicy}
+
+
+def make_policy(config: Scheduler) -> SchedulingPolicy:
+    if config.policy not in POLICIES:
+        raise ValueError(f"Unknown scheduling policy {config.policy}, expected one of {', '.join(POLICIES)}")
+    return POLICIES[config.policy](config)
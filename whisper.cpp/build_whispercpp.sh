@@ -17,6 +17,12 @@ git clone https://github.com/ggml-org/whisper.cpp.git
 pushd whisper.cpp
 git checkout v1.7.6
 
+# whisper-resident is whisper-cli with the model kept loaded between jobs
+rm -rf examples/resident
+cp -r $SCRIPT_DIR/resident examples/resident
+grep -q 'add_subdirectory(resident)' examples/CMakeLists.txt || \
+    echo 'add_subdirectory(resident)' >> examples/CMakeLists.txt
+
 # choose to build CUDA if it's available, otherwise CPU
 if nvcc --version > /dev/null; then
     BUILD_OPTIONS="-DGGML_CUDA=1"
@@ -33,6 +39,7 @@ popd
 # make some symlinks to stuff in whisper.cpp so the tools can easily find
 # what we need
 ln -s whisper.cpp/build/bin/whisper-cli .
+ln -s whisper.cpp/build/bin/whisper-resident .
 ln -s whisper.cpp/models/download-ggml-model.sh .
 ln -s whisper.cpp/models/download-vad-model.sh .
 
@@ -0,0 +1,207 @@
+// whisper-resident: whisper-cli that keeps its model loaded between jobs.
+//
+// It's started with the whisper-cli options which are the same for every
+// job (the model, the thread count, the output formats) and then reads one
+// job per line on stdin:
+//
+//     <input file> TAB <output prefix> TAB <language>
+//
+// Each job is run by whisper-cli's own main(), so the outputs are exactly
+// the ones whisper-cli writes, but the model is only loaded once.  "ready"
+// goes to stdout when the model is loaded and one line when each job is
+// done:
+//
+//     ok TAB <language code> TAB <media length in seconds>
+//     error TAB <message>
+//
+// Everything whisper-cli prints goes to stderr.
+
+#include "common.h"
+#include "common-whisper.h"
+#include "whisper.h"
+#include "grammar-parser.h"
+#include "ggml-backend.h"
+
+#include <cstdio>
+#include <iostream>
+#include <string>
+#include <vector>
+#include <unistd.h>
+
+static struct whisper_context * resident_ctx = nullptr;
+static struct whisper_state * resident_state = nullptr;
+static int resident_samples = 0;
+
+// whisper-cli loads the model and frees it for every run.  Hand it the one
+// we already have instead.
+static struct whisper_context * resident_init(const char * path_model, struct whisper_context_params params) {
+    if (resident_ctx == nullptr) {
+        resident_ctx = whisper_init_from_file_with_params_no_state(path_model, params);
+    }
+    return resident_ctx;
+}
+
+static void resident_free(struct whisper_context * /*ctx*/) {
+}
+
+static void resident_release() {
+    if (resident_state != nullptr) {
+        whisper_free_state(resident_state);
+        resident_state = nullptr;
+    }
+    if (resident_ctx != nullptr) {
+        whisper_free(resident_ctx);
+        resident_ctx = nullptr;
+    }
+}
+
+// the backends only need to be loaded once
+static void resident_load_backends() {
+    static bool loaded = false;
+    if (!loaded) {
+        ggml_backend_load_all();
+        loaded = true;
+    }
+}
+
+// Each job gets a new state.  Some of it (the sampling rng) carries over
+// from one run to the next, and whisper-cli always starts with a new one.
+// The audio isn't split over processors, whisper-cli doesn't by default.
+static int resident_full_parallel(struct whisper_context * ctx, struct whisper_full_params params,
+                                  const float * samples, int n_samples, int /*n_processors*/) {
+    if (resident_state != nullptr) {
+        whisper_free_state(resident_state);
+    }
+    resident_state = whisper_init_state(ctx);
+    if (resident_state == nullptr) {
+        return -1;
+    }
+    resident_samples = n_samples;
+    return whisper_full_with_state(ctx, resident_state, params, samples, n_samples);
+}
+
+// OpenVINO encoders belong to a state, which doesn't exist yet
+static int resident_init_openvino_encoder(struct whisper_context * /*ctx*/, const char * /*model_path*/,
+                                          const char * /*device*/, const char * /*cache_dir*/) {
+    return 1;
+}
+
+#define whisper_init_from_file_with_params resident_init
+#define whisper_free resident_free
+#define whisper_full_parallel resident_full_parallel
+#define whisper_ctx_init_openvino_encoder resident_init_openvino_encoder
+#define ggml_backend_load_all resident_load_backends
+// the results are in the job's state rather than the context's
+#define whisper_full_n_segments(ctx) whisper_full_n_segments_from_state(resident_state)
+#define whisper_full_lang_id(ctx) whisper_full_lang_id_from_state(resident_state)
+#define whisper_full_get_segment_t0(ctx, i) whisper_full_get_segment_t0_from_state(resident_state, i)
+#define whisper_full_get_segment_t1(ctx, i) whisper_full_get_segment_t1_from_state(resident_state, i)
+#define whisper_full_get_segment_speaker_turn_next(ctx, i) \
+    whisper_full_get_segment_speaker_turn_next_from_state(resident_state, i)
+#define whisper_full_get_segment_text(ctx, i) whisper_full_get_segment_text_from_state(resident_state, i)
+#define whisper_full_get_segment_no_speech_prob(ctx, i) \
+    whisper_full_get_segment_no_speech_prob_from_state(resident_state, i)
+#define whisper_full_n_tokens(ctx, i) whisper_full_n_tokens_from_state(resident_state, i)
+#define whisper_full_get_token_text(ctx, i, j) whisper_full_get_token_text_from_state(ctx, resident_state, i, j)
+#define whisper_full_get_token_id(ctx, i, j) whisper_full_get_token_id_from_state(resident_state, i, j)
+#define whisper_full_get_token_data(ctx, i, j) whisper_full_get_token_data_from_state(resident_state, i, j)
+#define whisper_full_get_token_p(ctx, i, j) whisper_full_get_token_p_from_state(resident_state, i, j)
+#define main whisper_cli_main
+#include "cli.cpp"
+#undef main
+#undef whisper_full_get_token_p
+#undef whisper_full_get_token_data
+#undef whisper_full_get_token_id
+#undef whisper_full_get_token_text
+#undef whisper_full_n_tokens
+#undef whisper_full_get_segment_no_speech_prob
+#undef whisper_full_get_segment_text
+#undef whisper_full_get_segment_speaker_turn_next
+#undef whisper_full_get_segment_t1
+#undef whisper_full_get_segment_t0
+#undef whisper_full_lang_id
+#undef whisper_full_n_segments
+#undef ggml_backend_load_all
+#undef whisper_ctx_init_openvino_encoder
+#undef whisper_full_parallel
+#undef whisper_free
+#undef whisper_init_from_file_with_params
+
+static int run_cli(int argc, char ** argv, const std::vector<std::string> & extra) {
+    std::vector<std::string> args(argv, argv + argc);
+    args.insert(args.end(), extra.begin(), extra.end());
+    std::vector<char *> cargs;
+    for (auto & arg : args) {
+        cargs.push_back(arg.data());
+    }
+    cargs.push_back(nullptr);
+    const int ret = whisper_cli_main((int) args.size(), cargs.data());
+    fflush(stdout);
+    fflush(stderr);
+    return ret;
+}
+
+static std::vector<std::string> split_job(const std::string & line) {
+    std::vector<std::string> fields;
+    size_t start = 0;
+    while (true) {
+        size_t tab = line.find('\t', start);
+        fields.push_back(line.substr(start, tab - start));
+        if (tab == std::string::npos) {
+            return fields;
+        }
+        start = tab + 1;
+    }
+}
+
+int main(int argc, char ** argv) {
+    // stdout is only for the replies, whisper-cli's output goes to stderr
+    FILE * replies = fdopen(dup(STDOUT_FILENO), "w");
+    if (replies == nullptr || dup2(STDERR_FILENO, STDOUT_FILENO) < 0) {
+        perror("whisper-resident");
+        return 1;
+    }
+
+    // load the model by giving whisper-cli an input which isn't audio: it
+    // sets up the model and then skips the input.
+    if (run_cli(argc, argv, { "-f", "/dev/null" }) != 0 || resident_ctx == nullptr) {
+        fprintf(replies, "error\tcannot load the model\n");
+        fflush(replies);
+        return 1;
+    }
+    fprintf(replies, "ready\n");
+    fflush(replies);
+
+    std::string line;
+    while (std::getline(std::cin, line)) {
+        const auto job = split_job(line);
+        if (job.size() != 3) {
+            fprintf(replies, "error\texpected input, output prefix and language\n");
+            fflush(replies);
+            continue;
+        }
+        // whisper-cli exits on an unknown language, which would take the
+        // model with it
+        if (job[2] != "auto" && whisper_lang_id(job[2].c_str()) == -1) {
+            fprintf(replies, "error\tunknown language '%s'\n", job[2].c_str());
+            fflush(replies);
+            continue;
+        }
+
+        resident_samples = 0;
+        const int ret = run_cli(argc, argv, { "-f", job[0], "-of", job[1], "-l", job[2] });
+        if (ret != 0) {
+            fprintf(replies, "error\twhisper-cli returned %d\n", ret);
+        } else if (resident_samples == 0) {
+            fprintf(replies, "error\tcannot read '%s'\n", job[0].c_str());
+        } else {
+            fprintf(replies, "ok\t%s\t%.3f\n",
+                    whisper_lang_str(whisper_full_lang_id_from_state(resident_state)),
+                    float(resident_samples) / WHISPER_SAMPLE_RATE);
+        }
+        fflush(replies);
+    }
+
+    resident_release();
+    return 0;
+}